@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+'''
+S3 upload throughput benchmark.
+
+Runs against the S3-compatible server started by ``inv start`` (minio)
+and compare a single in-memory ``put_object`` with streamed multipart uploads
+for multiple concurrency levels::
+
+    $ python bench/s3_upload.py --size 256 --concurrency 1 4 10
+'''
+from __future__ import unicode_literals, print_function
+
+import argparse
+import io
+import logging
+import os
+import time
+
+from flask_fs.backends.s3 import S3Backend
+from flask_fs.storage import Config
+
+MB = 1024 * 1024
+
+logging.getLogger('boto3').setLevel(logging.WARNING)
+logging.getLogger('botocore').setLevel(logging.WARNING)
+
+
+def backend(args, **kwargs):
+    config = Config(endpoint=args.endpoint, region=args.region,
+                    access_key=args.access_key, secret_key=args.secret_key,
+                    multipart_chunksize=args.part_size * MB, **kwargs)
+    return S3Backend(args.bucket, config)
+
+
+def measure(label, size, func, repeat):
+    durations = []
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        durations.append(time.time() - start)
+    best = min(durations)
+    print('{0:<32} {1:>8.2f}s {2:>10.1f} MB/s'.format(label, best, size / MB / best))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--endpoint', default='http://localhost:9000')
+    parser.add_argument('--region', default='us-east-1')
+    parser.add_argument('--access-key', default='ABCDEFGHIJKLMNOQRSTU')
+    parser.add_argument('--secret-key', default='abcdefghiklmnoqrstuvwxyz1234567890abcdef')
+    parser.add_argument('--bucket', default='bench')
+    parser.add_argument('--size', type=int, default=128, help='File size in MB')
+    parser.add_argument('--part-size', type=int, default=8, help='Part size in MB')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 10])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    size = args.size * MB
+    content = os.urandom(size)
+    print('Uploading {0}MB by {1}MB parts'.format(args.size, args.part_size))
+
+    single = backend(args)
+    measure('put_object (in memory)', size,
+            lambda: single.write('bench.bin', content), args.repeat)
+
+    for concurrency in args.concurrency:
+        multipart = backend(args, max_concurrency=concurrency)
+        measure('multipart (concurrency={0})'.format(concurrency), size,
+                lambda: multipart.write('bench.bin', io.BytesIO(content)), args.repeat)
+
+    single.delete('bench.bin')
+
+
+if __name__ == '__main__':
+    main()
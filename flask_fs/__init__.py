@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import logging
+import time
+
 from os.path import join
 
 from .__about__ import __version__, __description__  # noqa: Facade pattern
@@ -11,11 +14,13 @@ try:
     from .backends import BaseBackend, DEFAULT_BACKEND  # noqa: Facade pattern
     from .errors import *  # noqa: Facade pattern
     from .files import *  # noqa: Facade pattern
-    from .storage import Storage  # noqa: Facade pattern
+    from .storage import Storage, index_config  # noqa: Facade pattern
 
 except ImportError as e:
     print(e)
 
+log = logging.getLogger(__name__)
+
 
 def by_name(name):
     '''Get a storage by its name'''
@@ -39,10 +44,13 @@ def init_app(app, *storages):
     app.config.setdefault('FS_BACKEND', DEFAULT_BACKEND)
     app.config.setdefault('FS_IMAGES_OPTIMIZE', False)
 
+    start = time.time()
+    index = index_config(app.config)
     state = app.extensions['fs'] = app.extensions.get('fs', {})
     for storage in storages:
-        storage.configure(app)
+        storage.configure(app, index)
         state[storage.name] = storage
+    log.debug('Configured %d storage(s) in %.2fms', len(storages), (time.time() - start) * 1000)
 
     from .views import bp
     app.register_blueprint(bp, url_prefix=app.config['FS_PREFIX'])
@@ -1,15 +1,100 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import logging
+import os
+import shutil
+import threading
+
 import six
 
-from flask_fs import files
+from flask import Response, has_request_context, request
+
+from flask_fs import batch, cache, files, hashing, responses, streams
+from flask_fs.errors import FileExists, OperationNotSupported
 
-__all__ = [i.encode('ascii') for i in ('BaseBackend', 'DEFAULT_BACKEND')]
+__all__ = [i.encode('ascii') for i in (
+    'BaseBackend', 'DEFAULT_BACKEND', 'client_property', 'thread_client_property'
+)]
 
+log = logging.getLogger(__name__)
 
 DEFAULT_BACKEND = 'local'
 
+#: Default validity (in seconds) of signed URLs
+DEFAULT_SIGNED_URL_EXPIRES = 3600
+
+#: Cached signed URLs are renewed when their remaining validity drops below this (in seconds)
+SIGNED_URL_MARGIN = 60
+
+_pid = os.getpid()
+
+
+def _after_fork():
+    global _pid
+    _pid = os.getpid()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def current_pid():
+    '''The current process identifier, updated after each fork'''
+    return _pid if hasattr(os, 'register_at_fork') else os.getpid()
+
+
+class client_property(object):
+    '''
+    A cached property for backend clients (connections, sessions...).
+
+    Clients inherited from a parent process are not reused:
+    they are transparently rebuilt in forked processes
+    so each worker of a pre-forking server gets its own connections.
+    '''
+    def __init__(self, func):
+        self.func = func
+        self.__name__ = func.__name__
+        self.__doc__ = func.__doc__
+        self.key = '_client_{0}'.format(func.__name__)
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self
+        pid = current_pid()
+        cached = self.get_cached(obj)
+        if cached is not None:
+            if cached[0] == pid:
+                return cached[1]
+            log.debug('Process forked, rebuilding %s.%s', owner.__name__, self.__name__)
+        value = self.func(obj)
+        self.set_cached(obj, (pid, value))
+        return value
+
+    def get_cached(self, obj):
+        return obj.__dict__.get(self.key)
+
+    def set_cached(self, obj, cached):
+        obj.__dict__[self.key] = cached
+
+
+class thread_client_property(client_property):
+    '''
+    A :class:`client_property` building a dedicated client for each thread,
+    for clients which are not thread-safe.
+    '''
+    def local(self, obj):
+        local = obj.__dict__.get(self.key)
+        if local is None:
+            local = obj.__dict__.setdefault(self.key, threading.local())
+        return local
+
+    def get_cached(self, obj):
+        return getattr(self.local(obj), 'cached', None)
+
+    def set_cached(self, obj, cached):
+        self.local(obj).cached = cached
+
 
 class BaseBackend(object):
     '''
@@ -18,24 +103,146 @@ class BaseBackend(object):
     root = None
     DEFAULT_MIME = 'application/octet-stream'
 
+    #: Whether :meth:`write` and :meth:`save` accept an `overwrite` parameter
+    #: and raise :exc:`~flask_fs.errors.FileExists` themselves.
+    #: Storages check existence before writing on backends leaving it to `False`.
+    exclusive_create = False
+
+    #: Whether :meth:`read`, :meth:`open` and :meth:`serve`
+    #: raise :exc:`~flask_fs.errors.FileNotFound` for missing files.
+    #: Storages check existence before reading on backends leaving it to `False`.
+    raises_not_found = False
+
     def __init__(self, name, config):
         self.name = name
         self.config = config
+        self.checksum_algorithm = config.get('checksum_algorithm', hashing.DEFAULT_ALGORITHM)
+        if self.checksum_algorithm not in hashing.ALGORITHMS:
+            raise ValueError('Unsupported checksum algorithm "{0}"'.format(self.checksum_algorithm))
+        self.batch_workers = config.get('batch_workers', batch.DEFAULT_WORKERS)
+        self.part_size = config.get('part_size', streams.DEFAULT_PART_SIZE)
+        self.serve_chunk_size = config.get('serve_chunk_size', streams.CHUNK_SIZE)
+        self.signed_url_expires = config.get('signed_url_expires', DEFAULT_SIGNED_URL_EXPIRES)
+        self.signed_urls = cache.MemoryCache(
+            size=config.get('signed_url_cache_size', cache.DEFAULT_SIZE)
+        )
+
+    def warmup(self):
+        '''
+        Eagerly initialize the backend clients and connections.
+
+        Backends connect lazily on first operation,
+        this allows to pay the connection cost upfront.
+        '''
+        pass
 
     def exists(self, filename):
         '''Test wether a file exists or not given its filename in the storage'''
         raise NotImplementedError('Existance checking is not implemented')
 
     def open(self, filename, *args, **kwargs):
-        '''Open a file given its filename relative to the storage root'''
+        '''
+        Open a file given its filename relative to the storage root
+
+        :raises FileNotFound: when opening a missing file in read mode
+        '''
         raise NotImplementedError('Open operation is not implemented')
 
     def read(self, filename):
-        '''Read a file content given its filename in the storage'''
+        '''
+        Read a file content given its filename in the storage
+
+        :raises FileNotFound: when the file does not exists
+        '''
         raise NotImplementedError('Read operation is not implemented')
 
-    def write(self, filename, content):
-        '''Write content into a file given its filename in the storage'''
+    def read_range(self, filename, start, end=None):
+        '''
+        Read a range of bytes from a file given its filename in the storage.
+
+        Default implementation reads the file opened in binary mode up to `end`.
+        Backends should overwrite it if there is a better way.
+
+        :param int start: The first byte offset
+        :param int end: The offset after the last byte (default to the end of the file)
+        :raises FileNotFound: when the file does not exists
+        '''
+        with self.open(filename, 'rb') as f:
+            if streams.seekable(f):
+                f.seek(start)
+            else:
+                remaining = start
+                while remaining > 0:
+                    skipped = len(f.read(min(remaining, streams.CHUNK_SIZE)))
+                    if not skipped:
+                        break
+                    remaining -= skipped
+            return f.read() if end is None else f.read(max(end - start, 0))
+
+    def open_seekable(self, filename):
+        '''
+        Open a file for random binary reads.
+
+        Default implementation returns a lazy reader fetching ranges with :meth:`read_range`
+        with a small read-ahead buffer.
+        A missing file raises :exc:`~flask_fs.errors.FileNotFound` on first read.
+        '''
+        return streams.range_reader(lambda start, end: self.read_range(filename, start, end),
+                                    lambda: self.get_metadata(filename)['size'])
+
+    def iter_range(self, filename, start, end):
+        '''
+        Iterate over the binary chunks of a range of bytes of a file.
+
+        Default implementation reads the file opened with :meth:`open_seekable`
+        by chunks of `serve_chunk_size` bytes.
+        Backends should overwrite it if there is a better way.
+
+        :param int start: The first byte offset
+        :param int end: The offset after the last byte
+        :raises FileNotFound: when the file does not exists
+        '''
+        f = self.open_seekable(filename)
+        try:
+            f.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                data = f.read(min(remaining, self.serve_chunk_size))
+                if not data:
+                    break
+                remaining -= len(data)
+                yield data
+        finally:
+            f.close()
+
+    def download(self, filename, fileobj):
+        '''
+        Download a file content into a binary file-like object.
+
+        Default implementation copies the file opened in binary read mode.
+        Backends should overwrite it if there is a better way.
+
+        :raises FileNotFound: when the file does not exists
+        '''
+        with self.open(filename, 'rb') as f:
+            shutil.copyfileobj(f, fileobj, streams.CHUNK_SIZE)
+
+    def write(self, filename, content, overwrite=True):
+        '''
+        Write content into a file given its filename in the storage
+
+        Content can either be `bytes`, text, a `bytearray`, a `memoryview`,
+        a file-like object or an iterable of chunks.
+        Backends should stream file-like objects and iterables
+        instead of loading them in memory.
+        The `overwrite` parameter is only given to backends setting :attr:`exclusive_create`.
+
+        :param filename: The destination in the storage.
+        :param content: The content to write.
+        :param overwrite: if `False`, raise an exception if file exists in storage
+
+        :raises FileExists: when file exists and overwrite is `False`
+        '''
         raise NotImplementedError('Write operation is not implemented')
 
     def delete(self, filename):
@@ -56,7 +263,7 @@ class BaseBackend(object):
         self.copy(filename, target)
         self.delete(filename)
 
-    def save(self, file_or_wfs, filename, overwrite=False):
+    def save(self, file_or_wfs, filename, overwrite=True):
         '''
         Save a file-like object or a `werkzeug.FileStorage` with the specified filename.
 
@@ -65,9 +272,88 @@ class BaseBackend(object):
         :param overwrite: if `False`, raise an exception if file exists in storage
 
         :raises FileExists: when file exists and overwrite is `False`
+        :returns: the saved file with metadata computed during the upload
+        :rtype: ~flask_fs.files.SavedFile
+        '''
+        reader = self.hashing_reader(file_or_wfs, filename)
+        if self.exclusive_create:
+            self.write(filename, reader, overwrite=overwrite)
+        else:
+            self.write(filename, reader)
+        return reader.saved(filename)
+
+    def compute_checksum(self, data):
+        '''
+        Compute the checksum of some binary content with the configured algorithm.
+
+        :returns: the checksum expressed in the form `algo:hash`
+        '''
+        hasher = hashing.new(self.checksum_algorithm)
+        hasher.update(data)
+        return '{0}:{1}'.format(self.checksum_algorithm, hasher.hexdigest())
+
+    def hashing_reader(self, file_or_wfs, filename):
+        '''
+        Wrap a file-like object or a `werkzeug.FileStorage`
+        to compute checksum, size and mime type while it's read.
+        '''
+        return hashing.HashingReader(file_or_wfs, self.checksum_algorithm, filename)
+
+    def ensure_absent(self, filename):
+        '''
+        Raise :exc:`~flask_fs.errors.FileExists` if the file already exists.
+
+        This is a non-atomic fallback for backends without an exclusive create primitive.
+        Backends should perform the check in the same operation as the write when possible.
+        '''
+        if self.exists(filename):
+            raise FileExists(filename)
+
+    @client_property
+    def executor(self):
+        '''The thread pool running this backend batch operations (rebuilt after fork)'''
+        return batch.executor(self.batch_workers)
+
+    def fan_out(self, func, items, key=None):
+        '''
+        Call `func` on each item over the backend thread pool (see :func:`~flask_fs.batch.fan_out`).
+
+        :rtype: ~flask_fs.batch.BatchResult
+        '''
+        return batch.fan_out(func, items, self.batch_workers, key=key, executor=self.executor)
+
+    def exists_many(self, filenames):
+        '''
+        Test wether multiple files exist or not.
+
+        Default implementation calls :meth:`exists` concurrently.
+        Backends should overwrite it if there is a better way.
+
+        :rtype: ~flask_fs.batch.BatchResult
+        '''
+        return self.fan_out(self.exists, filenames)
+
+    def read_many(self, filenames):
+        '''
+        Read multiple files content.
+
+        Default implementation calls :meth:`read` concurrently.
+        Backends should overwrite it if there is a better way.
+
+        :rtype: ~flask_fs.batch.BatchResult
+        '''
+        return self.fan_out(self.read, filenames)
+
+    def delete_many(self, filenames):
         '''
-        self.write(filename, file_or_wfs.read())
-        return filename
+        Delete multiple files.
+
+        Default implementation calls :meth:`delete` concurrently.
+        Backends should overwrite it if there is a better way.
+
+        :rtype: ~flask_fs.batch.BatchResult
+        '''
+        return self.fan_out(self.delete, filenames)
 
     def metadata(self, filename):
         '''
@@ -85,8 +371,74 @@ class BaseBackend(object):
         raise NotImplementedError('Copy operation is not implemented')
 
     def serve(self, filename):
-        '''Serve a file given its filename'''
-        raise NotImplementedError('serve operation is not implemented')
+        '''
+        Serve a file given its filename
+
+        Conditional requests (``If-None-Match``, ``If-Modified-Since``) and byte ranges
+        are answered for the current request.
+
+        Default implementation takes validators, size and mime type from metadata
+        and streams the file opened in binary mode by chunks of `serve_chunk_size` bytes.
+        Backends should overwrite it if there is a better way.
+
+        :raises FileNotFound: when the file does not exists
+        '''
+        metadata = self.metadata(filename)
+        mime = metadata.get('mime') or files.mime(filename, self.DEFAULT_MIME)
+
+        def generate():
+            with self.open(filename, 'rb') as f:
+                for chunk in streams.chunks(f, self.serve_chunk_size):
+                    yield chunk
+
+        return responses.conditional(
+            self, filename, mime, metadata.get('size'),
+            etag=responses.etag(metadata.get('checksum')),
+            last_modified=metadata.get('modified'),
+            full=lambda: self.stream_response(generate(), mime, metadata.get('size')),
+        )
+
+    def signed_url(self, filename, expires=None):
+        '''
+        Get a short-lived URL giving a temporary read access to a file.
+
+        Signed URLs are cached by file and validity and reused until shortly before they expire.
+
+        :param int expires: The URL validity in seconds (default to `signed_url_expires`)
+        :raises OperationNotSupported: when the backend can't sign URLs
+        '''
+        expires = expires or self.signed_url_expires
+        key = (filename, expires)
+        now = cache.clock()
+        cached = self.signed_urls.get(key)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+        url = self.sign_url(filename, expires)
+        renew_at = now + expires - min(SIGNED_URL_MARGIN, expires / 2)
+        self.signed_urls.set(key, (renew_at, url))
+        return url
+
+    def sign_url(self, filename, expires):
+        '''Backend specific method to sign a temporary read URL valid for `expires` seconds'''
+        raise OperationNotSupported(
+            'URL signing is not supported by ' + self.__class__.__name__
+        )
+
+    def is_head_request(self):
+        '''Whether serving a HEAD request: the file content should not be fetched'''
+        return has_request_context() and request.method == 'HEAD'
+
+    def stream_response(self, chunks, mime, size=None):
+        '''
+        Build a streamed response from an iterable of binary chunks.
+
+        Only one chunk is held in memory at a time.
+        The iterable is closed with the response if it has a `close` method.
+        '''
+        response = Response(chunks, mimetype=mime, direct_passthrough=True)
+        if size is not None:
+            response.content_length = size
+        return response
 
     def as_binary(self, content, encoding='utf8'):
         '''Perform content encoding for binary write'''
@@ -94,5 +446,7 @@ class BaseBackend(object):
             return content.read()
         elif isinstance(content, six.text_type):
             return content.encode(encoding)
+        elif isinstance(content, (bytearray, memoryview)):
+            return streams.to_bytes(content)
         else:
             return content
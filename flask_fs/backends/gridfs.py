@@ -2,20 +2,73 @@
 from __future__ import unicode_literals, absolute_import
 
 import codecs
-import io
 import logging
 import re
+import uuid
 
 from contextlib import contextmanager
 
-from flask import send_file
-from gridfs import GridFS
+from gridfs import GridFS, errors as gridfs_errors
 from pymongo import MongoClient
+from pymongo.errors import DuplicateKeyError
 
-from . import BaseBackend
+from flask_fs import batch, files, responses, streams
+from flask_fs.errors import FileExists, FileNotFound
+
+from . import BaseBackend, client_property
 
 log = logging.getLogger(__name__)
 
+# Maximum number of files removed by a single delete query
+DELETE_BATCH_SIZE = 1000
+
+
+class GridFsWriter(streams.PartWriter):
+    '''
+    Stream a file to GridFS: parts are written as they come to a GridFS file
+    which only becomes visible once complete.
+    '''
+    def __init__(self, backend, filename, overwrite=True, **kwargs):
+        super(GridFsWriter, self).__init__(backend.part_size, backend.checksum_algorithm)
+        self.backend = backend
+        self.filename = filename
+        self.overwrite = overwrite
+        # With a unique filename index, versioning is not possible:
+        # commit under a temporary name then replace the previous versions
+        self.replacing = overwrite and backend.has_unique_index()
+        if not overwrite:
+            backend.ensure_unique_index()
+            if not backend._unique_index:
+                backend.ensure_absent(filename)
+        name = backend.temporary_filename(filename) if self.replacing else filename
+        self.grid_in = backend.fs.new_file(filename=name, **kwargs)
+
+    def put(self, data):
+        try:
+            self.grid_in.write(data)
+            self.complete()
+        except Exception:
+            self.grid_in.abort()
+            raise
+
+    def upload_part(self, number, data):
+        self.grid_in.write(data)
+
+    def complete(self):
+        self.grid_in.metadata = {'checksum': self.checksum}
+        try:
+            self.grid_in.close()
+        except gridfs_errors.FileExists:
+            if self.overwrite:
+                # A unique filename index has been created since checked
+                self.backend._unique_index = True
+            raise FileExists(self.filename)
+        if self.replacing:
+            self.backend.replace(self.grid_in._id, self.filename)
+
+    def cancel(self):
+        self.grid_in.abort()
+
 
 class GridFsBackend(BaseBackend):
     '''
@@ -25,65 +78,251 @@ class GridFsBackend(BaseBackend):
 
     - `mongo_url`: The Mongo access URL
     - `mongo_db`: The database to store the file in.
+
+    The Mongo client is created on first operation.
     '''
+    exclusive_create = True
+    raises_not_found = True
+
     def __init__(self, name, config):
         super(GridFsBackend, self).__init__(name, config)
+        self._unique_index = None
+        self._unindexable = False
+
+    @client_property
+    def client(self):
+        return MongoClient(self.config.mongo_url)
+
+    @client_property
+    def db(self):
+        return self.client[self.config.mongo_db]
+
+    @client_property
+    def fs(self):
+        return GridFS(self.db, self.name)
 
-        self.client = MongoClient(config.mongo_url)
-        self.db = self.client[config.mongo_db]
-        self.fs = GridFS(self.db, self.name)
+    def warmup(self):
+        self.client.admin.command('ping')
 
     def exists(self, filename):
         return self.fs.exists(filename=filename)
 
+    def exists_many(self, filenames):
+        '''Test existence of all files in a single query'''
+        filenames = list(filenames)
+        query = {'filename': {'$in': filenames}}
+        found = set(self.db[self.name].files.distinct('filename', query))
+        return batch.BatchResult((filename, filename in found) for filename in filenames)
+
+    def get_last_version(self, filename):
+        '''
+        Fetch the last version of a file in a single query.
+
+        :raises FileNotFound: when the file does not exists
+        '''
+        try:
+            return self.fs.get_last_version(filename)
+        except gridfs_errors.NoFile:
+            raise FileNotFound(filename)
+
     @contextmanager
     def open(self, filename, mode='r', encoding='utf8'):
         if 'r' in mode:
-            f = self.fs.get_last_version(filename)
+            f = self.get_last_version(filename)
             yield f if 'b' in mode else codecs.getreader(encoding)(f)
         else:  # mode == 'w'
-            f = io.BytesIO() if 'b' in mode else io.StringIO()
-            yield f
-            params = {'filename': filename}
-            if 'b' not in mode:
-                params['encoding'] = encoding
-            self.fs.put(f.getvalue(), **params)
+            params = {} if 'b' in mode else {'encoding': encoding}
+            with streams.writer(GridFsWriter(self, filename, **params), mode, encoding) as f:
+                yield f
 
     def read(self, filename):
-        f = self.fs.get_last_version(filename)
+        f = self.get_last_version(filename)
         return f.read()
 
-    def write(self, filename, content):
-        kwargs = {
-            'filename': filename
-        }
+    def read_range(self, filename, start, end=None):
+        '''Only fetch the chunks holding the requested range'''
+        f = self.get_last_version(filename)
+        f.seek(start)
+        return f.read() if end is None else f.read(max(end - start, 0))
+
+    def open_seekable(self, filename):
+        '''GridFS files are seekable and only fetch the chunks being read'''
+        return self.get_last_version(filename)
+
+    def write(self, filename, content, overwrite=True):
+        kwargs = {}
 
         if hasattr(content, 'content_type') and content.content_type is not None:
             kwargs['content_type'] = content.content_type
 
-        return self.fs.put(self.as_binary(content), **kwargs)
+        if not streams.is_buffer(content):
+            writer = GridFsWriter(self, filename, overwrite, **kwargs)
+            return streams.copy(content, writer).grid_in._id
+
+        data = self.as_binary(content)
+        kwargs['metadata'] = {'checksum': self.compute_checksum(data)}
+        if overwrite:
+            return self._put_over(data, filename, **kwargs)
+
+        self.ensure_unique_index()
+        if not self._unique_index:
+            self.ensure_absent(filename)
+        return self._put(data, filename=filename, **kwargs)
+
+    def temporary_filename(self, filename):
+        '''A unique name to commit a new version under before it replaces the previous ones'''
+        return '{0}.{1}.tmp'.format(filename, uuid.uuid4().hex)
+
+    def replace(self, file_id, filename):
+        '''
+        Give a file committed under a temporary name its final `filename`
+        once the previous versions are deleted (a unique filename index is in place).
+        '''
+        while True:
+            for version in self.fs.find({'filename': filename}):
+                self.fs.delete(version._id)
+            try:
+                self.db[self.name].files.update_one({'_id': file_id},
+                                                    {'$set': {'filename': filename}})
+                return
+            except DuplicateKeyError:
+                # Another version has been committed concurrently: replace it too
+                continue
+
+    def ensure_unique_index(self):
+        '''
+        Ensure a unique index exists on `filename`,
+        allowing the files document insertion to act as an exclusive create.
+
+        Collections already holding multiple versions of a file can't be indexed:
+        existence is then checked before writing.
+        '''
+        if self._unique_index or self._unindexable:
+            return
+        try:
+            self.db[self.name].files.create_index('filename', unique=True)
+            self._unique_index = True
+        except DuplicateKeyError:
+            log.warning('Unable to create a unique filename index on GridFS "%s": '
+                        'exclusive create will not be atomic', self.name)
+            self._unique_index = False
+            self._unindexable = True
+
+    def has_unique_index(self):
+        '''Whether a unique index exists on `filename` (checked once)'''
+        if self._unique_index is None:
+            indexes = self.db[self.name].files.index_information()
+            self._unique_index = any(index.get('unique') and index['key'] == [('filename', 1)]
+                                     for index in indexes.values())
+        return self._unique_index
+
+    def _put_over(self, data, filename, **kwargs):
+        '''
+        Put some bytes or a file-like object over the existing versions of `filename`.
+
+        Versions are kept unless a unique filename index exists:
+        the previous versions are then replaced once the new one is committed.
+        '''
+        if not self.has_unique_index():
+            try:
+                return self._put(data, filename=filename, **kwargs)
+            except FileExists:
+                # A unique filename index has been created since checked
+                self._unique_index = True
+                if hasattr(data, 'seek'):
+                    data.seek(0)
+        file_id = self._put(data, filename=self.temporary_filename(filename), **kwargs)
+        self.replace(file_id, filename)
+        return file_id
+
+    def _put(self, data, **kwargs):
+        grid_in = self.fs.new_file(**kwargs)
+        try:
+            grid_in.write(data)
+            grid_in.close()
+        except (DuplicateKeyError, gridfs_errors.FileExists):
+            grid_in.abort()
+            raise FileExists(kwargs['filename'])
+        return grid_in._id
 
     def delete(self, filename):
-        regex = '^{0}'.format(re.escape(filename))
-        for version in self.fs.find({'filename': {'$regex': regex}}):
-            self.fs.delete(version._id)
+        result = self.delete_many([filename])
+        if not result.ok:
+            raise result.errors[filename]
+
+    def delete_many(self, filenames):
+        '''
+        Delete all versions of multiple files (and "directories")
+        with batched queries on the files and chunks collections.
+
+        A filename matches its exact name and all files under ``filename/``.
+        '''
+        filenames = list(filenames)
+        result = batch.BatchResult((filename, None) for filename in filenames)
+        if not filenames:
+            return result
+        prefixes = [filename.rstrip('/') + '/' for filename in filenames]
+        regex = '^(?:{0})'.format('|'.join(re.escape(p) for p in prefixes))
+        query = {'$or': [{'filename': {'$in': filenames}}, {'filename': {'$regex': regex}}]}
+        collection = self.db[self.name]
+        docs = list(collection.files.find(query, {'_id': True, 'filename': True}))
+
+        def owner(name):
+            if name in result:
+                return name
+            return next(f for f, p in zip(filenames, prefixes) if name.startswith(p))
+
+        for i in range(0, len(docs), DELETE_BATCH_SIZE):
+            chunk = docs[i:i + DELETE_BATCH_SIZE]
+            ids = [doc['_id'] for doc in chunk]
+            try:
+                collection.files.delete_many({'_id': {'$in': ids}})
+                collection.chunks.delete_many({'files_id': {'$in': ids}})
+            except Exception as e:
+                for doc in chunk:
+                    result.errors.setdefault(owner(doc['filename']), e)
+        for filename in result.errors:
+            result.pop(filename, None)
+        return result
 
     def copy(self, filename, target):
-        src = self.fs.get_last_version(filename)
-        self.fs.put(src, filename=target, content_type=src.content_type)
+        src = self.get_last_version(filename)
+        self._put_over(src, target, content_type=src.content_type, metadata=src.metadata)
 
     def list_files(self):
         for f in self.fs.list():
             yield f
 
     def serve(self, filename):
-        file = self.fs.get_last_version(filename)
-        return send_file(file, mimetype=file.content_type)
+        '''
+        Stream the file chunks as they are fetched,
+        validators being taken from the fetched file document.
+        '''
+        f = self.get_last_version(filename)
+        mime = f.content_type or files.mime(filename, self.DEFAULT_MIME)
+
+        def full():
+            chunks = streams.closing(streams.chunks(f, self.serve_chunk_size), f.close)
+            return self.stream_response(chunks, mime, f.length)
+
+        response = responses.conditional(self, filename, mime, f.length,
+                                         etag=responses.etag(self.file_checksum(f)),
+                                         last_modified=f.upload_date, full=full)
+        if response.status_code != 200:
+            f.close()
+        return response
+
+    def file_checksum(self, f):
+        checksum = (f.metadata or {}).get('checksum')
+        if not checksum and f.md5:
+            # Legacy files, GridFS md5 is deprecated
+            checksum = 'md5:{0}'.format(f.md5)
+        return checksum
 
     def get_metadata(self, filename):
-        f = self.fs.get_last_version(filename)
+        f = self.get_last_version(filename)
         return {
-            'checksum': 'md5:{0}'.format(f.md5),
+            'checksum': self.file_checksum(f),
             'size': f.length,
             'mime': f.content_type,
             'modified': f.upload_date,
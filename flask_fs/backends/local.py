@@ -2,7 +2,6 @@
 from __future__ import unicode_literals
 
 import errno
-import hashlib
 import io
 import logging
 import os
@@ -10,29 +9,43 @@ import shutil
 
 from datetime import datetime
 
-from flask import current_app, send_from_directory
+from flask import current_app, has_request_context, request, safe_join, Response
 from werkzeug import cached_property
-from werkzeug.datastructures import FileStorage
+from werkzeug.urls import url_quote
+from werkzeug.wsgi import wrap_file
 
-from flask_fs import files
+from flask_fs import files, hashing, responses, streams
+from flask_fs.errors import FileExists, FileNotFound
 
 from . import BaseBackend
 
 log = logging.getLogger(__name__)
 
 
-CHUNK_SIZE = 2 ** 16
+#: Extended attribute used to persist a file checksum alongside its stat signature
+XATTR_CHECKSUM = 'user.flask_fs.checksum'
 
+#: Headers delegating the file transfer to a front server given the `sendfile` setting
+SENDFILE_HEADERS = {
+    'x-sendfile': 'X-Sendfile',
+    'x-accel-redirect': 'X-Accel-Redirect',
+}
 
-def sha1(file):
-    hasher = hashlib.sha1()
-    blk_size_to_read = hasher.block_size * CHUNK_SIZE
-    while (True):
-        read_data = file.read(blk_size_to_read)
-        if not read_data:
-            break
-        hasher.update(read_data)
-    return hasher.hexdigest()
+
+def stat_signature(stat):
+    '''
+    Compute a file signature from its stat result.
+
+    Any content modification changes at least one of the inode, the size or the mtime.
+    '''
+    mtime_ns = getattr(stat, 'st_mtime_ns', None) or int(stat.st_mtime * 1e9)
+    return '{0}:{1}:{2}'.format(stat.st_ino, stat.st_size, mtime_ns)
+
+
+def weak_etag(stat):
+    '''A weak entity tag from a file stat result modification time and size'''
+    mtime_ns = getattr(stat, 'st_mtime_ns', None) or int(stat.st_mtime * 1e9)
+    return '{0:x}-{1:x}'.format(mtime_ns, stat.st_size)
 
 
 class LocalBackend(BaseBackend):
@@ -42,7 +55,32 @@ class LocalBackend(BaseBackend):
     Expect the following settings:
 
     - `root`: The file system root
+
+    And the following optional settings:
+
+    - `sendfile`: Delegate served files transfer to the front server,
+      either with ``x-sendfile`` (Apache, lighttpd) or ``x-accel-redirect`` (nginx)
+    - `sendfile_location`: The location files are exposed on by the front server
+      (default to the root for ``x-sendfile`` and to ``/<name>/`` for ``x-accel-redirect``)
     '''
+    exclusive_create = True
+    raises_not_found = True
+
+    def __init__(self, name, config):
+        super(LocalBackend, self).__init__(name, config)
+        self.sendfile = config.get('sendfile')
+        if self.sendfile and self.sendfile not in SENDFILE_HEADERS:
+            raise ValueError('Unsupported sendfile mode "{0}"'.format(self.sendfile))
+
+    @cached_property
+    def sendfile_location(self):
+        location = self.config.get('sendfile_location')
+        if location:
+            return location
+        elif self.sendfile == 'x-accel-redirect':
+            return '/{0}/'.format(self.name)
+        return self.root
+
     @cached_property
     def root(self):
         return self.config.get('root') or os.path.join(self.default_root, self.name)
@@ -71,19 +109,65 @@ class LocalBackend(BaseBackend):
         dest = self.path(filename)
         if 'w' in mode:
             self.ensure_path(filename)
-        if 'b' in mode:
-            return open(dest, mode)
-        else:
-            return io.open(dest, mode, encoding=encoding)
+        try:
+            if 'b' in mode:
+                return open(dest, mode)
+            else:
+                return io.open(dest, mode, encoding=encoding)
+        except (IOError, OSError) as e:
+            if e.errno == errno.ENOENT and 'r' in mode:
+                raise FileNotFound(filename)
+            raise
 
     def read(self, filename):
         with self.open(filename, 'rb') as f:
             return f.read()
 
-    def write(self, filename, content):
+    def read_range(self, filename, start, end=None):
+        with self.open(filename, 'rb') as f:
+            size = (os.fstat(f.fileno()).st_size if end is None else end) - start
+            if size <= 0:
+                return b''
+            if hasattr(os, 'pread'):
+                return os.pread(f.fileno(), size, start)
+            f.seek(start)
+            return f.read(size)
+
+    def open_seekable(self, filename):
+        return self.open(filename, 'rb')
+
+    def open_for_write(self, filename, overwrite=True):
+        '''
+        Open a file for binary writing.
+
+        When `overwrite` is `False`, the file is created with ``O_EXCL``
+        so the existence check and the creation are a single atomic operation.
+
+        :raises FileExists: when file exists and overwrite is `False`
+        '''
         self.ensure_path(filename)
-        with self.open(filename, 'wb') as f:
-            return f.write(self.as_binary(content))
+        dest = self.path(filename)
+        if overwrite:
+            return open(dest, 'wb')
+        flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0)
+        try:
+            fd = os.open(dest, flags, 0o666)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                raise FileExists(filename)
+            raise
+        return io.open(fd, 'wb')
+
+    def write(self, filename, content, overwrite=True):
+        hasher = hashing.new(self.checksum_algorithm)
+        size = 0
+        with self.open_for_write(filename, overwrite) as f:
+            for chunk in streams.chunks(content):
+                hasher.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+        self.store_checksum(filename, '{0}:{1}'.format(self.checksum_algorithm, hasher.hexdigest()))
+        return size
 
     def delete(self, filename):
         dest = os.path.join(self.root, filename)
@@ -92,16 +176,12 @@ class LocalBackend(BaseBackend):
         else:
             os.remove(dest)
 
-    def save(self, file_or_wfs, filename):
-        self.ensure_path(filename)
-        dest = self.path(filename)
-
-        if isinstance(file_or_wfs, FileStorage):
-            file_or_wfs.save(dest)
-        else:
-            with open(dest, 'wb') as out:
-                shutil.copyfileobj(file_or_wfs, out)
-        return filename
+    def save(self, file_or_wfs, filename, overwrite=True):
+        reader = self.hashing_reader(file_or_wfs, filename)
+        with self.open_for_write(filename, overwrite) as out:
+            shutil.copyfileobj(reader, out)
+        self.store_checksum(filename, reader.checksum)
+        return reader.saved(filename)
 
     def copy(self, filename, target):
         src = self.path(filename)
@@ -126,17 +206,103 @@ class LocalBackend(BaseBackend):
         return os.path.join(self.root, filename)
 
     def serve(self, filename):
-        '''Serve files for storages with direct file access'''
-        return send_from_directory(self.root, filename)
+        '''
+        Serve files for storages with direct file access.
+
+        Validators are taken from a single `stat`:
+        a weak ``ETag`` from the modification time and the size and ``Last-Modified``.
+
+        With `sendfile` set, only headers are emitted
+        and the front server sends the file content,
+        answering conditional and range requests itself.
+        '''
+        path = safe_join(self.root, filename)
+        try:
+            stat = os.stat(path)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                raise FileNotFound(filename)
+            raise
+        mime = files.mime(filename, self.DEFAULT_MIME)
+        if self.sendfile:
+            return self.sendfile_response(filename, mime, stat)
+
+        def full():
+            environ = request.environ if has_request_context() else {}
+            chunks = wrap_file(environ, open(path, 'rb'), self.serve_chunk_size)
+            return self.stream_response(chunks, mime, stat.st_size)
+
+        return responses.conditional(self, filename, mime, stat.st_size,
+                                     etag=weak_etag(stat), weak=True,
+                                     last_modified=datetime.utcfromtimestamp(stat.st_mtime),
+                                     full=full)
+
+    def sendfile_response(self, filename, mime, stat):
+        '''A response delegating the file transfer to the front server'''
+        if self.sendfile == 'x-accel-redirect':
+            location = '/'.join((self.sendfile_location.rstrip('/'), url_quote(filename)))
+        else:
+            location = os.path.join(self.sendfile_location, filename)
+        response = Response(mimetype=mime, direct_passthrough=True)
+        response.headers[SENDFILE_HEADERS[self.sendfile]] = location
+        response.content_length = stat.st_size
+        return response
 
     def get_metadata(self, filename):
         '''Fetch all available metadata'''
         dest = self.path(filename)
-        with open(dest, 'rb', buffering=0) as f:
-            checksum = 'sha1:{0}'.format(sha1(f))
+        try:
+            stat = os.stat(dest)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                raise FileNotFound(filename)
+            raise
         return {
-            'checksum': checksum,
-            'size': os.path.getsize(dest),
+            'checksum': self.checksum(filename, stat),
+            'size': stat.st_size,
             'mime': files.mime(filename),
-            'modified': datetime.fromtimestamp(os.path.getmtime(dest)),
+            'modified': datetime.fromtimestamp(stat.st_mtime),
         }
+
+    def checksum(self, filename, stat=None):
+        '''
+        Get a file checksum expressed in the form `algo:hash`.
+
+        The checksum is persisted in an extended attribute
+        and the file is only hashed again when its stat signature changes.
+        '''
+        dest = self.path(filename)
+        stat = stat or os.stat(dest)
+        signature = stat_signature(stat)
+        algorithm = self.checksum_algorithm
+        stored = self.read_xattr(dest)
+        if stored:
+            stored_signature, _, checksum = stored.partition(' ')
+            if stored_signature == signature and checksum.startswith(algorithm + ':'):
+                return checksum
+        with open(dest, 'rb', buffering=0) as f:
+            checksum = '{0}:{1}'.format(algorithm, hashing.hash_file(f, algorithm))
+        self.write_xattr(dest, ' '.join((signature, checksum)))
+        return checksum
+
+    def store_checksum(self, filename, checksum):
+        '''Persist a checksum computed at write time for the current file state'''
+        dest = self.path(filename)
+        self.write_xattr(dest, ' '.join((stat_signature(os.stat(dest)), checksum)))
+
+    def read_xattr(self, dest):
+        if not hasattr(os, 'getxattr'):
+            return None
+        try:
+            return os.getxattr(dest, XATTR_CHECKSUM).decode('ascii')
+        except (IOError, OSError):
+            return None
+
+    def write_xattr(self, dest, value):
+        if not hasattr(os, 'setxattr'):
+            return
+        try:
+            os.setxattr(dest, XATTR_CHECKSUM, value.encode('ascii'))
+        except (IOError, OSError) as e:
+            # Extended attributes are not supported by every file system
+            log.debug('Unable to persist checksum for %s: %s', dest, e)
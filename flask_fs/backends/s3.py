@@ -2,19 +2,128 @@
 from __future__ import unicode_literals
 
 import codecs
-import io
 import logging
 
+from collections import OrderedDict
 from contextlib import contextmanager
 
 import boto3
 
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError
+from flask import redirect
 
-from . import BaseBackend
+from flask_fs import batch, files, responses, streams
+from flask_fs.errors import FileExists, FileNotFound, FSError
+
+from . import BaseBackend, current_pid, thread_client_property
 
 log = logging.getLogger(__name__)
 
+# Error codes returned by S3 when a conditional write is rejected
+CONFLICT_CODES = ('PreconditionFailed', 'ConditionalRequestConflict', '412', '409')
+
+# Error codes returned by S3 when a key does not exists
+NOT_FOUND_CODES = ('NoSuchKey', '404')
+
+# Content type given by S3 to objects uploaded without one
+S3_DEFAULT_MIME = 'binary/octet-stream'
+
+# Error codes returned by S3 when a range starts after the end of an object
+RANGE_NOT_SATISFIABLE_CODES = ('InvalidRange', '416')
+
+# Optional settings given to the botocore client configuration
+CLIENT_SETTINGS = ('max_pool_connections', 'tcp_keepalive', 'connect_timeout', 'read_timeout')
+
+# Optional settings given to the transfer configuration
+TRANSFER_SETTINGS = ('multipart_threshold', 'multipart_chunksize', 'max_concurrency')
+
+# Maximum number of keys accepted by a single DeleteObjects request
+DELETE_BATCH_SIZE = 1000
+
+# Tag storing the checksum of objects uploaded by parts
+CHECKSUM_TAG = 'checksum'
+
+# Client parameter requesting a conditional write, sent as an `If-None-Match: *` header
+# (botocore only models `IfNoneMatch` on writes since 1.35, which requires Python 3.8)
+IF_ABSENT = 'FlaskFsIfAbsent'
+
+# Operations accepting the `IF_ABSENT` parameter
+CONDITIONAL_WRITES = ('PutObject', 'CompleteMultipartUpload')
+
+# Request headers forwarded to S3 when serving a file, by GetObject parameter
+SERVE_CONDITIONS = {
+    'If-None-Match': 'IfNoneMatch',
+    'If-Modified-Since': 'IfModifiedSince',
+    'If-Match': 'IfMatch',
+    'Range': 'Range',
+}
+
+
+def pop_if_absent(params, context, **kwargs):
+    '''Move the `IF_ABSENT` parameter into the request context before validation'''
+    if params.pop(IF_ABSENT, False):
+        context[IF_ABSENT] = True
+
+
+def add_if_absent(params, context, **kwargs):
+    '''Turn the `IF_ABSENT` request context flag into an `If-None-Match: *` header'''
+    if context.get(IF_ABSENT):
+        params['headers']['If-None-Match'] = '*'
+
+
+class S3Writer(streams.PartWriter):
+    '''
+    Stream a file to S3 using a multipart upload, parts being uploaded concurrently.
+
+    Files smaller than the multipart threshold are uploaded with a single PUT.
+    '''
+    def __init__(self, backend, filename, overwrite=True):
+        transfer = backend.transfer_config
+        super(S3Writer, self).__init__(transfer.multipart_chunksize, backend.checksum_algorithm,
+                                       threshold=transfer.multipart_threshold,
+                                       max_concurrency=transfer.max_concurrency)
+        self.backend = backend
+        self.filename = filename
+        self.overwrite = overwrite
+        self.client = backend.bucket.meta.client
+        self.upload_id = None
+        self.uploaded = []
+
+    def put(self, data):
+        self.backend.write(self.filename, data, overwrite=self.overwrite)
+
+    def start(self):
+        response = self.client.create_multipart_upload(Bucket=self.backend.name, Key=self.filename)
+        self.upload_id = response['UploadId']
+
+    def upload_part(self, number, data):
+        response = self.client.upload_part(Bucket=self.backend.name, Key=self.filename,
+                                           UploadId=self.upload_id, PartNumber=number, Body=data)
+        self.uploaded.append({'ETag': response['ETag'], 'PartNumber': number})
+
+    def complete(self):
+        kwargs = {} if self.overwrite else {IF_ABSENT: True}
+        parts = sorted(self.uploaded, key=lambda part: part['PartNumber'])
+        try:
+            self.client.complete_multipart_upload(Bucket=self.backend.name, Key=self.filename,
+                                                  UploadId=self.upload_id,
+                                                  MultipartUpload={'Parts': parts},
+                                                  **kwargs)
+        except ClientError as e:
+            if e.response['Error']['Code'] in CONFLICT_CODES:
+                raise FileExists(self.filename)
+            raise
+        # Multipart uploads metadata are set on creation, before the checksum is known:
+        # store it as a tag (no data copy)
+        self.client.put_object_tagging(Bucket=self.backend.name, Key=self.filename, Tagging={
+            'TagSet': [{'Key': CHECKSUM_TAG, 'Value': self.checksum}]
+        })
+
+    def cancel(self):
+        self.client.abort_multipart_upload(Bucket=self.backend.name, Key=self.filename,
+                                           UploadId=self.upload_id)
+
 
 class S3Backend(BaseBackend):
     '''
@@ -26,25 +135,72 @@ class S3Backend(BaseBackend):
     - `region`: The region to work on.
     - `access_key`: The AWS credential access key
     - `secret_key`: The AWS credential secret key
+
+    And the following optional settings:
+
+    - `max_pool_connections`: The maximum number of connections kept in each thread pool
+    - `tcp_keepalive`: Whether to use TCP keep-alive
+    - `connect_timeout`: The connection timeout in seconds
+    - `read_timeout`: The read timeout in seconds
+    - `multipart_threshold`: The size from which files are uploaded by parts
+      (default to the `part_size` setting)
+    - `multipart_chunksize`: The size of each part (default to the `part_size` setting)
+    - `max_concurrency`: The maximum number of parts uploaded or downloaded concurrently
+    - `redirect`: Serve files with a redirection to a presigned URL
+      valid for `signed_url_expires` seconds instead of streaming them
+
+    The client is created and the bucket ensured on first operation.
+    As boto3 sessions and resources are not thread-safe, each thread has its own.
     '''
+    exclusive_create = True
+    raises_not_found = True
+
     def __init__(self, name, config):
         super(S3Backend, self).__init__(name, config)
+        params = dict((key, config[key]) for key in CLIENT_SETTINGS if config.get(key) is not None)
+        self.s3config = boto3.session.Config(signature_version='s3v4', **params)
+        params = {'multipart_threshold': self.part_size, 'multipart_chunksize': self.part_size}
+        params.update((key, config[key])
+                      for key in TRANSFER_SETTINGS if config.get(key) is not None)
+        self.transfer_config = TransferConfig(**params)
+        self.redirect = bool(config.get('redirect'))
+        self._bucket_pid = None
 
-        self.session = boto3.session.Session()
-        self.s3config = boto3.session.Config(signature_version='s3v4')
+    @thread_client_property
+    def session(self):
+        return boto3.session.Session()
 
-        self.s3 = self.session.resource('s3',
-                                        config=self.s3config,
-                                        endpoint_url=config.endpoint,
-                                        region_name=config.region,
-                                        aws_access_key_id=config.access_key,
-                                        aws_secret_access_key=config.secret_key)
-        self.bucket = self.s3.Bucket(name)
+    @thread_client_property
+    def s3(self):
+        s3 = self.session.resource('s3',
+                                   config=self.s3config,
+                                   endpoint_url=self.config.endpoint,
+                                   region_name=self.config.region,
+                                   aws_access_key_id=self.config.access_key,
+                                   aws_secret_access_key=self.config.secret_key)
+        events = s3.meta.client.meta.events
+        for operation in CONDITIONAL_WRITES:
+            events.register('provide-client-params.s3.{0}'.format(operation), pop_if_absent)
+            events.register('before-call.s3.{0}'.format(operation), add_if_absent)
+        return s3
 
+    @thread_client_property
+    def bucket(self):
+        self.ensure_bucket()
+        return self.s3.Bucket(self.name)
+
+    def ensure_bucket(self):
+        '''Create the bucket if needed, once per process'''
+        if self._bucket_pid == current_pid():
+            return
         try:
-            self.bucket.create()
+            self.s3.Bucket(self.name).create()
         except self.s3.meta.client.exceptions.BucketAlreadyOwnedByYou:
             pass
+        self._bucket_pid = current_pid()
+
+    def warmup(self):
+        self.bucket
 
     def exists(self, filename):
         try:
@@ -53,27 +209,153 @@ class S3Backend(BaseBackend):
             return False
         return True
 
+    def get_object(self, filename, head=False, **kwargs):
+        '''
+        Fetch an object (metadata and streaming body) in a single request.
+
+        :param bool head: Only fetch the metadata (HeadObject)
+        :raises FileNotFound: when the key does not exists
+        '''
+        try:
+            if head:
+                return self.bucket.meta.client.head_object(Bucket=self.name, Key=filename,
+                                                           **kwargs)
+            return self.bucket.Object(filename).get(**kwargs)
+        except ClientError as e:
+            if e.response['Error']['Code'] in NOT_FOUND_CODES:
+                raise FileNotFound(filename)
+            raise
+
     @contextmanager
     def open(self, filename, mode='r', encoding='utf8'):
-        obj = self.bucket.Object(filename)
         if 'r' in mode:
-            f = obj.get()['Body']
+            f = self.get_object(filename)['Body']
             yield f if 'b' in mode else codecs.getreader(encoding)(f)
         else:  # mode == 'w'
-            f = io.BytesIO() if 'b' in mode else io.StringIO()
-            yield f
-            obj.put(Body=f.getvalue())
+            with streams.writer(S3Writer(self, filename), mode, encoding) as f:
+                yield f
 
     def read(self, filename):
-        obj = self.bucket.Object(filename).get()
-        return obj['Body'].read()
+        return self.get_object(filename)['Body'].read()
 
-    def write(self, filename, content):
-        return self.bucket.put_object(Key=filename, Body=self.as_binary(content))
+    def read_range(self, filename, start, end=None):
+        if end is not None and end <= start:
+            return b''
+        byte_range = 'bytes={0}-{1}'.format(start, '' if end is None else end - 1)
+        try:
+            response = self.bucket.Object(filename).get(Range=byte_range)
+        except ClientError as e:
+            code = e.response['Error']['Code']
+            if code in NOT_FOUND_CODES:
+                raise FileNotFound(filename)
+            elif code in RANGE_NOT_SATISFIABLE_CODES:
+                return b''
+            raise
+        return response['Body'].read()
+
+    def iter_range(self, filename, start, end):
+        '''Stream a range of the object body with a single ranged request'''
+        if end <= start:
+            return iter(())
+        body = self.get_object(filename, Range='bytes={0}-{1}'.format(start, end - 1))['Body']
+        return streams.closing(body.iter_chunks(self.serve_chunk_size), body.close)
+
+    def download(self, filename, fileobj):
+        '''
+        Download with a boto3 managed transfer: objects larger than
+        the multipart threshold are fetched with concurrent ranged requests.
+        '''
+        try:
+            self.bucket.meta.client.download_fileobj(self.name, filename, fileobj,
+                                                     Config=self.transfer_config)
+        except ClientError as e:
+            if e.response['Error']['Code'] in NOT_FOUND_CODES:
+                raise FileNotFound(filename)
+            raise
+
+    def write(self, filename, content, overwrite=True):
+        if not streams.is_buffer(content):
+            # Files smaller than a part are still uploaded with a single PUT
+            streams.copy(content, S3Writer(self, filename, overwrite))
+            return
+        data = self.as_binary(content)
+        kwargs = {
+            'Key': filename,
+            'Body': data,
+            # Stored as x-amz-meta-checksum
+            'Metadata': {'checksum': self.compute_checksum(data)},
+        }
+        if not overwrite:
+            # Conditional write: S3 rejects the PUT if the key already exists
+            kwargs[IF_ABSENT] = True
+        try:
+            return self.bucket.put_object(**kwargs)
+        except ClientError as e:
+            if e.response['Error']['Code'] in CONFLICT_CODES:
+                raise FileExists(filename)
+            raise
 
     def delete(self, filename):
-        for obj in self.bucket.objects.filter(Prefix=filename):
-            obj.delete()
+        result = self.delete_many([filename])
+        if not result.ok:
+            raise result.errors[filename]
+
+    def delete_many(self, filenames):
+        '''
+        Delete multiple files (and "directories") using bulk DeleteObjects requests.
+
+        A filename matches its exact key and all keys under ``filename/``.
+        Keys are deleted by chunks of 1000, chunks being sent concurrently.
+        '''
+        filenames = list(filenames)
+        # boto3 clients are thread-safe, resources are not
+        client = self.bucket.meta.client
+        result = batch.BatchResult((filename, None) for filename in filenames)
+
+        listing = self.fan_out(lambda f: self.list_keys(client, f), filenames)
+        result.errors.update(listing.errors)
+        owners = OrderedDict()
+        for filename, keys in listing.items():
+            for key in keys:
+                owners.setdefault(key, filename)
+
+        keys = list(owners)
+        chunks = [keys[i:i + DELETE_BATCH_SIZE] for i in range(0, len(keys), DELETE_BATCH_SIZE)]
+        deletions = self.fan_out(lambda i: self.delete_keys(client, chunks[i]), range(len(chunks)))
+        for i, error in deletions.errors.items():
+            for key in chunks[i]:
+                result.errors.setdefault(owners[key], error)
+        for failures in deletions.values():
+            for key, message in failures.items():
+                error = FSError('Unable to delete "{0}": {1}'.format(key, message))
+                result.errors.setdefault(owners[key], error)
+
+        for filename in result.errors:
+            result.pop(filename, None)
+        return result
+
+    def list_keys(self, client, filename):
+        '''List the exact key and the keys under ``filename/`` matching a filename'''
+        keys = [filename]
+        prefix = filename.rstrip('/') + '/'
+        paginator = client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.name, Prefix=prefix):
+            keys.extend(obj['Key'] for obj in page.get('Contents', []))
+        return keys
+
+    def delete_keys(self, client, keys):
+        '''
+        Delete up to 1000 keys in a single request.
+
+        :returns: the error message for each key S3 failed to delete
+        :rtype: dict
+        '''
+        response = client.delete_objects(Bucket=self.name, Delete={
+            'Objects': [{'Key': key} for key in keys],
+            'Quiet': True,
+        })
+        return dict((e['Key'], e.get('Message') or e.get('Code'))
+                    for e in response.get('Errors', []))
 
     def copy(self, filename, target):
         src = {
@@ -86,10 +368,29 @@ class S3Backend(BaseBackend):
         for f in self.bucket.objects.all():
             yield f.key
 
+    def sign_url(self, filename, expires):
+        '''Presign a GET request locally (no request is sent to S3)'''
+        return self.s3.meta.client.generate_presigned_url(
+            'get_object', Params={'Bucket': self.name, 'Key': filename}, ExpiresIn=expires
+        )
+
     def get_metadata(self, filename):
         '''Fetch all availabe metadata'''
         obj = self.bucket.Object(filename)
-        checksum = 'md5:{0}'.format(obj.e_tag[1:-1])
+        try:
+            obj.load()
+        except ClientError as e:
+            if e.response['Error']['Code'] in NOT_FOUND_CODES:
+                raise FileNotFound(filename)
+            raise
+        checksum = obj.metadata.get('checksum')
+        if not checksum and '-' in obj.e_tag:
+            # Uploaded by parts: the checksum is stored as a tag
+            tags = self.bucket.meta.client.get_object_tagging(Bucket=self.name, Key=filename)
+            checksum = next((tag['Value'] for tag in tags.get('TagSet', [])
+                             if tag['Key'] == CHECKSUM_TAG), None)
+        # ETag is not an md5 for multipart uploads, only used for files without stored checksum
+        checksum = checksum or 'md5:{0}'.format(obj.e_tag[1:-1])
         mime = obj.content_type.split(';', 1)[0] if obj.content_type else None
         return {
             'checksum': checksum,
@@ -98,6 +399,47 @@ class S3Backend(BaseBackend):
             'modified': obj.last_modified,
         }
 
-    # def serve(self, filename):
-    #     file = self.fs.get_last_version(filename)
-    #     return send_file(file, mimetype=file.content_type)
+    def serve(self, filename):
+        '''
+        Stream the object body with a single request
+        or redirect to a presigned URL if `redirect` is set.
+
+        Conditional and range headers are forwarded so S3 answers them in the same request,
+        validators being the object ``ETag`` and ``Last-Modified``.
+        '''
+        if self.redirect:
+            return redirect(self.signed_url(filename))
+        conditions = dict((SERVE_CONDITIONS[name], value)
+                          for name, value in responses.forwarded_conditions().items())
+        return self.serve_object(filename, conditions)
+
+    def serve_object(self, filename, conditions):
+        head = self.is_head_request()
+        try:
+            obj = self.get_object(filename, head=head, **conditions)
+        except ClientError as e:
+            status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+            size = e.response.get('Error', {}).get('ActualObjectSize')
+            if status == 304:
+                headers = e.response['ResponseMetadata'].get('HTTPHeaders', {})
+                return responses.relayed(responses.not_modified(), headers.get('etag'),
+                                         headers.get('last-modified'))
+            elif status == 416 and size:
+                return responses.range_not_satisfiable(size)
+            elif status in (412, 416) and 'Range' in conditions:
+                # Outdated `If-Range` (forwarded as `If-Match`): serve the whole object
+                conditions = dict((key, value) for key, value in conditions.items()
+                                  if key not in ('Range', 'IfMatch'))
+                return self.serve_object(filename, conditions)
+            raise
+        mime = obj.get('ContentType')
+        if not mime or mime == S3_DEFAULT_MIME:
+            mime = files.mime(filename, self.DEFAULT_MIME)
+        if head:
+            chunks = ()
+        else:
+            chunks = streams.closing(obj['Body'].iter_chunks(self.serve_chunk_size),
+                                     obj['Body'].close)
+        response = self.stream_response(chunks, mime, obj.get('ContentLength'))
+        return responses.relayed(response, obj.get('ETag'), obj.get('LastModified'),
+                                 obj.get('ContentRange'))
@@ -1,18 +1,109 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import codecs
 import io
+import json
 import logging
+import re
+import threading
+import uuid
 
+from collections import OrderedDict
 from contextlib import contextmanager
 from dateutil import parser
 
+import six
 import swiftclient
 
-from . import BaseBackend
+from flask import redirect
+from six.moves.urllib.parse import quote, urlsplit
+from swiftclient.utils import generate_temp_url
+
+from flask_fs import batch, files, responses, streams
+from flask_fs.errors import FileExists, FileNotFound, FSError, OperationNotSupported
+
+from . import BaseBackend, current_pid, thread_client_property
 
 log = logging.getLogger(__name__)
 
+# Optional settings given to the Swift connection
+CONNECTION_SETTINGS = ('retries', 'timeout')
+
+# Default maximum number of ranges downloaded concurrently
+DEFAULT_CONCURRENCY = 10
+
+# Default maximum number of objects deleted by a bulk-delete request
+BULK_DELETE_SIZE = 10000
+
+# Digests supported by the TempURL middleware
+TEMP_URL_DIGESTS = ('sha1', 'sha256', 'sha512')
+
+# Segments names relative to their file: `{upload id}/{segment number}`
+SEGMENT_PATTERN = re.compile(r'^[0-9a-f]{32}/\d{8}$')
+
+
+class SwiftWriter(streams.PartWriter):
+    '''
+    Stream a file to Swift as segments assembled by a manifest:
+    a Static Large Object if the cluster supports it or a Dynamic Large Object otherwise.
+
+    Files smaller than a segment are uploaded with a single PUT.
+    Segments are stored in the ``{container}_segments`` container
+    and segments of the previous version (if it was a large object)
+    are deleted once the upload is complete.
+    '''
+    def __init__(self, backend, filename, overwrite=True):
+        super(SwiftWriter, self).__init__(backend.part_size, backend.checksum_algorithm)
+        self.backend = backend
+        self.filename = filename
+        self.overwrite = overwrite
+        self.prefix = '{0}/{1}/'.format(filename, uuid.uuid4().hex)
+        self.segments = []
+
+    def put(self, data):
+        self.backend.write(self.filename, data, overwrite=self.overwrite)
+
+    def upload_part(self, number, data):
+        conn = self.backend.conn
+        container = self.backend.segments_container
+        if number == 1:
+            conn.put_container(container)
+        name = '{0}{1:08d}'.format(self.prefix, number)
+        etag = conn.put_object(container, name, contents=data)
+        self.segments.append((name, etag, len(data)))
+
+    def complete(self):
+        conn = self.backend.conn
+        container = self.backend.segments_container
+        headers = {'X-Object-Meta-Checksum': self.checksum}
+        kwargs = {}
+        if not self.overwrite:
+            headers['If-None-Match'] = '*'
+        if 'slo' in self.backend.capabilities():
+            kwargs['contents'] = json.dumps([{
+                'path': '/'.join(('', container, name)),
+                'etag': etag,
+                'size_bytes': size,
+            } for name, etag, size in self.segments])
+            kwargs['query_string'] = 'multipart-manifest=put'
+        else:
+            headers['X-Object-Manifest'] = quote('/'.join((container, self.prefix)).encode('utf8'))
+            kwargs['contents'] = b''
+        replaces_manifest = self.overwrite and self.backend.is_manifest(self.filename)
+        try:
+            conn.put_object(self.backend.name, self.filename, headers=headers, **kwargs)
+        except swiftclient.ClientException as e:
+            if e.http_status == 412:
+                raise FileExists(self.filename)
+            raise
+        if replaces_manifest:
+            self.backend.remove(self.backend.previous_segments(self.filename, self.prefix))
+
+    def cancel(self):
+        container = self.backend.segments_container
+        self.backend.remove([(container, name) for name, _, _ in self.segments])
+
 
 class SwiftBackend(BaseBackend):
     '''
@@ -23,16 +114,66 @@ class SwiftBackend(BaseBackend):
     - `authurl`: The Swift Auth URL
     - `user`: The Swift user in
     - `key`: The user API Key
+
+    And the following optional settings:
+
+    - `retries`: The number of retries on failed requests
+    - `timeout`: The HTTP requests timeout in seconds
+    - `max_concurrency`: The maximum number of ranges downloaded concurrently
+    - `temp_url_key`: The account or container TempURL key used to sign URLs
+    - `temp_url_digest`: The TempURL signature digest, ``sha256`` (default), ``sha1`` or ``sha512``
+    - `storage_url`: The public storage URL of the account used in signed URLs
+      (default to the one given by authentication)
+    - `redirect`: Serve files with a redirection to a TempURL
+      valid for `signed_url_expires` seconds instead of streaming them
+
+    The connection is authenticated and the container ensured on first operation.
+    As Swift connections are not thread-safe, each thread has its own.
+    HTTP connections are kept alive and reused by each thread connection.
     '''
+    exclusive_create = True
+    raises_not_found = True
+
     def __init__(self, name, config):
         super(SwiftBackend, self).__init__(name, config)
+        self._container_pid = None
+        self._capabilities = None
+        self.max_concurrency = config.get('max_concurrency', DEFAULT_CONCURRENCY)
+        self.temp_url_key = config.get('temp_url_key')
+        self.temp_url_digest = config.get('temp_url_digest', 'sha256')
+        if self.temp_url_digest not in TEMP_URL_DIGESTS:
+            raise ValueError('Unsupported TempURL digest "{0}"'.format(self.temp_url_digest))
+        self.redirect = bool(config.get('redirect'))
 
-        self.conn = swiftclient.Connection(
-            user=config.user,
-            key=config.key,
-            authurl=config.authurl
+    @thread_client_property
+    def conn(self):
+        conn = self.connect(
+            user=self.config.user,
+            key=self.config.key,
+            authurl=self.config.authurl,
         )
-        self.conn.put_container(self.name)
+        self.ensure_container(conn)
+        return conn
+
+    def connect(self, **kwargs):
+        '''Create a new Swift connection with the configured settings'''
+        kwargs.update((key, self.config[key])
+                      for key in CONNECTION_SETTINGS if self.config.get(key) is not None)
+        return swiftclient.Connection(**kwargs)
+
+    def ensure_container(self, conn):
+        '''Create the container if needed, once per process'''
+        if self._container_pid != current_pid():
+            conn.put_container(self.name)
+            self._container_pid = current_pid()
+
+    @property
+    def segments_container(self):
+        '''The container storing the segments of files uploaded by parts'''
+        return '{0}_segments'.format(self.name)
+
+    def warmup(self):
+        self.conn
 
     def exists(self, filename):
         try:
@@ -44,27 +185,252 @@ class SwiftBackend(BaseBackend):
     @contextmanager
     def open(self, filename, mode='r', encoding='utf8'):
         if 'r' in mode:
-            obj = self.read(filename)
-            yield io.BytesIO(obj) if 'b' in mode else io.StringIO(obj.decode(encoding))
+            _, body = self.get_object(filename, streams.CHUNK_SIZE)
+            with io.BufferedReader(streams.IterReader(body)) as f:
+                yield f if 'b' in mode else codecs.getreader(encoding)(f)
         else:  # mode == 'w'
-            f = io.BytesIO() if 'b' in mode else io.StringIO()
-            yield f
-            self.write(filename, f.getvalue())
+            with streams.writer(SwiftWriter(self, filename), mode, encoding) as f:
+                yield f
+
+    def get_object(self, filename, chunk_size=None, **kwargs):
+        '''
+        Fetch an object headers and content (an iterable of chunks if `chunk_size` is given).
+
+        :raises FileNotFound: when the object does not exists
+        '''
+        try:
+            return self.conn.get_object(self.name, filename, resp_chunk_size=chunk_size, **kwargs)
+        except swiftclient.ClientException as e:
+            if e.http_status == 404:
+                raise FileNotFound(filename)
+            raise
 
     def read(self, filename):
-        _, data = self.conn.get_object(self.name, filename)
+        _, data = self.get_object(filename)
+        return data
+
+    def read_range(self, filename, start, end=None):
+        if end is not None and end <= start:
+            return b''
+        headers = {'Range': 'bytes={0}-{1}'.format(start, '' if end is None else end - 1)}
+        try:
+            _, data = self.conn.get_object(self.name, filename, headers=headers)
+        except swiftclient.ClientException as e:
+            if e.http_status == 404:
+                raise FileNotFound(filename)
+            elif e.http_status == 416:
+                return b''
+            raise
         return data
 
-    def write(self, filename, content):
-        self.conn.put_object(self.name, filename, contents=content)
+    def iter_range(self, filename, start, end):
+        '''Stream a range of the object content with a single ranged request'''
+        if end <= start:
+            return iter(())
+        headers = {'Range': 'bytes={0}-{1}'.format(start, end - 1)}
+        _, body = self.get_object(filename, self.serve_chunk_size, headers=headers)
+        return streams.closing(body, body.close)
+
+    def download(self, filename, fileobj):
+        '''
+        Download a file content into a binary file-like object.
+
+        Files larger than `part_size` are fetched with concurrent ranged requests
+        (given the target is seekable), each thread using its own connection
+        sharing the current authentication token.
+        '''
+        try:
+            headers = self.conn.head_object(self.name, filename)
+        except swiftclient.ClientException as e:
+            if e.http_status == 404:
+                raise FileNotFound(filename)
+            raise
+        size = int(headers['content-length'])
+        if size <= self.part_size or self.max_concurrency <= 1 or not streams.seekable(fileobj):
+            _, body = self.conn.get_object(self.name, filename,
+                                           resp_chunk_size=streams.CHUNK_SIZE)
+            for chunk in body:
+                fileobj.write(chunk)
+            return
+
+        url, token = self.conn.url, self.conn.token
+        offset = fileobj.tell()
+        local = threading.local()
+        lock = threading.Lock()
+
+        def fetch(start):
+            if not hasattr(local, 'conn'):
+                local.conn = self.connect(preauthurl=url, preauthtoken=token)
+            end = min(start + self.part_size, size) - 1
+            # Fail instead of mixing versions if the object is replaced meanwhile
+            range_headers = {'Range': 'bytes={0}-{1}'.format(start, end),
+                             'If-Match': headers['etag']}
+            _, data = local.conn.get_object(self.name, filename, headers=range_headers)
+            with lock:
+                fileobj.seek(offset + start)
+                fileobj.write(data)
+
+        result = batch.fan_out(fetch, range(0, size, self.part_size), self.max_concurrency)
+        if not result.ok:
+            raise next(iter(result.errors.values()))
+        fileobj.seek(offset + size)
+
+    def write(self, filename, content, overwrite=True):
+        if not streams.is_buffer(content):
+            # Files smaller than a segment are still uploaded with a single PUT
+            streams.copy(content, SwiftWriter(self, filename, overwrite))
+            return
+        data = self.as_binary(content)
+        headers = {'X-Object-Meta-Checksum': self.compute_checksum(data)}
+        if not overwrite:
+            # Swift rejects the PUT with a 412 if the object already exists
+            headers['If-None-Match'] = '*'
+        replaces_manifest = overwrite and self.is_manifest(filename)
+        try:
+            self.conn.put_object(self.name, filename, contents=data, headers=headers)
+        except swiftclient.ClientException as e:
+            if e.http_status == 412:
+                raise FileExists(filename)
+            raise
+        if replaces_manifest:
+            self.remove(self.previous_segments(filename))
+
+    def is_manifest(self, filename):
+        '''
+        Whether a file is a large object manifest (SLO or DLO)
+        whose segments need to be deleted once overwritten.
+        Only checked when overwriting: new files don't have any.
+        '''
+        try:
+            headers = self.conn.head_object(self.name, filename)
+        except swiftclient.ClientException as e:
+            if e.http_status == 404:
+                return False
+            raise
+        return ('x-object-manifest' in headers
+                or headers.get('x-static-large-object', '').lower() == 'true')
+
+    def previous_segments(self, filename, upload_prefix=None):
+        '''The segments of a file previous versions, excluding the upload in progress'''
+        container = self.segments_container
+        prefix = filename + '/'
+        return [(container, name) for name in self.list_prefix(container, prefix)
+                if SEGMENT_PATTERN.match(name[len(prefix):])
+                and not (upload_prefix and name.startswith(upload_prefix))]
 
     def delete(self, filename):
-        if self.exists(filename):
-            self.conn.delete_object(self.name, filename)
-        else:
-            headers, items = self.conn.get_container(self.name, path=filename)
-            for i in items:
-                self.conn.delete_object(self.name, i['name'])
+        result = self.delete_many([filename])
+        if not result.ok:
+            raise result.errors[filename]
+
+    def delete_many(self, filenames):
+        '''
+        Delete multiple files (and "directories") using the bulk-delete middleware if available.
+
+        A filename matches its exact object and all objects under ``filename/``.
+        Segments of files uploaded by parts are deleted too.
+        '''
+        filenames = list(filenames)
+        result = batch.BatchResult((filename, None) for filename in filenames)
+        owners = OrderedDict()
+        for filename in filenames:
+            owners.setdefault((self.name, filename), filename)
+            prefix = filename.rstrip('/') + '/'
+            for container in self.name, self.segments_container:
+                for name in self.list_prefix(container, prefix):
+                    owners.setdefault((container, name), filename)
+
+        failures = self.remove(list(owners))
+        for obj, error in failures.items():
+            result.errors.setdefault(owners[obj], error)
+        for filename in result.errors:
+            result.pop(filename, None)
+        return result
+
+    def list_prefix(self, container, prefix):
+        '''List all object names starting with `prefix` in a container (across all pages)'''
+        try:
+            _, items = self.conn.get_container(container, prefix=prefix, full_listing=True)
+        except swiftclient.ClientException as e:
+            if e.http_status == 404:
+                return []
+            raise
+        return [item['name'] for item in items]
+
+    def capabilities(self):
+        '''The cluster capabilities (fetched once)'''
+        if self._capabilities is None:
+            try:
+                self._capabilities = self.conn.get_capabilities()
+            except swiftclient.ClientException:
+                self._capabilities = {}
+        return self._capabilities
+
+    def remove(self, objects):
+        '''
+        Delete objects using bulk-delete requests if supported or one by one otherwise.
+
+        :param objects: A list of ``(container, name)`` tuples
+        :returns: an error for each object Swift failed to delete
+        :rtype: dict
+        '''
+        size = self.bulk_delete_size()
+        if not size:
+            return self.delete_objects(objects)
+        failures = {}
+        for i in range(0, len(objects), size):
+            failures.update(self.bulk_delete(objects[i:i + size]))
+        return failures
+
+    def bulk_delete_size(self):
+        '''
+        The maximum number of objects per bulk-delete request
+        or `0` if the cluster does not support bulk-delete.
+        '''
+        bulk = self.capabilities().get('bulk_delete')
+        if bulk is None:
+            return 0
+        return bulk.get('max_deletes_per_request', BULK_DELETE_SIZE)
+
+    def bulk_delete(self, objects):
+        '''
+        Delete objects in a single bulk-delete request.
+
+        :param objects: A list of ``(container, name)`` tuples
+        :returns: an error for each object Swift failed to delete
+        :rtype: dict
+        '''
+        paths = dict((quote('/'.join(('',) + obj).encode('utf8')), obj) for obj in objects)
+        data = '\n'.join(paths).encode('utf8')
+        headers = {'Content-Type': 'text/plain', 'Accept': 'application/json'}
+        _, body = self.conn.post_account(headers, query_string='bulk-delete', data=data)
+        if isinstance(body, six.binary_type):
+            body = body.decode('utf8')
+        response = json.loads(body)
+        failures = {}
+        for path, status in response.get('Errors') or []:
+            obj = paths.get(path) or paths.get(quote(path.encode('utf8')))
+            if obj is not None:
+                failures[obj] = FSError('Unable to delete "{0}": {1}'.format(obj[1], status))
+        if not response.get('Response Status', '200').startswith('2') and not failures:
+            error = FSError('Bulk delete failed: {0}'.format(response.get('Response Body')))
+            failures = dict((obj, error) for obj in objects)
+        return failures
+
+    def delete_objects(self, objects):
+        '''
+        Delete objects one by one, ignoring missing ones
+
+        :param objects: A list of ``(container, name)`` tuples
+        '''
+        failures = {}
+        for container, name in objects:
+            try:
+                self.conn.delete_object(container, name)
+            except swiftclient.ClientException as e:
+                if e.http_status != 404:
+                    failures[(container, name)] = e
+        return failures
 
     def copy(self, filename, target):
         dest = '/'.join((self.name, target))
@@ -75,10 +441,74 @@ class SwiftBackend(BaseBackend):
         for i in items:
             yield i['name']
 
+    def serve(self, filename):
+        '''
+        Stream the object content with a single request
+        or redirect to a TempURL if `redirect` is set.
+
+        Conditional and range headers are forwarded so Swift answers them in the same request,
+        validators being the object ``ETag`` and ``Last-Modified``.
+        '''
+        if self.redirect:
+            return redirect(self.signed_url(filename))
+        return self.serve_object(filename, responses.forwarded_conditions(multiple_ranges=True))
+
+    def serve_object(self, filename, conditions):
+        head = self.is_head_request()
+        try:
+            if head:
+                headers, body = self.conn.head_object(self.name, filename, headers=conditions), None
+            else:
+                headers, body = self.conn.get_object(self.name, filename, headers=conditions,
+                                                     resp_chunk_size=self.serve_chunk_size)
+        except swiftclient.ClientException as e:
+            headers = e.http_response_headers or {}
+            content_range = headers.get('content-range') or ''
+            if e.http_status == 404:
+                raise FileNotFound(filename)
+            elif e.http_status == 304:
+                return responses.relayed(responses.not_modified(), headers.get('etag'),
+                                         headers.get('last-modified'))
+            elif e.http_status == 416 and content_range.startswith('bytes */'):
+                return responses.range_not_satisfiable(int(content_range.rsplit('/', 1)[1]))
+            elif e.http_status in (412, 416) and 'Range' in conditions:
+                # Outdated `If-Range` (forwarded as `If-Match`): serve the whole object
+                conditions = dict((name, value) for name, value in conditions.items()
+                                  if name not in ('Range', 'If-Match'))
+                return self.serve_object(filename, conditions)
+            raise
+        mime = headers.get('content-type') or files.mime(filename, self.DEFAULT_MIME)
+        size = headers.get('content-length')
+        chunks = () if head else streams.closing(body, body.close)
+        response = self.stream_response(chunks, mime, int(size) if size is not None else None)
+        return responses.relayed(response, headers.get('etag'), headers.get('last-modified'),
+                                 headers.get('content-range'))
+
+    def sign_url(self, filename, expires):
+        '''
+        Compute a TempURL locally (HMAC of the object path with `temp_url_key`).
+
+        Only authenticates if `storage_url` is not set.
+        '''
+        if not self.temp_url_key:
+            raise OperationNotSupported('Signing URLs requires a TempURL key (`temp_url_key`)')
+        storage_url = urlsplit((self.config.get('storage_url') or self.conn.url).rstrip('/'))
+        path = '/'.join((storage_url.path, self.name, filename))
+        signed = generate_temp_url(path, expires, self.temp_url_key, 'GET',
+                                   digest=self.temp_url_digest)
+        query = signed.split('?', 1)[1]
+        return '{0}://{1}{2}?{3}'.format(storage_url.scheme, storage_url.netloc,
+                                         quote(path.encode('utf8')), query)
+
     def get_metadata(self, filename):
-        data = self.conn.head_object(self.name, filename)
+        try:
+            data = self.conn.head_object(self.name, filename)
+        except swiftclient.ClientException as e:
+            if e.http_status == 404:
+                raise FileNotFound(filename)
+            raise
         return {
-            'checksum': 'md5:{0}'.format(data['etag']),
+            'checksum': data.get('x-object-meta-checksum') or 'md5:{0}'.format(data['etag']),
             'size': int(data['content-length']),
             'mime': data['content-type'],
             'modified': parser.parse(data['last-modified']),
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+'''
+This module handle batch operations
+'''
+from __future__ import unicode_literals
+
+import logging
+import threading
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app, has_app_context
+
+__all__ = ('BatchResult', 'DEFAULT_WORKERS', 'executor', 'fan_out')
+
+log = logging.getLogger(__name__)
+
+#: Default maximum number of concurrent operations in a batch
+DEFAULT_WORKERS = 8
+
+# Marks the threads running batch operations
+_local = threading.local()
+
+
+class BatchResult(OrderedDict):
+    '''
+    Per-item results of a batch operation.
+
+    Successful items results are stored by key, in submission order.
+    Failed items exceptions are stored by key in :attr:`errors`.
+    '''
+    def __init__(self, *args, **kwargs):
+        super(BatchResult, self).__init__(*args, **kwargs)
+        self.errors = OrderedDict()
+
+    @property
+    def ok(self):
+        '''Whether all items succeeded'''
+        return not self.errors
+
+    def update_from(self, other):
+        '''Merge another batch results and errors into this one'''
+        self.update(other)
+        self.errors.update(other.errors)
+        return self
+
+
+def executor(max_workers=DEFAULT_WORKERS):
+    '''
+    Build a bounded thread pool to be reused across batches (see :func:`fan_out`),
+    so per-thread clients are kept from a batch to another.
+    '''
+    return ThreadPoolExecutor(max_workers=max_workers)
+
+
+def fan_out(func, items, max_workers=DEFAULT_WORKERS, key=None, executor=None):
+    '''
+    Call `func` on each item over a bounded thread pool.
+
+    A failing item does not abort the batch: its exception is collected.
+    The current Flask application context (if any) is pushed in each worker.
+    Batches started from a batch worker run sequentially in this worker
+    so a shared pool can't deadlock.
+
+    :param callable func: The operation to perform on each item
+    :param items: An iterable of items
+    :param int max_workers: The maximum number of concurrent calls
+    :param callable key: Extract the result key from an item (default to the item itself)
+    :param executor: A shared :class:`~concurrent.futures.ThreadPoolExecutor`
+        (default to a new pool of `max_workers` threads)
+    :rtype: BatchResult
+    '''
+    items = list(items)
+    key = key or (lambda item: item)
+    result = BatchResult()
+    app = current_app._get_current_object() if has_app_context() else None
+
+    def call(item):
+        try:
+            return True, func(item)
+        except Exception as e:
+            log.debug('Batch operation failed on %s: %s', key(item), e)
+            return False, e
+
+    def work(item):
+        _local.worker = True
+        try:
+            if app is None:
+                return call(item)
+            with app.app_context():
+                return call(item)
+        finally:
+            _local.worker = False
+
+    if max_workers <= 1 or len(items) <= 1 or getattr(_local, 'worker', False):
+        outcomes = [call(item) for item in items]
+    elif executor is not None:
+        outcomes = list(executor.map(work, items))
+    else:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as pool:
+            outcomes = list(pool.map(work, items))
+
+    for item, (success, value) in zip(items, outcomes):
+        if success:
+            result[key(item)] = value
+        else:
+            result.errors[key(item)] = value
+    return result
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+'''
+This module provides the metadata caches used by :meth:`Storage.metadata`
+and the in-memory LRU cache they are built on
+'''
+from __future__ import unicode_literals
+
+import threading
+import time
+
+from collections import OrderedDict
+
+__all__ = ('MemoryCache', 'MetadataCache', 'MemoryMetadataCache', 'DEFAULT_TTL', 'DEFAULT_SIZE')
+
+#: Default time to live (in seconds) of a cached metadata entry
+DEFAULT_TTL = 300
+
+#: Default maximum number of cached entries
+DEFAULT_SIZE = 1024
+
+clock = getattr(time, 'monotonic', time.time)
+
+
+class MemoryCache(object):
+    '''
+    A thread-safe in-process cache with optional TTL and LRU eviction.
+
+    :param int ttl: The number of seconds an entry stays valid (`None` for no expiry)
+    :param int size: The maximum number of entries before evicting the least recently used
+    '''
+    def __init__(self, ttl=None, size=DEFAULT_SIZE):
+        self.ttl = ttl
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        '''Get the cached value for a given key or `None`'''
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires is not None and expires < clock():
+                return None
+            # Reinsert to mark as most recently used
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value):
+        '''Store a value, evicting the least recently used entries if full'''
+        expires = clock() + self.ttl if self.ttl else None
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (expires, value)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class MetadataCache(object):
+    '''
+    Abstract metadata cache interface.
+
+    Extend this class to back the metadata cache with a shared store
+    and give an instance as ``{NAME}_FS_METADATA_CACHE``.
+    Files are keyed by ``{storage}:{filename}`` so storages can share a cache.
+    '''
+    def get(self, filename):
+        '''Get the cached metadata for a given file or `None`'''
+        raise NotImplementedError('get operation is not implemented')
+
+    def set(self, filename, metadata):
+        '''Store the metadata for a given file'''
+        raise NotImplementedError('set operation is not implemented')
+
+    def delete(self, filename):
+        '''Invalidate the cached metadata for a given file'''
+        raise NotImplementedError('delete operation is not implemented')
+
+    def delete_prefix(self, prefix):
+        '''
+        Invalidate the cached metadata for all files starting with `prefix`.
+
+        Default implementation clears the whole cache.
+        Caches should overwrite it if there is a better way.
+        '''
+        self.clear()
+
+    def clear(self):
+        '''Invalidate all cached metadata'''
+        raise NotImplementedError('clear operation is not implemented')
+
+
+class MemoryMetadataCache(MemoryCache, MetadataCache):
+    '''
+    A thread-safe in-process metadata cache with TTL and LRU eviction.
+
+    :param int ttl: The number of seconds an entry stays valid
+    :param int size: The maximum number of entries before evicting the least recently used
+    '''
+    def __init__(self, ttl=DEFAULT_TTL, size=DEFAULT_SIZE):
+        super(MemoryMetadataCache, self).__init__(ttl, size)
+
+    def delete_prefix(self, prefix):
+        with self._lock:
+            for filename in [f for f in self._entries if f.startswith(prefix)]:
+                del self._entries[filename]
+
+
+def from_config(config):
+    '''
+    Build the metadata cache for a given storage configuration.
+
+    ``metadata_cache`` can either be ``None`` or ``False`` (no cache), ``True`` (in-memory cache)
+    or a :class:`MetadataCache` instance.
+    '''
+    cache = config.get('metadata_cache')
+    if isinstance(cache, MetadataCache):
+        return cache
+    elif cache is None or cache is False:
+        return None
+    return MemoryMetadataCache(
+        ttl=config.get('metadata_cache_ttl', DEFAULT_TTL),
+        size=config.get('metadata_cache_size', DEFAULT_SIZE),
+    )
@@ -4,9 +4,11 @@ from __future__ import unicode_literals
 import mimetypes
 import os.path
 
+import six
+
 __all__ = (
     'TEXT', 'DOCUMENTS', 'IMAGES', 'AUDIO', 'DATA', 'SCRIPTS', 'ARCHIVES', 'EXECUTABLES',
-    'DEFAULTS', 'ALL', 'NONE', 'All', 'AllExcept', 'DisallowAll'
+    'DEFAULTS', 'ALL', 'NONE', 'All', 'AllExcept', 'DisallowAll', 'SavedFile'
 )
 
 #: This just contains plain text files (.txt).
@@ -42,6 +44,22 @@ EXECUTABLES = 'so exe dll'.split()
 #: The default allowed extensions - `TEXT`, `DOCUMENTS`, `DATA`, and `IMAGES`.
 DEFAULTS = TEXT + DOCUMENTS + IMAGES + DATA
 
+#: Known file signatures (magic numbers) used for mime type sniffing
+SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'%PDF-', 'application/pdf'),
+    (b'\x1f\x8b', 'application/gzip'),
+    (b'BZh', 'application/x-bzip2'),
+    (b'7z\xbc\xaf\x27\x1c', 'application/x-7z-compressed'),
+    (b'PK\x03\x04', 'application/zip'),
+)
+
+#: Container formats for which the filename gives a more accurate mime type (ie. docx, xlsx...)
+CONTAINERS = ('application/zip',)
+
 
 def extension(filename):
     ext = os.path.splitext(filename)[1]
@@ -75,6 +93,55 @@ def mime(filename, default=None):
     return mimetypes.guess_type(filename)[0] or default
 
 
+def sniff(head, filename=None, default=None):
+    '''
+    A basic helper to detect mime type from the first bytes of a file,
+    falling back on the filename.
+
+    :param bytes head: The file leading bytes
+    :param str filename: An optional filename or url used as fallback
+    '''
+    for signature, mimetype in SIGNATURES:
+        if head.startswith(signature):
+            if mimetype in CONTAINERS and filename:
+                return mime(filename, mimetype)
+            return mimetype
+    return mime(filename, default) if filename else default
+
+
+class SavedFile(six.text_type):
+    '''
+    The filename of a saved file, as returned by :meth:`~flask_fs.Storage.save`.
+
+    It behaves as the filename string
+    but also exposes the metadata computed while the content was uploaded.
+
+    :param str filename: The storage root-relative filename
+    :param str checksum: The content checksum expressed in the form `algo:hash`
+    :param int size: The content size in bytes
+    :param str mime: The content mime type
+    '''
+    def __new__(cls, filename, checksum=None, size=None, mime=None):
+        saved = six.text_type.__new__(cls, filename)
+        saved.checksum = checksum
+        saved.size = size
+        saved.mime = mime
+        return saved
+
+    @property
+    def filename(self):
+        return six.text_type(self)
+
+    @property
+    def metadata(self):
+        '''The known metadata as a dictionnary'''
+        return dict((key, value) for key, value in (
+            ('checksum', self.checksum),
+            ('size', self.size),
+            ('mime', self.mime),
+        ) if value is not None)
+
+
 class All(object):
     '''
     This type can be used to allow all extensions.
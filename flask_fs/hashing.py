@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+'''
+This module handle checksums computation
+'''
+from __future__ import unicode_literals
+
+import hashlib
+
+import six
+
+from werkzeug.datastructures import FileStorage
+
+from . import files
+
+__all__ = ('ALGORITHMS', 'DEFAULT_ALGORITHM', 'HashingReader', 'new', 'hash_file')
+
+#: Supported checksum algorithms
+ALGORITHMS = tuple(a for a in ('md5', 'sha1', 'sha256', 'sha512', 'blake2b') if hasattr(hashlib, a))
+
+#: The default checksum algorithm
+DEFAULT_ALGORITHM = 'sha1'
+
+CHUNK_SIZE = 2 ** 16
+
+#: Number of leading bytes kept for mime type sniffing
+HEAD_SIZE = 32
+
+
+def new(algorithm=DEFAULT_ALGORITHM):
+    '''
+    Get a new hasher for a given algorithm
+
+    :raises ValueError: if the algorithm is not supported
+    '''
+    if algorithm not in ALGORITHMS:
+        raise ValueError('Unsupported checksum algorithm "{0}"'.format(algorithm))
+    return getattr(hashlib, algorithm)()
+
+
+def hash_file(file, algorithm=DEFAULT_ALGORITHM):
+    '''Compute the hexadecimal digest of a file-like object content'''
+    hasher = new(algorithm)
+    blk_size_to_read = hasher.block_size * CHUNK_SIZE
+    while (True):
+        read_data = file.read(blk_size_to_read)
+        if not read_data:
+            break
+        hasher.update(read_data)
+    return hasher.hexdigest()
+
+
+class HashingReader(object):
+    '''
+    A file-like wrapper computing checksum, size and mime type
+    while the wrapped content is read.
+
+    :param file_or_wfs: The file-like object or `werkzeug.FileStorage` to read from
+    :param str algorithm: The checksum algorithm
+    :param str filename: The destination filename used as mime type fallback
+    :param str encoding: The encoding used for text content
+    '''
+    def __init__(self, file_or_wfs, algorithm=DEFAULT_ALGORITHM, filename=None, encoding='utf8'):
+        self.hasher = new(algorithm)
+        self.algorithm = algorithm
+        self.filename = filename
+        self.encoding = encoding
+        self.size = 0
+        self.head = b''
+        self.content_type = getattr(file_or_wfs, 'content_type', None)
+        if isinstance(file_or_wfs, FileStorage):
+            file_or_wfs = file_or_wfs.stream
+        self.file = file_or_wfs
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        if isinstance(data, six.text_type):
+            data = data.encode(self.encoding)
+        if data:
+            if len(self.head) < HEAD_SIZE:
+                self.head += data[:HEAD_SIZE - len(self.head)]
+            self.hasher.update(data)
+            self.size += len(data)
+        return data
+
+    @property
+    def checksum(self):
+        '''The checksum of the content read so far expressed in the form `algo:hash`'''
+        return '{0}:{1}'.format(self.algorithm, self.hasher.hexdigest())
+
+    @property
+    def mime(self):
+        '''The mime type sniffed from the content or guessed from the filename'''
+        return files.sniff(self.head, self.filename)
+
+    def saved(self, filename=None):
+        '''Get a :class:`~flask_fs.files.SavedFile` for the content read'''
+        return files.SavedFile(filename or self.filename,
+                               checksum=self.checksum,
+                               size=self.size,
+                               mime=self.mime)
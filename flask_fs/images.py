@@ -1,14 +1,14 @@
 # -*- coding: utf-8 -*-
 '''
 This module handle image operations (thumbnailing, resizing...)
+
+PIL is only imported when an image operation is performed.
 '''
 from __future__ import unicode_literals, division
 
 import logging
 import six
 
-from PIL import Image
-
 
 log = logging.getLogger(__name__)
 
@@ -21,6 +21,7 @@ def make_thumbnail(file, size, bbox=None):
     :param int size: The thumbnail size in pixels (Thumbnails are squares)
     :param tuple bbox: An optionnal Bounding box definition for the thumbnail
     '''
+    from PIL import Image
     image = Image.open(file)
     if bbox:
         thumbnail = crop_thumbnail(image, size, bbox)
@@ -30,6 +31,7 @@ def make_thumbnail(file, size, bbox=None):
 
 
 def center_thumbnail(image, size):
+    from PIL import Image
     result = Image.new('RGBA', (size, size), (255, 255, 255, 0))
     if image.size[0] > image.size[1]:
         new_size = (size, int(image.size[1] * size / image.size[0]))
@@ -43,10 +45,12 @@ def center_thumbnail(image, size):
 
 
 def crop_thumbnail(image, size, bbox):
+    from PIL import Image
     return image.crop(bbox).resize((size, size), Image.ANTIALIAS)
 
 
 def resize(file, size):
+    from PIL import Image
     image = Image.open(file)
     if image.size[0] > size or image.size[1] > size:
         ratio = min(size / image.size[0], size / image.size[1])
@@ -58,6 +62,7 @@ def resize(file, size):
 
 
 def optimize(file):
+    from PIL import Image
     image = Image.open(file)
     return _img_to_file(image)
 
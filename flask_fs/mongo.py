@@ -21,18 +21,31 @@ log = logging.getLogger(__name__)
 class FileReference(object):
     '''Implements the FileField interface'''
     def __init__(self, fs=None, filename=None, upload_to=None, basename=None,
-                 instance=None, name=None):
+                 instance=None, name=None, store_metadata=False,
+                 checksum=None, size=None, mime=None):
         self.fs = fs
         self.upload_to = upload_to
         self._filename = filename
         self.basename = basename
         self._instance = instance
         self._name = name
+        self.store_metadata = store_metadata
+        # Metadata computed on upload (see :class:`~flask_fs.files.SavedFile`), if any
+        self.checksum = checksum or getattr(filename, 'checksum', None)
+        self.size = size if size is not None else getattr(filename, 'size', None)
+        self.mime = mime or getattr(filename, 'mime', None)
 
     def to_mongo(self):
-        return {
+        data = {
             'filename': self.filename
         }
+        if self.store_metadata:
+            data.update((key, value) for key, value in (
+                ('checksum', self.checksum),
+                ('size', self.size),
+                ('mime', self.mime),
+            ) if value is not None)
+        return data
 
     def save(self, wfs, filename=None):
         '''Save a Werkzeug FileStorage object'''
@@ -51,6 +64,9 @@ class FileReference(object):
     def filename(self, value):
         self._mark_as_changed()
         self._filename = value
+        self.checksum = getattr(value, 'checksum', None)
+        self.size = getattr(value, 'size', None)
+        self.mime = getattr(value, 'mime', None)
 
     @property
     def url(self):
@@ -208,13 +224,18 @@ class ImageReference(FileReference):
 class FileField(BaseField):
     '''
     Store reference to files in a given storage.
+
+    With `store_metadata`, the checksum, size and mime type computed on upload
+    are stored alongside the filename so they don't need to be fetched from the storage.
     '''
     proxy_class = FileReference
 
-    def __init__(self, fs=None, upload_to=None, basename=None, *args, **kwargs):
+    def __init__(self, fs=None, upload_to=None, basename=None, store_metadata=False,
+                 *args, **kwargs):
         self.fs = fs
         self.upload_to = upload_to
         self.basename = basename
+        self.store_metadata = store_metadata
         super(FileField, self).__init__(*args, **kwargs)
 
     def proxy(self, filename=None, instance=None, **kwargs):
@@ -225,6 +246,7 @@ class FileField(BaseField):
             basename=self.basename,
             instance=instance,
             name=self.name,
+            store_metadata=self.store_metadata,
             **kwargs
         )
 
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+'''
+This module handle conditional and partial HTTP responses
+'''
+from __future__ import unicode_literals
+
+import six
+import uuid
+
+from datetime import timedelta
+
+from dateutil import tz
+from flask import Response, has_request_context, request
+from werkzeug.http import parse_date, quote_etag, unquote_etag
+
+__all__ = (
+    'etag', 'http_datetime', 'is_not_modified', 'requested_ranges', 'conditional',
+    'forwarded_conditions', 'relayed', 'not_modified', 'range_not_satisfiable', 'partial',
+    'add_validators', 'add_cache_control'
+)
+
+
+def etag(checksum):
+    '''
+    Build a strong entity tag from a checksum expressed in the form `algo:hash`.
+
+    Returns `None` if there is no checksum.
+    '''
+    return checksum.replace(':', '-', 1) if checksum else None
+
+
+def http_datetime(value):
+    '''
+    Normalize a datetime to the HTTP dates precision and convention:
+    naive UTC datetime without microseconds (naive datetimes are considered as UTC).
+    '''
+    if value is None:
+        return None
+    if value.tzinfo is not None:
+        value = value.astimezone(tz.tzutc()).replace(tzinfo=None)
+    return value.replace(microsecond=0)
+
+
+def is_not_modified(request, etag, last_modified):
+    '''
+    Whether the client copy is still valid given the request
+    ``If-None-Match`` or ``If-Modified-Since`` (only considered without ``If-None-Match``).
+    '''
+    if request.if_none_match:
+        return request.if_none_match.star_tag or (
+            etag is not None and request.if_none_match.contains_weak(etag)
+        )
+    since = http_datetime(request.if_modified_since)
+    return since is not None and last_modified is not None and last_modified <= since
+
+
+def if_range_matches(request, etag, last_modified):
+    '''Whether a ``Range`` should be honored given the request ``If-Range``'''
+    if_range = request.if_range
+    if if_range.etag:
+        return etag is not None and if_range.etag == etag
+    elif if_range.date:
+        return last_modified is not None and http_datetime(if_range.date) == last_modified
+    return True
+
+
+def requested_ranges(request, size, etag=None, last_modified=None):
+    '''
+    Get the satisfiable byte ranges requested for a file of `size` bytes.
+
+    :returns: `None` if the whole file should be served (no valid range requested,
+        unknown size or outdated ``If-Range``) or a list of `(start, end)` tuples,
+        `end` being exclusive. An empty list means no range is satisfiable.
+    '''
+    requested = request.range
+    if requested is None or requested.units != 'bytes' or size is None:
+        return None
+    if not if_range_matches(request, etag, last_modified):
+        return None
+    ranges = []
+    for start, end in requested.ranges:
+        if start < 0:
+            start, end = max(size + start, 0), size
+        else:
+            end = size if end is None else min(end, size)
+        if start < end:
+            ranges.append((start, end))
+    return ranges
+
+
+def content_range(start, end, size):
+    return 'bytes {0}-{1}/{2}'.format(start, end - 1, size)
+
+
+def not_modified():
+    '''A ``304 Not Modified`` response'''
+    return Response(status=304)
+
+
+def range_not_satisfiable(size):
+    '''A ``416 Range Not Satisfiable`` response'''
+    response = Response(status=416)
+    response.headers['Content-Range'] = 'bytes */{0}'.format(size)
+    return response
+
+
+def partial(backend, filename, ranges, mime, size):
+    '''
+    A streamed ``206 Partial Content`` response for some satisfiable ranges.
+
+    A single range is served as is, multiple ranges as a ``multipart/byteranges`` body.
+    Ranges content is read with :meth:`~flask_fs.backends.BaseBackend.iter_range`.
+    '''
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        response = backend.stream_response(backend.iter_range(filename, start, end), mime,
+                                           end - start)
+        response.headers['Content-Range'] = content_range(start, end, size)
+    else:
+        boundary = uuid.uuid4().hex
+        headers = [
+            '\r\n--{0}\r\nContent-Type: {1}\r\nContent-Range: {2}\r\n\r\n'.format(
+                boundary, mime, content_range(start, end, size)
+            ).encode('ascii')
+            for start, end in ranges
+        ]
+        footer = '\r\n--{0}--\r\n'.format(boundary).encode('ascii')
+
+        def generate():
+            for header, (start, end) in zip(headers, ranges):
+                yield header
+                chunks = backend.iter_range(filename, start, end)
+                try:
+                    for chunk in chunks:
+                        yield chunk
+                finally:
+                    if hasattr(chunks, 'close'):
+                        chunks.close()
+            yield footer
+
+        length = sum(len(h) for h in headers) + sum(e - s for s, e in ranges) + len(footer)
+        mime = 'multipart/byteranges; boundary={0}'.format(boundary)
+        response = backend.stream_response(generate(), mime, length)
+    response.status_code = 206
+    return response
+
+
+def conditional(backend, filename, mime, size=None, etag=None, last_modified=None,
+                weak=False, full=None):
+    '''
+    Answer the current request for a file given its validators.
+
+    Conditional requests get a ``304 Not Modified``, byte ranges a ``206 Partial Content``
+    (read with :meth:`~flask_fs.backends.BaseBackend.iter_range`)
+    or a ``416 Range Not Satisfiable``. Other requests get the `full` response.
+
+    :param str etag: The file entity tag (only used for ``If-Range`` if strong)
+    :param bool weak: Whether `etag` is a weak entity tag
+    :param callable full: Build the whole file response
+    '''
+    last_modified = http_datetime(last_modified)
+    if not has_request_context():
+        return add_validators(full(), etag, last_modified, weak, accept_ranges=size is not None)
+    elif is_not_modified(request, etag, last_modified):
+        response = not_modified()
+    else:
+        requested = requested_ranges(request, size, None if weak else etag, last_modified)
+        if requested is None:
+            response = full()
+        elif not requested:
+            response = range_not_satisfiable(size)
+        else:
+            response = partial(backend, filename, requested, mime, size)
+    return add_validators(response, etag, last_modified, weak, accept_ranges=size is not None)
+
+
+def forwarded_conditions(multiple_ranges=False):
+    '''
+    Get the conditional and range headers of the current request to forward to an object store
+    so it answers them in the same request as the content.
+
+    ``If-Range`` is forwarded as ``If-Match`` for entity tags
+    (the store should then be queried again without range if it fails)
+    and the range is dropped for dates.
+
+    :param bool multiple_ranges: Whether the store supports multiple ranges in a request
+    :returns: a dictionary of headers
+    '''
+    if not has_request_context():
+        return {}
+    headers = dict((name, request.headers[name])
+                   for name in ('If-None-Match', 'If-Modified-Since') if name in request.headers)
+    requested = request.range
+    if (requested is not None and requested.units == 'bytes'
+            and (multiple_ranges or len(requested.ranges) == 1)):
+        if_range = request.if_range
+        if if_range.etag:
+            headers['Range'] = requested.to_header()
+            headers['If-Match'] = quote_etag(if_range.etag)
+        elif not if_range.date:
+            headers['Range'] = requested.to_header()
+    return headers
+
+
+def relayed(response, etag=None, last_modified=None, content_range=None):
+    '''
+    Set on a file response the validators and range returned by an object store.
+
+    :param str etag: The ``ETag`` header value (quoted or not)
+    :param last_modified: The ``Last-Modified`` header value or datetime
+    :param str content_range: The ``Content-Range`` header value of a partial content
+    '''
+    weak = False
+    if etag:
+        if not etag.startswith(('"', 'W/')):
+            etag = quote_etag(etag)
+        etag, weak = unquote_etag(etag)
+    if isinstance(last_modified, six.string_types):
+        last_modified = parse_date(last_modified)
+    if content_range:
+        response.status_code = 206
+        response.headers['Content-Range'] = content_range
+    return add_validators(response, etag, http_datetime(last_modified), weak)
+
+
+def add_validators(response, etag=None, last_modified=None, weak=False, accept_ranges=True):
+    '''
+    Set validators (``ETag`` and ``Last-Modified``) and ``Accept-Ranges`` headers
+    on a file response.
+    '''
+    if etag is not None:
+        response.set_etag(etag, weak=weak)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    if accept_ranges:
+        response.headers['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def add_cache_control(response, cache_control=None):
+    '''
+    Set the ``Cache-Control`` header on a file response.
+
+    :param cache_control: A ``Cache-Control`` header value
+        or a number of seconds for ``public, max-age=<seconds>``
+    '''
+    if isinstance(cache_control, timedelta):
+        cache_control = int(cache_control.total_seconds())
+    if isinstance(cache_control, int) and not isinstance(cache_control, bool):
+        cache_control = 'public, max-age={0}'.format(cache_control)
+    if cache_control:
+        response.headers['Cache-Control'] = cache_control
+    return response
@@ -1,15 +1,23 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-import pkg_resources
 import os.path
 
-from flask import current_app, url_for, request, abort
+from flask import (
+    current_app, url_for, request, abort, has_request_context, make_response, safe_join
+)
 from six.moves.urllib.parse import urljoin
 from werkzeug import secure_filename, FileStorage, cached_property
+from werkzeug.urls import url_quote
 
-from .errors import UnauthorizedFileType, FileExists, OperationNotSupported, FileNotFound
-from .files import DEFAULTS, extension, lower_extension
+try:
+    from importlib.metadata import entry_points
+except ImportError:  # Python < 3.8
+    from importlib_metadata import entry_points
+
+from . import cache, responses, streams
+from .errors import UnauthorizedFileType, OperationNotSupported, FileNotFound
+from .files import DEFAULTS, SavedFile, extension, lower_extension
 
 
 DEFAULT_CONFIG = {
@@ -24,8 +32,71 @@ BACKEND_PREFIX = 'FS_{0}_'
 # Config keys that should be overwritten from backend config
 BACKEND_EXCLUDED_CONFIG = ('BACKEND', 'URL', 'ROOT')
 
-# Load registered backends
-BACKENDS = dict((ep.name, ep) for ep in pkg_resources.iter_entry_points('fs.backend'))
+# Marker of storage level configuration keys
+STORAGE_MARKER = '_FS_'
+
+# Entry point group used to register backends
+BACKENDS_GROUP = 'fs.backend'
+
+# Resolved backends entry points
+BACKENDS = {}
+
+# Served responses statuses the `cache_control` setting applies to
+CACHEABLE_STATUSES = (200, 206, 304)
+
+
+def load_backend(name):
+    '''
+    Load a registered backend class given its name.
+
+    Backends are discovered lazily from the ``fs.backend`` entry points
+    and only the requested one is imported.
+
+    :raises ValueError: if no backend is registered with this name
+    '''
+    if name not in BACKENDS:
+        eps = entry_points()
+        if hasattr(eps, 'select'):
+            eps = eps.select(group=BACKENDS_GROUP, name=name)
+        else:  # Python < 3.10
+            eps = [ep for ep in eps.get(BACKENDS_GROUP, []) if ep.name == name]
+        for ep in eps:
+            BACKENDS[name] = ep
+            break
+        else:
+            raise ValueError('Unknown backend "{0}"'.format(name))
+    return BACKENDS[name].load()
+
+
+def index_config(config):
+    '''
+    Index Flask-FS configuration keys by prefix in a single pass.
+
+    Each ``FS_*`` and ``*_FS_*`` key is indexed under every candidate prefix
+    so storage and backend names containing underscores are supported.
+
+    :param dict config: The application configuration
+    :returns: a dictionnary ``{prefix: {lowercase key without prefix: value}}``
+    :rtype: dict
+    '''
+    index = {}
+
+    def add(prefix, key, value):
+        suffix = key[len(prefix):]
+        if suffix:
+            index.setdefault(prefix, {})[suffix.lower()] = value
+
+    for key, value in config.items():
+        if key.startswith(CONF_PREFIX):
+            pos = key.find('_', len(CONF_PREFIX))
+            while pos >= 0:
+                add(key[:pos + 1], key, value)
+                pos = key.find('_', pos + 1)
+        pos = key.find(STORAGE_MARKER)
+        while pos >= 0:
+            add(key[:pos + len(STORAGE_MARKER)], key, value)
+            pos = key.find(STORAGE_MARKER, pos + 1)
+    return index
 
 
 class Config(dict):
@@ -83,8 +154,10 @@ class Storage(object):
         self.upload_to = upload_to
         self.backend = None
         self.overwrite = overwrite
+        self.metadata_cache = None
+        self._url_prefixes = {}
 
-    def configure(self, app):
+    def configure(self, app, index=None):
         '''
         Load configuration from application configuration.
 
@@ -94,35 +167,48 @@ class Storage(object):
             {STORAGE_NAME}_FS_{KEY}
 
         If no configuration is set for a given key, global config is taken as default.
+
+        :param app: The `~flask.Flask` instance to get the configuration from.
+        :param dict index: An optionnal configuration index as built by :func:`index_config`.
+            It allows to share a single configuration scan between multiple storages.
         '''
         config = Config()
+        if index is None:
+            index = index_config(app.config)
 
         prefix = PREFIX.format(self.name.upper())
         backend_key = '{0}BACKEND'.format(prefix)
         self.backend_name = app.config.get(backend_key, app.config['FS_BACKEND'])
         self.backend_prefix = BACKEND_PREFIX.format(self.backend_name.upper())
-        backend_excluded_keys = [''.join((self.backend_prefix, k)) for k in BACKEND_EXCLUDED_CONFIG]
+        backend_excluded_keys = [k.lower() for k in BACKEND_EXCLUDED_CONFIG]
 
         # Set default values
         for key, value in DEFAULT_CONFIG.items():
             config.setdefault(key, value)
 
         # Set backend level values
-        for key, value in app.config.items():
-            if key.startswith(self.backend_prefix) and key not in backend_excluded_keys:
-                config[key.replace(self.backend_prefix, '').lower()] = value
+        for key, value in index.get(self.backend_prefix, {}).items():
+            if key not in backend_excluded_keys:
+                config[key] = value
 
         # Set storage level values
-        for key, value in app.config.items():
-            if key.startswith(prefix):
-                config[key.replace(prefix, '').lower()] = value
+        config.update(index.get(prefix, {}))
 
-        if self.backend_name not in BACKENDS:
-            raise ValueError('Unknown backend "{0}"'.format(self.backend_name))
-        backend_class = BACKENDS[self.backend_name].load()
+        backend_class = load_backend(self.backend_name)
         backend_class.backend_name = self.backend_name
         self.backend = backend_class(self.name, config)
+        self.metadata_cache = cache.from_config(config)
         self.config = config
+        self._url_prefixes = {}
+
+    def warmup(self):
+        '''
+        Eagerly connect the backend.
+
+        Backends connect lazily on first operation,
+        call this after the application initialization to connect upfront.
+        '''
+        self.backend.warmup()
 
     @cached_property
     def root(self):
@@ -131,19 +217,23 @@ class Storage(object):
     @property
     def base_url(self):
         '''The public URL for this storage'''
+        return self._base_url()
+
+    def _base_url(self, secure=None):
         config_value = self.config.get('url')
         if config_value:
-            return self._clean_url(config_value)
+            return self._clean_url(config_value, secure)
         default_url = current_app.config.get('FS_URL')
         default_url = current_app.config.get('{0}URL'.format(self.backend_prefix), default_url)
         if default_url:
             url = urljoin(default_url, self.name)
-            return self._clean_url(url)
+            return self._clean_url(url, secure)
         return url_for('fs.get_file', fs=self.name, filename='', _external=True)
 
-    def _clean_url(self, url):
+    def _clean_url(self, url, secure=None):
         if not url.startswith('http://') and not url.startswith('https://'):
-            url = ('https://' if request.is_secure else 'http://') + url
+            secure = request.is_secure if secure is None else secure
+            url = ('https://' if secure else 'http://') + url
         if not url.endswith('/'):
             url += '/'
         return url
@@ -153,6 +243,20 @@ class Storage(object):
         '''Whether this storage has a public URL or not'''
         return bool(self.config.get('url') or current_app.config.get('FS_URL'))
 
+    def _url_prefix(self):
+        '''
+        The public URL prefix for the current application and scheme
+        or `None` if files are served by Flask-FS.
+
+        It is resolved once per application and scheme.
+        '''
+        app = current_app._get_current_object()
+        secure = has_request_context() and request.is_secure
+        key = (app, secure)
+        if key not in self._url_prefixes:
+            self._url_prefixes[key] = self._base_url(secure) if self.has_url else None
+        return self._url_prefixes[key]
+
     def url(self, filename, external=False):
         '''
         This function gets the URL a file uploaded to this set would be
@@ -163,11 +267,30 @@ class Storage(object):
         '''
         if filename.startswith('/'):
             filename = filename[1:]
-        if self.has_url:
-            return self.base_url + filename
+        prefix = self._url_prefix()
+        if prefix:
+            return prefix + filename
         else:
             return url_for('fs.get_file', fs=self.name, filename=filename, _external=external)
 
+    def urls(self, filenames, external=False):
+        '''
+        Get the URLs for multiple files at once.
+
+        This is equivalent to calling :meth:`url` for each filename
+        but the URL prefix is only resolved once.
+
+        :param filenames: An iterable of filenames to return the URL for.
+        :param bool external: If True, returns absolute URLs
+        :rtype: list
+        '''
+        filenames = [f[1:] if f.startswith('/') else f for f in filenames]
+        prefix = self._url_prefix()
+        if prefix:
+            return [prefix + filename for filename in filenames]
+        prefix = url_for('fs.get_file', fs=self.name, filename='', _external=external)
+        return [prefix + url_quote(filename, safe='/:') for filename in filenames]
+
     def path(self, filename):
         '''
         This returns the absolute path of a file uploaded to this set. It
@@ -192,6 +315,16 @@ class Storage(object):
         '''
         return self.backend.exists(filename)
 
+    def exists_many(self, filenames):
+        '''
+        Verify whether multiple files exist or not.
+
+        :param filenames: An iterable of storage root-relative filenames
+        :returns: a boolean for each filename
+        :rtype: ~flask_fs.batch.BatchResult
+        '''
+        return self.backend.exists_many(filenames)
+
     def file_allowed(self, storage, basename):
         '''
         This tells whether a file is allowed.
@@ -224,21 +357,76 @@ class Storage(object):
         :param string filename: The storage root-relative filename
         :raises FileNotFound: If the file does not exists
         '''
-        if not self.backend.exists(filename):
-            raise FileNotFound(filename)
+        self._ensure_exists(filename)
         return self.backend.read(filename)
 
-    def open(self, filename, mode='r', **kwargs):
+    def download(self, filename, fileobj_or_path):
+        '''
+        Download a file into a binary file-like object or a local path
+        without loading it in memory.
+
+        Large files are downloaded with concurrent ranged requests on backends supporting it.
+
+        :param string filename: The storage root-relative filename
+        :param fileobj_or_path: A binary file-like object or a local path
+        :raises FileNotFound: If the file does not exists
+        '''
+        if hasattr(fileobj_or_path, 'write'):
+            return self.backend.download(filename, fileobj_or_path)
+        try:
+            with open(fileobj_or_path, 'wb') as out:
+                self.backend.download(filename, out)
+        except Exception:
+            # Do not leave a partial or empty file behind
+            if os.path.exists(fileobj_or_path):
+                os.remove(fileobj_or_path)
+            raise
+
+    def read_many(self, filenames):
+        '''
+        Read multiple files content.
+
+        Missing files are reported as :exc:`FileNotFound` in the result errors.
+
+        :param filenames: An iterable of storage root-relative filenames
+        :returns: the content of each file
+        :rtype: ~flask_fs.batch.BatchResult
+        '''
+        return self.backend.read_many(filenames)
+
+    def open(self, filename, mode='r', seekable=False, **kwargs):
         '''
         Open the file and return a file-like object.
 
+        With `seekable`, the file is opened for random binary reads:
+        only the read ranges are fetched from the backend.
+        Files opened for writing invalidate their cached metadata once closed.
+
         :param str filename: The storage root-relative filename
         :param str mode: The open mode (``(r|w)b?``)
+        :param bool seekable: Whether to open a lazy seekable file (only in ``rb`` mode)
         :raises FileNotFound: If trying to read a file that does not exists
         '''
-        if 'r' in mode and not self.backend.exists(filename):
-            raise FileNotFound(filename)
-        return self.backend.open(filename, mode, **kwargs)
+        if seekable:
+            if mode != 'rb':
+                raise ValueError('Seekable files can only be opened in "rb" mode')
+            return self.backend.open_seekable(filename)
+        if 'r' in mode:
+            self._ensure_exists(filename)
+            return self.backend.open(filename, mode, **kwargs)
+        opened = self.backend.open(filename, mode, **kwargs)
+        return streams.CloseHook(opened, lambda: self.invalidate(filename))
+
+    def read_range(self, filename, start, end=None):
+        '''
+        Read a range of bytes from a file without fetching the whole file.
+
+        :param string filename: The storage root-relative filename
+        :param int start: The first byte offset
+        :param int end: The offset after the last byte (default to the end of the file)
+        :raises FileNotFound: If the file does not exists
+        '''
+        return self.backend.read_range(filename, start, end)
 
     def write(self, filename, content, overwrite=False):
         '''
@@ -249,9 +437,15 @@ class Storage(object):
         :param bool overwrite: Whether to wllow overwrite or not
         :raises FileExists: If the file exists and `overwrite` is `False`
         '''
-        if not self.overwrite and not overwrite and self.backend.exists(filename):
-            raise FileExists()
-        return self.backend.write(filename, content)
+        overwrite = self.overwrite or overwrite
+        if self.backend.exclusive_create:
+            result = self.backend.write(filename, content, overwrite=overwrite)
+        else:
+            if not overwrite:
+                self.backend.ensure_absent(filename)
+            result = self.backend.write(filename, content)
+        self.invalidate(filename)
+        return result
 
     def delete(self, filename):
         '''
@@ -259,7 +453,44 @@ class Storage(object):
 
         :param str filename: The storage root-relative filename
         '''
-        return self.backend.delete(filename)
+        result = self.backend.delete(filename)
+        self.invalidate(filename, prefix=True)
+        return result
+
+    def delete_many(self, filenames):
+        '''
+        Delete multiple files.
+
+        :param filenames: An iterable of storage root-relative filenames
+        :rtype: ~flask_fs.batch.BatchResult
+        '''
+        result = self.backend.delete_many(filenames)
+        for filename in result:
+            self.invalidate(filename, prefix=True)
+        return result
+
+    def copy(self, filename, target):
+        '''
+        Copy a file to another path in the storage.
+
+        :param str filename: The storage root-relative source filename
+        :param str target: The storage root-relative destination filename
+        '''
+        result = self.backend.copy(filename, target)
+        self.invalidate(target)
+        return result
+
+    def move(self, filename, target):
+        '''
+        Move a file to another path in the storage.
+
+        :param str filename: The storage root-relative source filename
+        :param str target: The storage root-relative destination filename
+        '''
+        result = self.backend.move(filename, target)
+        self.invalidate(filename)
+        self.invalidate(target)
+        return result
 
     def save(self, file_or_wfs, filename=None, prefix=None, overwrite=None):
         '''
@@ -267,7 +498,8 @@ class Storage(object):
 
         If the upload is not allowed, an :exc:`UploadNotAllowed` error will be raised.
         Otherwise, the file will be saved and its name (including the folder)
-        will be returned.
+        will be returned as a :class:`~flask_fs.files.SavedFile`
+        exposing the checksum, size and mime type computed during the upload.
 
         :param file_or_wfs: a file or :class:`werkzeug.FileStorage` file to save.
         :param string filename: The expected filename in the storage.
@@ -276,6 +508,7 @@ class Storage(object):
         :param bool overwrite: if specified, override the storage default value.
 
         :raise UnauthorizedFileType: If the file type is not allowed
+        :raise FileExists: If the file exists and `overwrite` is `False`
         '''
         if not filename and isinstance(file_or_wfs, FileStorage):
             filename = lower_extension(secure_filename(file_or_wfs.filename))
@@ -294,12 +527,53 @@ class Storage(object):
             filename = '/'.join((upload_to, filename))
 
         overwrite = self.overwrite if overwrite is None else overwrite
-        if not overwrite and self.exists(filename):
-            raise FileExists(filename)
+        if self.backend.exclusive_create:
+            saved = self.backend.save(file_or_wfs, filename, overwrite=overwrite)
+        else:
+            if not overwrite:
+                self.backend.ensure_absent(filename)
+            saved = self.backend.save(file_or_wfs, filename)
+        self.invalidate(filename)
+
+        if not isinstance(saved, SavedFile):
+            # Custom backends may only return the filename
+            saved = SavedFile(filename)
+        return saved
 
-        self.backend.save(file_or_wfs, filename)
+    def save_many(self, files, prefix=None, overwrite=None):
+        '''
+        Saves multiple files concurrently.
 
-        return filename
+        Each file is saved with :meth:`save` over a bounded thread pool
+        (``{NAME}_FS_BATCH_WORKERS`` concurrent uploads).
+        A failing file doesn't abort the others.
+
+        :param files: An iterable of `file` or :class:`~werkzeug.FileStorage`
+            or of ``(file_or_wfs, filename)`` tuples.
+        :param string prefix: a path or a callable returning a path to prepend to the filenames.
+        :param bool overwrite: if specified, override the storage default value.
+        :returns: the :class:`~flask_fs.files.SavedFile` of each file keyed by its given filename
+        :rtype: ~flask_fs.batch.BatchResult
+        :raises ValueError: if a file has no filename or if filenames are not unique
+        '''
+        items = [f if isinstance(f, tuple) else (f, None) for f in files]
+
+        def save(item):
+            file_or_wfs, filename = item
+            return self.save(file_or_wfs, filename, prefix=prefix, overwrite=overwrite)
+
+        def key(item):
+            file_or_wfs, filename = item
+            return filename or getattr(file_or_wfs, 'filename', None)
+
+        # Results are keyed by filename: reject ambiguous batches upfront
+        keys = [key(item) for item in items]
+        if not all(keys):
+            raise ValueError('filename is required')
+        if len(set(keys)) != len(keys):
+            raise ValueError('Filenames must be unique in a batch')
+
+        return self.backend.fan_out(save, items, key=key)
 
     def list_files(self):
         '''
@@ -317,12 +591,56 @@ class Storage(object):
         - `checksum`: a checksum expressed in the form `algo:hash`
         - 'mime': the mime type
         - `modified`: the last modification date
+
+        Backend metadata are cached if ``{NAME}_FS_METADATA_CACHE`` is set.
         '''
-        metadata = self.backend.metadata(filename)
+        key = self._cache_key(filename)
+        metadata = self.metadata_cache.get(key) if self.metadata_cache is not None else None
+        if metadata is None:
+            metadata = self.backend.metadata(filename)
+            if self.metadata_cache is not None:
+                self.metadata_cache.set(key, metadata)
+        metadata = dict(metadata)
         metadata['filename'] = os.path.basename(filename)
         metadata['url'] = self.url(filename, external=True)
         return metadata
 
+    def signed_url(self, filename, expires=None):
+        '''
+        Get a short-lived URL giving a temporary read access to a private file,
+        ie. to be used in templates.
+
+        Signed URLs are cached and reused until shortly before they expire.
+
+        :param str filename: The storage root-relative filename
+        :param int expires: The URL validity in seconds
+            (default to ``{NAME}_FS_SIGNED_URL_EXPIRES``)
+        :raises OperationNotSupported: when the backend does not support signed URLs
+        '''
+        return self.backend.signed_url(filename, expires)
+
+    def invalidate(self, filename, prefix=False):
+        '''
+        Invalidate cached metadata for a given file.
+
+        :param str filename: The storage root-relative filename
+        :param bool prefix: Also invalidate all files under `filename` considered as a directory
+        '''
+        if self.metadata_cache is None:
+            return
+        self.metadata_cache.delete(self._cache_key(filename))
+        if prefix:
+            self.metadata_cache.delete_prefix(self._cache_key(filename.rstrip('/') + '/'))
+
+    def _ensure_exists(self, filename):
+        '''Check existence before reading on backends without :attr:`raises_not_found` support'''
+        if not self.backend.raises_not_found and not self.backend.exists(filename):
+            raise FileNotFound(filename)
+
+    def _cache_key(self, filename):
+        '''The metadata cache key, namespaced by storage as caches can be shared'''
+        return '{0}:{1}'.format(self.name, filename)
+
     def __contains__(self, value):
         return self.exists(value)
 
@@ -348,7 +666,23 @@ class Storage(object):
                 return newname
 
     def serve(self, filename):
-        '''Serve a file given its filename'''
-        if not self.exists(filename):
+        '''
+        Serve a file given its filename.
+
+        Backends answer conditional requests with a ``304 Not Modified``
+        and byte ranges requests with a ``206 Partial Content``
+        from validators fetched along with the file
+        (see :meth:`~flask_fs.backends.BaseBackend.serve`).
+        The ``Cache-Control`` header is set from ``{NAME}_FS_CACHE_CONTROL``
+        unless the backend redirects to another URL (ie. a signed URL).
+        '''
+        # Reject filenames escaping the storage root (raises a 404)
+        safe_join('', filename)
+        try:
+            self._ensure_exists(filename)
+            response = make_response(self.backend.serve(filename))
+        except FileNotFound:
             abort(404)
-        return self.backend.serve(filename)
+        if response.status_code in CACHEABLE_STATUSES:
+            responses.add_cache_control(response, self.config.get('cache_control'))
+        return response
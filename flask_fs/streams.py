@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+'''
+This module handle streamed uploads
+'''
+from __future__ import unicode_literals
+
+import codecs
+import io
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import six
+
+from . import hashing
+
+__all__ = (
+    'DEFAULT_PART_SIZE', 'PartWriter', 'RangeReader', 'IterReader',
+    'writer', 'copy', 'chunks', 'closing', 'CloseHook', 'is_buffer', 'to_bytes', 'seekable',
+    'range_reader'
+)
+
+log = logging.getLogger(__name__)
+
+#: Default size of uploaded parts (S3 requires at least 5MB for all parts but the last)
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+
+#: Size of the chunks read from streamed contents
+CHUNK_SIZE = 64 * 1024
+
+BUFFER_TYPES = (six.binary_type, six.text_type, bytearray, memoryview)
+
+
+def is_buffer(content):
+    '''Whether a content is already in memory (as opposed to a file-like object or an iterable)'''
+    return isinstance(content, BUFFER_TYPES)
+
+
+def to_bytes(data):
+    '''Copy a binary buffer into `bytes` (``bytes(memoryview)`` is its repr on Python 2)'''
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    return bytes(data)
+
+
+def seekable(fileobj):
+    '''Whether a file-like object supports random access'''
+    if hasattr(fileobj, 'seekable'):
+        return fileobj.seekable()
+    return hasattr(fileobj, 'seek') and hasattr(fileobj, 'tell')
+
+
+def chunks(content, size=CHUNK_SIZE, encoding='utf8'):
+    '''
+    Iterate over the binary chunks of a content without loading it entirely.
+
+    :param content: A file-like object, an iterable of chunks or an in-memory content
+        (`bytes`, text, `bytearray` or `memoryview`). Text is encoded with `encoding`.
+    :param int size: The size of the chunks read from file-like objects
+    '''
+    def encode(data):
+        return data.encode(encoding) if isinstance(data, six.text_type) else to_bytes(data)
+
+    if is_buffer(content):
+        yield encode(content)
+    elif hasattr(content, 'read'):
+        while True:
+            data = content.read(size)
+            if not data:
+                break
+            yield encode(data)
+    else:
+        for data in content:
+            if data:
+                yield encode(data)
+
+
+class PartWriter(object):
+    '''
+    A write-only file-like object uploading its content by parts.
+
+    Written content is buffered until a full part is available,
+    so memory usage is bounded by the part size
+    (times the number of parts uploaded concurrently).
+    Contents smaller than `threshold` are uploaded at once on :meth:`close`.
+
+    Subclasses implement :meth:`put`, :meth:`upload_part`, :meth:`complete` and :meth:`cancel`
+    and may implement :meth:`start`.
+    :meth:`upload_part` must be thread-safe when `max_concurrency` is greater than 1.
+
+    :param int part_size: The size of each uploaded part (except the last one)
+    :param str algorithm: The checksum algorithm
+    :param int threshold: The size from which content is uploaded by parts (default to `part_size`)
+    :param int max_concurrency: The maximum number of parts uploaded concurrently
+    '''
+    def __init__(self, part_size=DEFAULT_PART_SIZE, algorithm=hashing.DEFAULT_ALGORITHM,
+                 threshold=None, max_concurrency=1):
+        self.part_size = part_size
+        self.algorithm = algorithm
+        self.threshold = max(threshold or part_size, part_size)
+        self.max_concurrency = max_concurrency
+        self.hasher = hashing.new(algorithm)
+        self.buffer = bytearray()
+        self.parts = 0
+        self.size = 0
+        self.closed = False
+        self.executor = None
+        self.pending = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+        data = to_bytes(data)
+        self.hasher.update(data)
+        self.size += len(data)
+        self.buffer.extend(data)
+        if self.parts or len(self.buffer) >= self.threshold:
+            while len(self.buffer) >= self.part_size:
+                self.flush_part(self.part_size)
+        return len(data)
+
+    def flush_part(self, size):
+        if not self.parts:
+            # Initiate the upload once, before any concurrent part upload
+            self.start()
+        part = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        self.parts += 1
+        if self.max_concurrency <= 1:
+            self.upload_part(self.parts, part)
+            return
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+        while len(self.pending) >= self.max_concurrency:
+            # Bound memory usage: wait for the oldest part before buffering a new one
+            self.pending.pop(0).result()
+        self.pending.append(self.executor.submit(self.upload_part, self.parts, part))
+
+    def wait(self, raise_errors=True):
+        '''Wait for the parts being uploaded'''
+        pending, self.pending = self.pending, []
+        errors = [e for e in (future.exception() for future in pending) if e is not None]
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        if errors and raise_errors:
+            raise errors[0]
+
+    def flush(self):
+        '''Parts are only uploaded once complete'''
+        pass
+
+    @property
+    def checksum(self):
+        '''The checksum of the content written so far expressed in the form `algo:hash`'''
+        return '{0}:{1}'.format(self.algorithm, self.hasher.hexdigest())
+
+    def close(self):
+        '''Upload the remaining content and complete the upload'''
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if not self.parts:
+                self.put(bytes(self.buffer))
+            else:
+                while self.buffer:
+                    self.flush_part(min(len(self.buffer), self.part_size))
+                self.wait()
+                self.complete()
+        except Exception:
+            if self.parts:
+                self.wait(raise_errors=False)
+                self.cancel()
+            raise
+        finally:
+            self.buffer = bytearray()
+
+    def abort(self):
+        '''Discard the buffered content and cleanup the parts already uploaded'''
+        if self.closed:
+            return
+        self.closed = True
+        self.buffer = bytearray()
+        if self.parts:
+            self.wait(raise_errors=False)
+            self.cancel()
+
+    def put(self, data):
+        '''Upload a content smaller than a part in a single request'''
+        raise NotImplementedError('Single upload is not implemented')
+
+    def start(self):
+        '''Initiate an upload by parts (called before the first part upload)'''
+        pass
+
+    def upload_part(self, number, data):
+        '''Upload the part number `number` (starting at 1)'''
+        raise NotImplementedError('Part upload is not implemented')
+
+    def complete(self):
+        '''Assemble the uploaded parts'''
+        raise NotImplementedError('Upload completion is not implemented')
+
+    def cancel(self):
+        '''Remove the uploaded parts'''
+        raise NotImplementedError('Upload cancellation is not implemented')
+
+
+def copy(content, part_writer):
+    '''
+    Stream a content (see :func:`chunks`) to a :class:`PartWriter`,
+    completing the upload or aborting it on error.
+    '''
+    try:
+        for chunk in chunks(content):
+            part_writer.write(chunk)
+    except BaseException:
+        part_writer.abort()
+        raise
+    part_writer.close()
+    return part_writer
+
+
+class RangeReader(io.RawIOBase):
+    '''
+    A lazy seekable file-like object fetching only the requested bytes ranges.
+
+    Wrap it into an :class:`io.BufferedReader` (see :func:`range_reader`) for read-ahead.
+
+    :param callable read_range: Read a range of bytes given `start` and `end` (exclusive,
+        `None` for the end of the file).
+        Must return an empty content when `start` is past the end of the file.
+    :param size: The file size or a callable returning it (only called when seeking from the end)
+    '''
+    def __init__(self, read_range, size=None):
+        super(RangeReader, self).__init__()
+        self.read_range = read_range
+        self._size = size
+        self.position = 0
+
+    @property
+    def size(self):
+        if callable(self._size):
+            self._size = self._size()
+        return self._size
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError('Invalid whence ({0})'.format(whence))
+        if position < 0:
+            raise ValueError('Negative seek position {0}'.format(position))
+        self.position = position
+        return position
+
+    def readinto(self, b):
+        data = self.read_range(self.position, self.position + len(b))
+        size = len(data)
+        b[:size] = data
+        self.position += size
+        return size
+
+    def readall(self):
+        '''Read until the end of the file with a single open-ended range'''
+        data = self.read_range(self.position, None)
+        self.position += len(data)
+        return data
+
+
+class IterReader(io.RawIOBase):
+    '''
+    A file-like object reading from an iterable of binary chunks.
+
+    :param iterable: The chunks iterable (closed with the reader if it has a `close` method)
+    '''
+    def __init__(self, iterable):
+        super(IterReader, self).__init__()
+        self.iterable = iterable
+        self.iterator = iter(iterable)
+        self.pending = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.pending:
+            try:
+                self.pending = next(self.iterator)
+            except StopIteration:
+                return 0
+        size = min(len(b), len(self.pending))
+        b[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+    def close(self):
+        if hasattr(self.iterable, 'close'):
+            self.iterable.close()
+        super(IterReader, self).close()
+
+
+class closing(object):
+    '''
+    Iterate over `iterable` and call `close` once exhausted or closed.
+
+    Unlike a generator, :meth:`close` releases the resource even if iteration never started
+    (ie. HEAD requests or clients disconnecting early, WSGI servers always calling `close()`).
+    '''
+    def __init__(self, iterable, close):
+        self.iterator = iter(iterable)
+        self._close = close
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self.iterator)
+        except StopIteration:
+            self.close()
+            raise
+
+    next = __next__  # Python 2
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._close()
+
+
+class CloseHook(object):
+    '''
+    Proxy an opened file (or a context manager yielding one) calling `callback` once closed.
+
+    :param opened: The file-like object or context manager returned by a backend `open()`
+    :param callable callback: Called without argument when closed or on context exit
+    '''
+    def __init__(self, opened, callback):
+        self.opened = opened
+        self.callback = callback
+
+    def __enter__(self):
+        return self.opened.__enter__()
+
+    def __exit__(self, *exc_info):
+        try:
+            return self.opened.__exit__(*exc_info)
+        finally:
+            self.callback()
+
+    def close(self):
+        try:
+            self.opened.close()
+        finally:
+            self.callback()
+
+    def __getattr__(self, name):
+        return getattr(self.opened, name)
+
+
+def range_reader(read_range, size=None, buffer_size=CHUNK_SIZE):
+    '''
+    Build a buffered seekable reader on top of a :class:`RangeReader`:
+    each request reads at least `buffer_size` bytes ahead.
+    '''
+    return io.BufferedReader(RangeReader(read_range, size), buffer_size)
+
+
+@contextmanager
+def writer(part_writer, mode='w', encoding='utf8'):
+    '''
+    Yield a :class:`PartWriter` (wrapped into a text writer unless in binary `mode`)
+    completing the upload on exit or aborting it on error.
+    '''
+    try:
+        yield part_writer if 'b' in mode else codecs.getwriter(encoding)(part_writer)
+    except BaseException:
+        try:
+            part_writer.abort()
+        except Exception:
+            log.exception('Unable to abort upload')
+        raise
+    part_writer.close()
@@ -55,6 +55,13 @@ def cover(ctx, html=False):
         ctx.run('pytest --cov flask_fs {0}'.format(params), pty=True)
 
 
+@task
+def bench(ctx, size=128):
+    '''Run the S3 upload benchmark against the middlewares (docker)'''
+    with ctx.cd(ROOT):
+        ctx.run('python bench/s3_upload.py --size {0}'.format(size), pty=True)
+
+
 @task
 def tox(ctx):
     '''Run tests against Python versions'''
@@ -2,10 +2,14 @@
 from __future__ import unicode_literals
 
 import hashlib
+import io
+import pytest
 import six
 
 from datetime import datetime
 
+from flask_fs.errors import FileExists, FileNotFound
+
 
 class BackendTestCase(object):
 
@@ -54,6 +58,11 @@ class BackendTestCase(object):
             assert isinstance(data, six.binary_type)
             assert data == content
 
+    def test_open_read_not_found(self):
+        with pytest.raises(FileNotFound):
+            with self.backend.open('file.test') as f:
+                f.read()
+
     def test_open_write_new_file(self, faker):
         filename = 'test.text'
         content = six.text_type(faker.sentence())
@@ -97,6 +106,64 @@ class BackendTestCase(object):
 
         assert self.backend.read('file.test') == six.b(content)
 
+    def test_read_not_found(self):
+        with pytest.raises(FileNotFound):
+            self.backend.read('file.test')
+
+    def test_read_range(self):
+        self.put_file('file.test', b'0123456789')
+
+        assert self.backend.read_range('file.test', 2, 5) == b'234'
+        assert self.backend.read_range('file.test', 7) == b'789'
+        assert self.backend.read_range('file.test', 8, 20) == b'89'
+        assert self.backend.read_range('file.test', 20) == b''
+        assert self.backend.read_range('file.test', 5, 5) == b''
+
+    def test_iter_range(self):
+        self.put_file('file.test', b'0123456789')
+
+        assert b''.join(self.backend.iter_range('file.test', 2, 5)) == b'234'
+        assert b''.join(self.backend.iter_range('file.test', 8, 10)) == b'89'
+
+    def test_read_range_not_found(self):
+        with pytest.raises(FileNotFound):
+            self.backend.read_range('file.test', 0, 10)
+
+    def test_open_seekable(self):
+        self.put_file('file.test', b'0123456789')
+
+        with self.backend.open_seekable('file.test') as f:
+            assert f.seekable()
+            f.seek(-3, io.SEEK_END)
+            assert f.read() == b'789'
+            f.seek(2)
+            assert f.read(3) == b'234'
+            assert f.tell() == 5
+
+    def test_serve(self, app, faker):
+        content = six.text_type(faker.sentence())
+        self.put_file('file.txt', content)
+
+        response = self.backend.serve('file.txt')
+        response.direct_passthrough = False
+
+        assert response.get_data() == six.b(content)
+        assert response.content_length == len(six.b(content))
+        assert response.mimetype == 'text/plain'
+
+    def test_download(self, faker):
+        content = six.binary_type(faker.binary())
+        self.put_file('file.test', content)
+        out = io.BytesIO()
+
+        self.backend.download('file.test', out)
+
+        assert out.getvalue() == content
+
+    def test_download_not_found(self):
+        with pytest.raises(FileNotFound):
+            self.backend.download('file.test', io.BytesIO())
+
     def test_write_text(self, faker):
         content = six.text_type(faker.sentence())
         self.backend.write('test.txt', content)
@@ -115,6 +182,50 @@ class BackendTestCase(object):
 
         self.assert_bin_equal('test.bin', content)
 
+    def test_write_memoryview(self, faker):
+        content = six.binary_type(faker.binary())
+        self.backend.write('test.bin', memoryview(content))
+
+        self.assert_bin_equal('test.bin', content)
+
+    def test_write_iterable(self, faker):
+        content = six.binary_type(faker.binary())
+        self.backend.write('test.bin', (content[i:i + 10] for i in range(0, len(content), 10)))
+
+        self.assert_bin_equal('test.bin', content)
+
+    def test_write_file_no_overwrite_existing_file(self, faker, utils):
+        content = six.text_type(faker.sentence())
+        self.put_file('test.txt', content)
+
+        with pytest.raises(FileExists):
+            self.backend.write('test.txt', utils.file(faker.binary()), overwrite=False)
+
+        self.assert_text_equal('test.txt', content)
+
+    def test_write_no_overwrite(self, faker):
+        content = six.text_type(faker.sentence())
+        self.backend.write('test.txt', content, overwrite=False)
+
+        self.assert_text_equal('test.txt', content)
+
+    def test_write_no_overwrite_existing_file(self, faker):
+        content = six.text_type(faker.sentence())
+        self.put_file('test.txt', content)
+
+        with pytest.raises(FileExists):
+            self.backend.write('test.txt', faker.sentence(), overwrite=False)
+
+        self.assert_text_equal('test.txt', content)
+
+    def test_write_overwrite_existing_file(self, faker):
+        content = six.text_type(faker.sentence())
+        self.put_file('test.txt', faker.sentence())
+
+        self.backend.write('test.txt', content, overwrite=True)
+
+        self.assert_text_equal('test.txt', content)
+
     def test_write_with_prefix(self, faker):
         content = six.text_type(faker.sentence())
         self.backend.write('some/path/to/test.txt', content)
@@ -140,6 +251,15 @@ class BackendTestCase(object):
         assert not self.file_exists('test/file.02')
         assert not self.file_exists('test')
 
+    def test_delete_keep_siblings(self, faker):
+        self.put_file('file.test', faker.sentence())
+        self.put_file('file.test-backup', faker.sentence())
+
+        self.backend.delete('file.test')
+
+        assert not self.file_exists('file.test')
+        assert self.file_exists('file.test-backup')
+
     def test_save_content(self, faker, utils):
         content = six.text_type(faker.sentence())
         storage = utils.filestorage('test.txt', content)
@@ -156,6 +276,29 @@ class BackendTestCase(object):
 
         self.assert_bin_equal('test.png', content)
 
+    def test_save_no_overwrite_existing_file(self, faker, utils):
+        content = six.text_type(faker.sentence())
+        self.put_file('test.txt', content)
+        storage = utils.filestorage('test.txt', faker.sentence())
+
+        with pytest.raises(FileExists):
+            self.backend.save(storage, 'test.txt', overwrite=False)
+
+        self.assert_text_equal('test.txt', content)
+
+    def test_save_metadata(self, faker, utils):
+        content = six.text_type(faker.sentence())
+        storage = utils.filestorage('test.txt', content)
+        hasher = getattr(hashlib, self.backend.checksum_algorithm)
+
+        saved = self.backend.save(storage, 'test.txt')
+
+        assert saved == 'test.txt'
+        assert saved.checksum == '{0}:{1}'.format(self.backend.checksum_algorithm,
+                                                  hasher(content.encode('utf8')).hexdigest())
+        assert saved.size == len(content)
+        assert saved.mime == 'text/plain'
+
     def test_save_with_filename(self, faker, utils):
         filename = 'somewhere/test.test'
         content = six.text_type(faker.sentence())
@@ -184,6 +327,20 @@ class BackendTestCase(object):
         assert metadata['mime'] == 'text/plain'
         assert isinstance(metadata['modified'], datetime)
 
+    @pytest.mark.parametrize('algorithm', ['sha1', 'sha256'])
+    def test_metadata_stored_checksum(self, app, faker, algorithm):
+        content = six.text_type(faker.sentence())
+        hashed = getattr(hashlib, algorithm)(content.encode('utf8')).hexdigest()
+        self.backend.checksum_algorithm = algorithm
+        self.backend.write('file.txt', content)
+
+        metadata = self.backend.metadata('file.txt')
+        assert metadata['checksum'] == '{0}:{1}'.format(algorithm, hashed)
+
+    def test_metadata_not_found(self):
+        with pytest.raises(FileNotFound):
+            self.backend.metadata('file.txt')
+
     def test_metadata_unknown_mime(self, app, faker):
         content = six.text_type(faker.sentence())
         self.put_file('file.whatever', content)
@@ -191,6 +348,36 @@ class BackendTestCase(object):
         metadata = self.backend.metadata('file.whatever')
         assert metadata['mime'] in ('application/octet-stream', 'text/plain')
 
+    def test_exists_many(self):
+        self.put_file('file.test', 'test')
+
+        result = self.backend.exists_many(['file.test', 'other.test'])
+
+        assert result == {'file.test': True, 'other.test': False}
+
+    def test_read_many(self, faker):
+        content = six.text_type(faker.sentence())
+        self.put_file('file.test', content)
+
+        result = self.backend.read_many(['file.test', 'other.test'])
+
+        assert result == {'file.test': six.b(content)}
+        assert isinstance(result.errors['other.test'], FileNotFound)
+
+    def test_delete_many(self, faker):
+        self.put_file('first.test', faker.sentence())
+        self.put_file('second.test', faker.sentence())
+        self.put_file('dir/third.test', faker.sentence())
+        self.put_file('kept.test', faker.sentence())
+
+        result = self.backend.delete_many(['first.test', 'second.test', 'dir'])
+
+        assert result.ok
+        assert not self.file_exists('first.test')
+        assert not self.file_exists('second.test')
+        assert not self.file_exists('dir/third.test')
+        assert self.file_exists('kept.test')
+
     def test_copy(self, faker):
         content = faker.sentence()
         self.put_file('file.test', content)
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import io
+import os
+import threading
+
+from contextlib import contextmanager
+
+from flask_fs.backends import BaseBackend, client_property, thread_client_property
+from flask_fs.errors import OperationNotSupported
+from flask_fs.storage import Config
+
+import pytest
+
+
+class Tester(object):
+    def __init__(self):
+        self.built = 0
+
+    @client_property
+    def client(self):
+        self.built += 1
+        return object()
+
+    @thread_client_property
+    def thread_client(self):
+        self.built += 1
+        return object()
+
+
+def test_client_property_cached():
+    tester = Tester()
+    client = tester.client
+
+    assert tester.client is client
+    assert tester.built == 1
+
+
+def test_client_property_rebuilt_after_fork(mocker):
+    tester = Tester()
+    client = tester.client
+
+    mocker.patch('flask_fs.backends.current_pid', return_value=-1)
+
+    assert tester.client is not client
+    assert tester.built == 2
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='Requires os.fork()')
+def test_client_property_in_forked_process():
+    tester = Tester()
+    client = tester.client
+    read, write = os.pipe()
+
+    pid = os.fork()
+    if pid == 0:  # pragma: no cover
+        rebuilt = tester.client is not client and tester.client is tester.client
+        os.write(write, b'1' if rebuilt else b'0')
+        os._exit(0)
+
+    os.waitpid(pid, 0)
+    assert os.read(read, 1) == b'1'
+    assert tester.client is client
+
+
+def test_thread_client_property():
+    tester = Tester()
+    clients = []
+
+    def get_client():
+        clients.append(tester.thread_client)
+        clients.append(tester.thread_client)
+
+    threads = [threading.Thread(target=get_client) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert clients[0] is clients[1]
+    assert clients[2] is clients[3]
+    assert clients[0] is not clients[2]
+    assert tester.built == 2
+
+
+def test_thread_client_property_rebuilt_after_fork(mocker):
+    tester = Tester()
+    client = tester.thread_client
+
+    mocker.patch('flask_fs.backends.current_pid', return_value=-1)
+
+    assert tester.thread_client is not client
+
+
+class StreamingBackend(BaseBackend):
+    def __init__(self, content, **config):
+        super(StreamingBackend, self).__init__('test', Config(config))
+        self.content = content
+
+    @contextmanager
+    def open(self, filename, mode='r', encoding='utf8'):
+        yield io.BytesIO(self.content)
+
+    def get_metadata(self, filename):
+        return {'size': len(self.content), 'mime': None}
+
+
+def test_default_serve_streams_by_chunks(app):
+    backend = StreamingBackend(b'0123456789', serve_chunk_size=4)
+
+    response = backend.serve('file.txt')
+
+    assert response.is_streamed
+    assert response.content_length == 10
+    assert response.mimetype == 'text/plain'
+    assert list(response.response) == [b'0123', b'4567', b'89']
+
+
+def test_default_serve_range(app):
+    backend = StreamingBackend(b'0123456789', serve_chunk_size=4)
+
+    with app.test_request_context('/', headers={'Range': 'bytes=2-5'}):
+        response = backend.serve('file.txt')
+
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == 'bytes 2-5/10'
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    assert b''.join(response.response) == b'2345'
+
+
+class SigningBackend(BaseBackend):
+    def __init__(self, **config):
+        super(SigningBackend, self).__init__('test', Config(config))
+        self.signed = 0
+
+    def sign_url(self, filename, expires):
+        self.signed += 1
+        return 'https://signed/{0}?expires={1}&n={2}'.format(filename, expires, self.signed)
+
+
+def test_signed_url_cached_until_expiry(mocker):
+    clock = mocker.patch('flask_fs.cache.clock', return_value=1000)
+    backend = SigningBackend(signed_url_expires=600)
+
+    url = backend.signed_url('file.txt')
+    assert url == 'https://signed/file.txt?expires=600&n=1'
+
+    clock.return_value = 1500
+    assert backend.signed_url('file.txt') == url
+    assert backend.signed_url('file.txt', expires=60) == 'https://signed/file.txt?expires=60&n=2'
+
+    # Renewed shortly before expiry
+    clock.return_value = 1550
+    assert backend.signed_url('file.txt') == 'https://signed/file.txt?expires=600&n=3'
+
+
+def test_signed_url_not_supported():
+    with pytest.raises(OperationNotSupported):
+        BaseBackend('test', Config()).signed_url('file.txt')
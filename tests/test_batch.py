@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import threading
+
+from flask import current_app
+
+from flask_fs.batch import BatchResult, executor, fan_out
+
+import pytest
+
+
+@pytest.mark.parametrize('max_workers', [1, 4])
+def test_fan_out(max_workers):
+    result = fan_out(lambda x: x * 2, [1, 2, 3], max_workers)
+
+    assert isinstance(result, BatchResult)
+    assert result.ok
+    assert list(result.items()) == [(1, 2), (2, 4), (3, 6)]
+
+
+@pytest.mark.parametrize('max_workers', [1, 4])
+def test_fan_out_errors(max_workers):
+    def func(x):
+        if x == 2:
+            raise ValueError('error')
+        return x
+
+    result = fan_out(func, [1, 2, 3], max_workers)
+
+    assert not result.ok
+    assert list(result.items()) == [(1, 1), (3, 3)]
+    assert list(result.errors.keys()) == [2]
+    assert isinstance(result.errors[2], ValueError)
+
+
+def test_fan_out_key():
+    result = fan_out(lambda item: item[1], [('a', 1), ('b', 2)], key=lambda item: item[0])
+    assert result == {'a': 1, 'b': 2}
+
+
+def test_fan_out_bounded_concurrency():
+    lock = threading.Lock()
+    state = {'running': 0, 'max': 0}
+    barrier = threading.Event()
+
+    def func(x):
+        with lock:
+            state['running'] += 1
+            state['max'] = max(state['max'], state['running'])
+        barrier.wait(0.01)
+        with lock:
+            state['running'] -= 1
+        return x
+
+    result = fan_out(func, range(20), max_workers=3)
+
+    assert result.ok
+    assert len(result) == 20
+    assert state['max'] <= 3
+
+
+def test_batch_result_update_from():
+    first = BatchResult([('a', 1)])
+    second = BatchResult([('b', 2)])
+    second.errors['c'] = ValueError()
+
+    first.update_from(second)
+
+    assert first == {'a': 1, 'b': 2}
+    assert list(first.errors.keys()) == ['c']
+
+
+def test_fan_out_shared_executor_reuses_threads():
+    pool = executor(2)
+    first = fan_out(lambda x: threading.current_thread().ident, range(10), executor=pool)
+    second = fan_out(lambda x: threading.current_thread().ident, range(10), executor=pool)
+    pool.shutdown()
+
+    assert len(set(first.values()) | set(second.values())) <= 2
+
+
+def test_fan_out_nested_in_shared_executor():
+    pool = executor(1)
+
+    def nested(x):
+        return sum(fan_out(lambda y: y, range(x), executor=pool).values())
+
+    result = fan_out(nested, [3, 4], max_workers=2, executor=pool)
+    pool.shutdown()
+
+    assert result == {3: 3, 4: 6}
+
+
+def test_fan_out_pushes_app_context(app):
+    with app.app_context():
+        result = fan_out(lambda x: current_app.name, [1, 2], max_workers=2)
+
+    assert result == {1: app.name, 2: app.name}
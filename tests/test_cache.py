@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from flask_fs import cache
+from flask_fs.cache import MemoryCache, MemoryMetadataCache, MetadataCache
+from flask_fs.storage import Config
+
+
+def test_get_missing():
+    metadata_cache = MemoryMetadataCache()
+    assert metadata_cache.get('file.test') is None
+
+
+def test_set_and_get():
+    metadata_cache = MemoryMetadataCache()
+    metadata_cache.set('file.test', {'size': 42})
+    assert metadata_cache.get('file.test') == {'size': 42}
+
+
+def test_ttl_expiration(mocker):
+    clock = mocker.patch('flask_fs.cache.clock', return_value=1000)
+    metadata_cache = MemoryMetadataCache(ttl=10)
+    metadata_cache.set('file.test', {'size': 42})
+
+    clock.return_value = 1009
+    assert metadata_cache.get('file.test') == {'size': 42}
+
+    clock.return_value = 1011
+    assert metadata_cache.get('file.test') is None
+    assert len(metadata_cache) == 0
+
+
+def test_lru_eviction():
+    metadata_cache = MemoryMetadataCache(size=2)
+    metadata_cache.set('first.test', {})
+    metadata_cache.set('second.test', {})
+    metadata_cache.get('first.test')  # Mark as recently used
+    metadata_cache.set('third.test', {})
+
+    assert len(metadata_cache) == 2
+    assert metadata_cache.get('first.test') is not None
+    assert metadata_cache.get('second.test') is None
+    assert metadata_cache.get('third.test') is not None
+
+
+def test_memory_cache_without_ttl(mocker):
+    clock = mocker.patch('flask_fs.cache.clock', return_value=1000)
+    memory_cache = MemoryCache(size=2)
+    memory_cache.set(('file.test', 60), 'value')
+
+    clock.return_value = 10 ** 9
+    assert memory_cache.get(('file.test', 60)) == 'value'
+    assert not isinstance(memory_cache, MetadataCache)
+
+
+def test_delete():
+    metadata_cache = MemoryMetadataCache()
+    metadata_cache.set('file.test', {})
+    metadata_cache.delete('file.test')
+    metadata_cache.delete('unknown.test')
+    assert metadata_cache.get('file.test') is None
+
+
+def test_delete_prefix():
+    metadata_cache = MemoryMetadataCache()
+    metadata_cache.set('dir/file.test', {})
+    metadata_cache.set('dir/sub/file.test', {})
+    metadata_cache.set('dir.test', {})
+    metadata_cache.delete_prefix('dir/')
+
+    assert metadata_cache.get('dir/file.test') is None
+    assert metadata_cache.get('dir/sub/file.test') is None
+    assert metadata_cache.get('dir.test') is not None
+
+
+def test_from_config_disabled():
+    assert cache.from_config(Config()) is None
+
+
+def test_from_config_memory():
+    metadata_cache = cache.from_config(Config(metadata_cache=True,
+                                              metadata_cache_ttl=10,
+                                              metadata_cache_size=5))
+    assert isinstance(metadata_cache, MemoryMetadataCache)
+    assert metadata_cache.ttl == 10
+    assert metadata_cache.size == 5
+
+
+def test_from_config_custom():
+    class CustomCache(MetadataCache):
+        pass
+
+    custom = CustomCache()
+    assert cache.from_config(Config(metadata_cache=custom)) is custom
+
+
+def test_from_config_empty_memory_instance():
+    metadata_cache = MemoryMetadataCache()
+    assert cache.from_config(Config(metadata_cache=metadata_cache)) is metadata_cache
+
+
+def test_from_config_explicitly_disabled():
+    assert cache.from_config(Config(metadata_cache=False)) is None
@@ -5,8 +5,11 @@ from os.path import join
 
 from flask import url_for
 
+import flask_fs
+
 from flask_fs import Storage, DEFAULTS, NONE
 from flask_fs.backends.local import LocalBackend
+from flask_fs.storage import index_config
 
 
 def test_default_configuration(app):
@@ -112,3 +115,34 @@ def test_configurable_extensions(app):
     files = Storage('files', NONE)
     app.configure(files, FS_ALLOW=['txt'])
     assert files.extension_allowed('txt')
+
+
+def test_index_config():
+    index = index_config({
+        'FS_BACKEND': 'local',
+        'FS_S3_ACCESS_KEY': 'key',
+        'MY_FS_STORAGE_FS_URL': 'http://somewhere.net/',
+        'FILES_FS_ROOT': '/root',
+        'OTHER': 'value',
+    })
+
+    assert index['FS_S3_'] == {'access_key': 'key'}
+    assert index['FILES_FS_'] == {'root': '/root'}
+    assert index['MY_FS_STORAGE_FS_'] == {'url': 'http://somewhere.net/'}
+    assert 'OTHER' not in str(index)
+
+
+def test_storage_name_with_fs_marker(app):
+    files = Storage('my_fs_files')
+    app.configure(files, MY_FS_FILES_FS_URL='http://somewhere.net/files/')
+    assert files.base_url == 'http://somewhere.net/files/'
+
+
+def test_configuration_indexed_once(app, mocker):
+    index_config = mocker.spy(flask_fs, 'index_config')
+    storages = [Storage('storage{0}'.format(i)) for i in range(5)]
+    app.configure(*storages, STORAGE3_FS_URL='http://somewhere.net/3/')
+
+    assert index_config.call_count == 1
+    assert storages[3].config.url == 'http://somewhere.net/3/'
+    assert 'url' not in storages[2].config
@@ -53,3 +53,36 @@ def test_mime_default_to_none():
 def test_mime_default_to_custom():
     default = 'application/octet-stream'
     assert files.mime('test', default=default) == default
+
+
+def test_sniff_signature(pngfile, jpgfile):
+    with open(pngfile, 'rb') as f:
+        assert files.sniff(f.read(32)) == 'image/png'
+    with open(jpgfile, 'rb') as f:
+        assert files.sniff(f.read(32), 'misnamed.png') == 'image/jpeg'
+
+
+def test_sniff_container_use_filename():
+    assert files.sniff(b'PK\x03\x04', 'test.zip') == 'application/zip'
+    assert files.sniff(b'PK\x03\x04', 'test.xlsx') == files.mime('test.xlsx')
+    assert files.sniff(b'PK\x03\x04') == 'application/zip'
+
+
+def test_sniff_fallback_to_filename():
+    assert files.sniff(b'some text', 'test.txt') == 'text/plain'
+    assert files.sniff(b'some text') is None
+    default = 'application/octet-stream'
+    assert files.sniff(b'some text', default=default) == default
+
+
+def test_saved_file():
+    saved = files.SavedFile('test.txt', checksum='sha1:abc', size=3, mime='text/plain')
+    assert saved == 'test.txt'
+    assert saved.filename == 'test.txt'
+    assert saved.metadata == {'checksum': 'sha1:abc', 'size': 3, 'mime': 'text/plain'}
+
+
+def test_saved_file_without_metadata():
+    saved = files.SavedFile('test.txt')
+    assert saved == 'test.txt'
+    assert saved.metadata == {}
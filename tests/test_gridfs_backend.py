@@ -72,6 +72,16 @@ class GridFsBackendTest(BackendTestCase):
         self.backend.delete(filename)
         assert not self.file_exists(filename)
 
+    def test_copy_over_existing_with_unique_index(self):
+        self.backend.write('source.txt', b'source', overwrite=False)
+        self.backend.write('target.txt', b'target', overwrite=False)
+
+        self.backend.copy('source.txt', 'target.txt')
+
+        assert self.get_file('target.txt') == b'source'
+        assert self.gfs.find({'filename': 'target.txt'}).count() == 1
+        assert self.db['test'].chunks.count_documents({}) == 2
+
     def test_write_pngimage(self, pngimage, utils):
         filename = 'test.png'
         content = six.binary_type(pngimage.read())
@@ -95,3 +105,132 @@ class GridFsBackendTest(BackendTestCase):
             assert f.content_type == content_type
 
         self.assert_bin_equal(filename, content)
+
+
+def test_lazy_connection(mocker):
+    client = mocker.patch('flask_fs.backends.gridfs.MongoClient')
+    backend = GridFsBackend('test', Config(mongo_url='mongodb://somewhere', mongo_db=TEST_DB))
+    assert not client.called
+
+    backend.warmup()
+
+    client.assert_called_once_with('mongodb://somewhere')
+    client.return_value.admin.command.assert_called_once_with('ping')
+
+
+def test_delete_many_batched_queries(mocker):
+    client = mocker.patch('flask_fs.backends.gridfs.MongoClient')
+    collection = client.return_value[TEST_DB]['test']
+    collection.files.find.return_value = [
+        {'_id': 1, 'filename': 'a.png'},
+        {'_id': 2, 'filename': 'dir/b.png'},
+        {'_id': 3, 'filename': 'dir/sub/c.png'},
+    ]
+    backend = GridFsBackend('test', Config(mongo_url='mongodb://somewhere', mongo_db=TEST_DB))
+
+    result = backend.delete_many(['a.png', 'dir'])
+
+    assert result.ok
+    query = collection.files.find.call_args[0][0]
+    assert query == {'$or': [
+        {'filename': {'$in': ['a.png', 'dir']}},
+        {'filename': {'$regex': r'^(?:a\.png/|dir/)'}},
+    ]}
+    collection.files.delete_many.assert_called_once_with({'_id': {'$in': [1, 2, 3]}})
+    collection.chunks.delete_many.assert_called_once_with({'files_id': {'$in': [1, 2, 3]}})
+
+
+def test_open_write_stream(mocker):
+    fs = mocker.patch('flask_fs.backends.gridfs.GridFS').return_value
+    client = mocker.patch('flask_fs.backends.gridfs.MongoClient')
+    client.return_value[TEST_DB]['test'].files.index_information.return_value = {}
+    grid_in = fs.new_file.return_value
+    backend = GridFsBackend('test', Config(mongo_url='mongodb://somewhere', mongo_db=TEST_DB,
+                                           part_size=4))
+
+    with backend.open('file.txt', 'w') as f:
+        f.write('abcdefghij')
+
+    fs.new_file.assert_called_once_with(filename='file.txt', encoding='utf8')
+    assert [c[0][0] for c in grid_in.write.call_args_list] == [b'abcd', b'efgh', b'ij']
+    assert grid_in.metadata == {'checksum': backend.compute_checksum(b'abcdefghij')}
+    grid_in.close.assert_called_once_with()
+    assert not grid_in.abort.called
+
+
+def test_open_write_stream_abort(mocker):
+    fs = mocker.patch('flask_fs.backends.gridfs.GridFS').return_value
+    mocker.patch('flask_fs.backends.gridfs.MongoClient')
+    grid_in = fs.new_file.return_value
+    backend = GridFsBackend('test', Config(mongo_url='mongodb://somewhere', mongo_db=TEST_DB,
+                                           part_size=4))
+
+    with pytest.raises(ValueError):
+        with backend.open('file.txt', 'wb') as f:
+            f.write(b'abcdefghij')
+            raise ValueError()
+
+    grid_in.abort.assert_called_once_with()
+    assert not grid_in.close.called
+
+
+def test_open_write_stream_replaces_after_commit(mocker):
+    fs = mocker.patch('flask_fs.backends.gridfs.GridFS').return_value
+    client = mocker.patch('flask_fs.backends.gridfs.MongoClient')
+    files = client.return_value[TEST_DB]['test'].files
+    files.index_information.return_value = {
+        'filename_1': {'key': [('filename', 1)], 'unique': True},
+    }
+    calls = []
+    grid_in = fs.new_file.return_value
+    grid_in._id = 'new'
+    grid_in.close.side_effect = lambda: calls.append('commit')
+    fs.find.return_value = [mocker.Mock(_id='old')]
+    fs.delete.side_effect = lambda file_id: calls.append(('delete', file_id))
+    files.update_one.side_effect = lambda query, update: calls.append(('rename', query, update))
+    backend = GridFsBackend('test', Config(mongo_url='mongodb://somewhere', mongo_db=TEST_DB))
+
+    with backend.open('file.txt', 'wb') as f:
+        f.write(b'abc')
+
+    temporary = fs.new_file.call_args[1]['filename']
+    assert temporary != 'file.txt' and temporary.startswith('file.txt.')
+    fs.find.assert_called_once_with({'filename': 'file.txt'})
+    assert calls == [
+        'commit',
+        ('delete', 'old'),
+        ('rename', {'_id': 'new'}, {'$set': {'filename': 'file.txt'}}),
+    ]
+
+
+def test_copy_replaces_existing_target_with_unique_index(mocker):
+    fs = mocker.patch('flask_fs.backends.gridfs.GridFS').return_value
+    client = mocker.patch('flask_fs.backends.gridfs.MongoClient')
+    files = client.return_value[TEST_DB]['test'].files
+    files.index_information.return_value = {
+        'filename_1': {'key': [('filename', 1)], 'unique': True},
+    }
+    src = fs.get_last_version.return_value
+    grid_in = fs.new_file.return_value
+    grid_in._id = 'new'
+    fs.find.return_value = [mocker.Mock(_id='old')]
+    backend = GridFsBackend('test', Config(mongo_url='mongodb://somewhere', mongo_db=TEST_DB))
+
+    backend.copy('source.txt', 'target.txt')
+
+    temporary = fs.new_file.call_args[1]['filename']
+    assert temporary.startswith('target.txt.')
+    grid_in.write.assert_called_once_with(src)
+    fs.delete.assert_called_once_with('old')
+    files.update_one.assert_called_once_with({'_id': 'new'}, {'$set': {'filename': 'target.txt'}})
+
+
+def test_has_unique_index_cached(mocker):
+    client = mocker.patch('flask_fs.backends.gridfs.MongoClient')
+    files = client.return_value[TEST_DB]['test'].files
+    files.index_information.return_value = {'_id_': {'key': [('_id', 1)]}}
+    backend = GridFsBackend('test', Config(mongo_url='mongodb://somewhere', mongo_db=TEST_DB))
+
+    assert not backend.has_unique_index()
+    assert not backend.has_unique_index()
+    files.index_information.assert_called_once_with()
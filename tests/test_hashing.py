@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import hashlib
+import io
+
+from flask_fs import hashing
+from flask_fs.files import SavedFile
+
+import pytest
+
+
+@pytest.mark.parametrize('algorithm', hashing.ALGORITHMS)
+def test_hash_file(algorithm, faker):
+    content = faker.binary()
+    expected = hashlib.new(algorithm, content).hexdigest()
+    assert hashing.hash_file(io.BytesIO(content), algorithm) == expected
+
+
+def test_unsupported_algorithm():
+    with pytest.raises(ValueError):
+        hashing.new('unknown')
+
+
+@pytest.mark.parametrize('algorithm', hashing.ALGORITHMS)
+def test_hashing_reader(algorithm, faker):
+    content = faker.binary()
+    reader = hashing.HashingReader(io.BytesIO(content), algorithm, 'file.bin')
+
+    assert reader.read(10) == content[:10]
+    assert reader.read() == content[10:]
+    assert reader.read() == b''
+
+    expected = hashlib.new(algorithm, content).hexdigest()
+    assert reader.checksum == '{0}:{1}'.format(algorithm, expected)
+    assert reader.size == len(content)
+
+
+def test_hashing_reader_filestorage(utils, pngfile):
+    with open(pngfile, 'rb') as f:
+        content = f.read()
+    wfs = utils.filestorage('flask.png', content, 'image/png')
+    reader = hashing.HashingReader(wfs, filename='misnamed.txt')
+
+    assert reader.read() == content
+    assert reader.content_type == 'image/png'
+    assert reader.mime == 'image/png'
+
+
+def test_hashing_reader_text(faker):
+    content = faker.sentence()
+    reader = hashing.HashingReader(io.StringIO(content), filename='file.txt')
+
+    assert reader.read() == content.encode('utf8')
+    assert reader.checksum == 'sha1:{0}'.format(hashlib.sha1(content.encode('utf8')).hexdigest())
+    assert reader.mime == 'text/plain'
+
+
+def test_hashing_reader_saved(faker):
+    content = faker.binary()
+    reader = hashing.HashingReader(io.BytesIO(content), filename='file.bin')
+    reader.read()
+
+    saved = reader.saved('other.bin')
+    assert isinstance(saved, SavedFile)
+    assert saved == 'other.bin'
+    assert saved.checksum == reader.checksum
+    assert saved.size == len(content)
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+import subprocess
+import sys
+
+import pytest
+
+#: Modules which should never be imported by a bare `import flask_fs`
+HEAVY_MODULES = ('pkg_resources', 'PIL', 'boto3', 'swiftclient', 'pymongo', 'gridfs')
+
+SCRIPT = '''
+import json, sys
+import {module}
+print(json.dumps(list(sys.modules)))
+'''
+
+
+def imported_modules(module):
+    output = subprocess.check_output([sys.executable, '-c', SCRIPT.format(module=module)])
+    return set(json.loads(output.decode('utf8')))
+
+
+@pytest.mark.parametrize('module', ['flask_fs', 'flask_fs.images'])
+def test_no_heavy_import(module):
+    modules = imported_modules(module)
+    for heavy in HEAVY_MODULES:
+        assert heavy not in modules
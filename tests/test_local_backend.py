@@ -1,12 +1,15 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import hashlib
 import pytest
 import os
+import six
 
 from .test_backend_mixin import BackendTestCase
 
 from flask_fs.backends.local import LocalBackend
+from flask_fs.errors import FileNotFound
 from flask_fs.storage import Config
 
 
@@ -53,3 +56,85 @@ class LocalBackendTest(BackendTestCase):
         root = self.test_dir.join('default')
         backend = LocalBackend('default', Config({}))
         assert backend.root == root
+
+    @pytest.fixture
+    def xattrs(self):
+        probe = self.test_dir.join('probe')
+        probe.write('')
+        try:
+            os.setxattr(str(probe), 'user.probe', b'')
+        except (AttributeError, OSError):
+            pytest.skip('Extended attributes are not supported')
+        finally:
+            probe.remove()
+
+    def test_metadata_checksum_is_persisted(self, app, faker, mocker, xattrs):
+        content = six.text_type(faker.sentence())
+        self.put_file('file.txt', content)
+        hashed = hashlib.sha1(content.encode('utf8')).hexdigest()
+
+        assert self.backend.metadata('file.txt')['checksum'] == 'sha1:{0}'.format(hashed)
+
+        hasher = mocker.patch('flask_fs.hashing.hash_file')
+        assert self.backend.metadata('file.txt')['checksum'] == 'sha1:{0}'.format(hashed)
+        assert not hasher.called
+
+    def test_metadata_checksum_from_write(self, app, faker, mocker, xattrs):
+        content = six.text_type(faker.sentence())
+        hashed = hashlib.sha1(content.encode('utf8')).hexdigest()
+        hasher = mocker.patch('flask_fs.hashing.hash_file')
+
+        self.backend.write('file.txt', content)
+
+        assert self.backend.metadata('file.txt')['checksum'] == 'sha1:{0}'.format(hashed)
+        assert not hasher.called
+
+    def test_metadata_checksum_on_modified_file(self, app, faker, xattrs):
+        self.backend.write('file.txt', faker.sentence())
+        content = six.text_type(faker.sentence()) + ' modified'
+        self.put_file('file.txt', content)
+        hashed = hashlib.sha1(content.encode('utf8')).hexdigest()
+
+        assert self.backend.metadata('file.txt')['checksum'] == 'sha1:{0}'.format(hashed)
+
+    def test_serve_x_accel_redirect(self, app):
+        self.put_file('some dir/file.txt', b'0123456789')
+        self.config['sendfile'] = 'x-accel-redirect'
+        backend = LocalBackend('test', self.config)
+
+        response = backend.serve('some dir/file.txt')
+
+        assert response.headers['X-Accel-Redirect'] == '/test/some%20dir/file.txt'
+        assert response.mimetype == 'text/plain'
+        assert response.content_length == 10
+        assert response.get_data() == b''
+
+    def test_serve_x_accel_redirect_location(self, app):
+        self.put_file('file.txt', b'0123456789')
+        self.config.update(sendfile='x-accel-redirect', sendfile_location='/internal/files')
+        backend = LocalBackend('test', self.config)
+
+        response = backend.serve('file.txt')
+
+        assert response.headers['X-Accel-Redirect'] == '/internal/files/file.txt'
+
+    def test_serve_x_sendfile(self, app):
+        self.put_file('file.txt', b'0123456789')
+        self.config['sendfile'] = 'x-sendfile'
+        backend = LocalBackend('test', self.config)
+
+        response = backend.serve('file.txt')
+
+        assert response.headers['X-Sendfile'] == self.filename('file.txt')
+        assert response.get_data() == b''
+
+    def test_serve_sendfile_not_found(self, app):
+        self.config['sendfile'] = 'x-sendfile'
+        backend = LocalBackend('test', self.config)
+
+        with pytest.raises(FileNotFound):
+            backend.serve('file.txt')
+
+    def test_unsupported_sendfile(self):
+        with pytest.raises(ValueError):
+            LocalBackend('test', Config({'sendfile': 'x-unknown'}))
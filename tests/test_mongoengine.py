@@ -226,6 +226,43 @@ class FileFieldTest(MongoEngineTestCase):
         tester = Tester.objects.get(id=tester.id)
         assert tester.file.filename == expected_filename
 
+    def test_save_with_metadata(self, storage, utils):
+        class Tester(db.Document):
+            file = FileField(fs=storage, store_metadata=True)
+
+        filename = 'test.txt'
+
+        tester = Tester()
+        tester.file.save(utils.filestorage(filename, 'this is a stest'))
+        tester.validate()
+
+        metadata = storage.metadata(filename)
+        assert tester.to_mongo() == {
+            'file': {
+                'filename': filename,
+                'checksum': metadata['checksum'],
+                'size': 15,
+                'mime': 'text/plain',
+            }
+        }
+
+        tester.save()
+        tester = Tester.objects.get(id=tester.id)
+        assert tester.file.filename == filename
+        assert tester.file.checksum == metadata['checksum']
+        assert tester.file.size == 15
+        assert tester.file.mime == 'text/plain'
+
+    def test_set_filename_resets_metadata(self, storage, utils):
+        class Tester(db.Document):
+            file = FileField(fs=storage, store_metadata=True)
+
+        tester = Tester()
+        tester.file.save(utils.filestorage('test.txt', 'this is a stest'))
+        tester.file.filename = 'other.txt'
+
+        assert tester.to_mongo() == {'file': {'filename': 'other.txt'}}
+
 
 class ImageFieldTestMixin(MongoEngineTestCase):
     @pytest.fixture
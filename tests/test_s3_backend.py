@@ -1,15 +1,24 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import io
 import logging
+import threading
+import time
+
+from datetime import datetime
 
 from .test_backend_mixin import BackendTestCase
 
 from flask_fs.backends.s3 import S3Backend
+from flask_fs.errors import FileExists, FileNotFound, FSError
 from flask_fs.storage import Config
 
 import boto3
 
+from dateutil import tz
+
+from botocore.awsrequest import AWSResponse
 from botocore.exceptions import ClientError
 
 import pytest
@@ -77,3 +86,431 @@ class S3BackendTest(BackendTestCase):
     #     backend = LocalBackend('default', Config({}))
     #     with self.app.app_context():
     #         self.assertEqual(backend.root, root)
+
+
+def test_lazy_connection(mocker):
+    session = mocker.patch('boto3.session.Session')
+    backend = S3Backend('test', Config(endpoint=S3_SERVER, region=S3_REGION,
+                                       access_key=S3_ACCESS_KEY, secret_key=S3_SECRET_KEY))
+    assert not session.called
+
+    backend.warmup()
+
+    session.return_value.resource.assert_called_once_with(
+        's3', config=backend.s3config, endpoint_url=S3_SERVER, region_name=S3_REGION,
+        aws_access_key_id=S3_ACCESS_KEY, aws_secret_access_key=S3_SECRET_KEY
+    )
+    bucket = session.return_value.resource.return_value.Bucket
+    bucket.assert_called_with('test')
+    bucket.return_value.create.assert_called_once_with()
+
+
+def test_client_per_thread(mocker):
+    sessions = []
+
+    def new_session():
+        sessions.append(mocker.MagicMock())
+        return sessions[-1]
+
+    mocker.patch('boto3.session.Session', side_effect=new_session)
+    backend = S3Backend('test', Config(endpoint=S3_SERVER, region=S3_REGION,
+                                       access_key=S3_ACCESS_KEY, secret_key=S3_SECRET_KEY))
+    buckets = []
+
+    def get_bucket():
+        buckets.append(backend.bucket)
+
+    get_bucket()
+    thread = threading.Thread(target=get_bucket)
+    thread.start()
+    thread.join()
+
+    assert backend.bucket is buckets[0]
+    assert buckets[0] is not buckets[1]
+    assert len(sessions) == 2
+    # Bucket is only created once per process
+    assert sum(s.resource.return_value.Bucket.return_value.create.call_count
+               for s in sessions) == 1
+
+
+def test_client_settings():
+    backend = S3Backend('test', Config(endpoint=S3_SERVER, region=S3_REGION,
+                                       access_key=S3_ACCESS_KEY, secret_key=S3_SECRET_KEY,
+                                       max_pool_connections=42, tcp_keepalive=True))
+    assert backend.s3config.max_pool_connections == 42
+    assert backend.s3config.tcp_keepalive is True
+    assert backend.s3config.signature_version == 's3v4'
+
+
+@pytest.fixture
+def s3client(mocker):
+    session = mocker.patch('boto3.session.Session')
+    bucket = session.return_value.resource.return_value.Bucket.return_value
+    client = bucket.meta.client
+    client.delete_objects.return_value = {}
+    return client
+
+
+def paginate(*pages):
+    return lambda Bucket, Prefix: [{'Contents': [{'Key': key} for key in page]} for page in pages]
+
+
+def test_delete_exact_key(s3client):
+    backend = S3Backend('test', Config(endpoint=S3_SERVER, region=S3_REGION,
+                                       access_key=S3_ACCESS_KEY, secret_key=S3_SECRET_KEY))
+    paginator = s3client.get_paginator.return_value
+    paginator.paginate.side_effect = paginate()
+
+    backend.delete('a.png')
+
+    paginator.paginate.assert_called_once_with(Bucket='test', Prefix='a.png/')
+    s3client.delete_objects.assert_called_once_with(Bucket='test', Delete={
+        'Objects': [{'Key': 'a.png'}],
+        'Quiet': True,
+    })
+
+
+def test_delete_many_by_chunks(s3client):
+    backend = S3Backend('test', Config(endpoint=S3_SERVER, region=S3_REGION,
+                                       access_key=S3_ACCESS_KEY, secret_key=S3_SECRET_KEY))
+    keys = ['dir/{0}.png'.format(i) for i in range(2500)]
+    paginator = s3client.get_paginator.return_value
+    paginator.paginate.side_effect = paginate(keys[:1000], keys[1000:2000], keys[2000:])
+
+    result = backend.delete_many(['dir'])
+
+    assert result.ok
+    assert list(result.keys()) == ['dir']
+    assert s3client.delete_objects.call_count == 3
+    deleted = [o['Key'] for c in s3client.delete_objects.call_args_list
+               for o in c[1]['Delete']['Objects']]
+    assert sorted(deleted) == sorted(['dir'] + keys)
+    assert all(len(c[1]['Delete']['Objects']) <= 1000
+               for c in s3client.delete_objects.call_args_list)
+
+
+def test_delete_many_errors(s3client):
+    backend = S3Backend('test', Config(endpoint=S3_SERVER, region=S3_REGION,
+                                       access_key=S3_ACCESS_KEY, secret_key=S3_SECRET_KEY))
+    paginator = s3client.get_paginator.return_value
+    paginator.paginate.side_effect = paginate()
+    s3client.delete_objects.return_value = {
+        'Errors': [{'Key': 'b.png', 'Code': 'AccessDenied', 'Message': 'Access Denied'}]
+    }
+
+    result = backend.delete_many(['a.png', 'b.png'])
+
+    assert list(result.keys()) == ['a.png']
+    assert isinstance(result.errors['b.png'], FSError)
+
+    with pytest.raises(FSError):
+        backend.delete('b.png')
+
+
+def test_open_write_multipart(s3client):
+    backend = S3Backend('test', Config(endpoint=S3_SERVER, region=S3_REGION,
+                                       access_key=S3_ACCESS_KEY, secret_key=S3_SECRET_KEY,
+                                       part_size=4))
+    s3client.create_multipart_upload.return_value = {'UploadId': 'upload'}
+    s3client.upload_part.side_effect = lambda **kwargs: {'ETag': str(kwargs['PartNumber'])}
+
+    with backend.open('file.txt', 'wb') as f:
+        f.write(b'abcdefghij')
+
+    s3client.create_multipart_upload.assert_called_once_with(Bucket='test', Key='file.txt')
+    parts = sorted((c[1]['PartNumber'], c[1]['Body']) for c in s3client.upload_part.call_args_list)
+    assert parts == [(1, b'abcd'), (2, b'efgh'), (3, b'ij')]
+    s3client.complete_multipart_upload.assert_called_once_with(
+        Bucket='test', Key='file.txt', UploadId='upload',
+        MultipartUpload={'Parts': [{'ETag': '1', 'PartNumber': 1},
+                                   {'ETag': '2', 'PartNumber': 2},
+                                   {'ETag': '3', 'PartNumber': 3}]}
+    )
+    s3client.put_object_tagging.assert_called_once_with(
+        Bucket='test', Key='file.txt',
+        Tagging={'TagSet': [{'Key': 'checksum',
+                             'Value': backend.compute_checksum(b'abcdefghij')}]}
+    )
+    assert not s3client.copy_object.called
+    assert not s3client.abort_multipart_upload.called
+
+
+def test_open_write_abort_multipart(s3client):
+    backend = S3Backend('test', Config(endpoint=S3_SERVER, region=S3_REGION,
+                                       access_key=S3_ACCESS_KEY, secret_key=S3_SECRET_KEY,
+                                       part_size=4))
+    s3client.create_multipart_upload.return_value = {'UploadId': 'upload'}
+    s3client.upload_part.return_value = {'ETag': 'etag'}
+
+    with pytest.raises(ValueError):
+        with backend.open('file.txt', 'wb') as f:
+            f.write(b'abcdefghij')
+            raise ValueError()
+
+    s3client.abort_multipart_upload.assert_called_once_with(Bucket='test', Key='file.txt',
+                                                            UploadId='upload')
+    assert not s3client.complete_multipart_upload.called
+
+
+def test_write_small_stream_single_put(s3client, utils):
+    backend = S3Backend('test', Config(endpoint=S3_SERVER, region=S3_REGION,
+                                       access_key=S3_ACCESS_KEY, secret_key=S3_SECRET_KEY,
+                                       part_size=4))
+    bucket = backend.bucket
+
+    backend.write('file.txt', utils.file(b'abc'), overwrite=False)
+
+    checksum = backend.compute_checksum(b'abc')
+    bucket.put_object.assert_called_once_with(Key='file.txt', Body=b'abc', FlaskFsIfAbsent=True,
+                                              Metadata={'checksum': checksum})
+    assert not s3client.create_multipart_upload.called
+
+
+def test_write_stream_no_overwrite_existing(s3client, utils):
+    backend = S3Backend('test', Config(endpoint=S3_SERVER, region=S3_REGION,
+                                       access_key=S3_ACCESS_KEY, secret_key=S3_SECRET_KEY,
+                                       part_size=4))
+    s3client.create_multipart_upload.return_value = {'UploadId': 'upload'}
+    s3client.upload_part.return_value = {'ETag': 'etag'}
+    error = {'Error': {'Code': 'PreconditionFailed'}}
+    s3client.complete_multipart_upload.side_effect = ClientError(error, 'CompleteMultipartUpload')
+
+    with pytest.raises(FileExists):
+        backend.write('file.txt', utils.file(b'abcdefghij'), overwrite=False)
+
+    assert s3client.complete_multipart_upload.call_args[1]['FlaskFsIfAbsent']
+    s3client.abort_multipart_upload.assert_called_once_with(Bucket='test', Key='file.txt',
+                                                            UploadId='upload')
+
+
+def test_transfer_settings():
+    backend = S3Backend('test', Config(endpoint=S3_SERVER, region=S3_REGION,
+                                       access_key=S3_ACCESS_KEY, secret_key=S3_SECRET_KEY,
+                                       part_size=42, multipart_threshold=100, max_concurrency=3))
+    assert backend.transfer_config.multipart_chunksize == 42
+    assert backend.transfer_config.multipart_threshold == 100
+    assert backend.transfer_config.max_concurrency == 3
+
+
+def test_write_stream_below_threshold(s3client, utils):
+    backend = S3Backend('test', Config(endpoint=S3_SERVER, region=S3_REGION,
+                                       access_key=S3_ACCESS_KEY, secret_key=S3_SECRET_KEY,
+                                       multipart_chunksize=4, multipart_threshold=16))
+
+    backend.write('file.txt', utils.file(b'abcdefghij'))
+
+    assert backend.bucket.put_object.call_args[1]['Body'] == b'abcdefghij'
+    assert not s3client.create_multipart_upload.called
+
+
+def test_download_managed_transfer(s3client):
+    backend = S3Backend('test', Config(endpoint=S3_SERVER, region=S3_REGION,
+                                       access_key=S3_ACCESS_KEY, secret_key=S3_SECRET_KEY))
+    out = io.BytesIO()
+
+    backend.download('file.txt', out)
+
+    config = backend.transfer_config
+    s3client.download_fileobj.assert_called_once_with('test', 'file.txt', out, Config=config)
+
+
+def test_download_not_found(s3client):
+    backend = S3Backend('test', Config(endpoint=S3_SERVER, region=S3_REGION,
+                                       access_key=S3_ACCESS_KEY, secret_key=S3_SECRET_KEY))
+    s3client.download_fileobj.side_effect = ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+
+    with pytest.raises(FileNotFound):
+        backend.download('file.txt', io.BytesIO())
+
+
+def test_read_range_header(s3client):
+    backend = S3Backend('test', Config(endpoint=S3_SERVER, region=S3_REGION,
+                                       access_key=S3_ACCESS_KEY, secret_key=S3_SECRET_KEY))
+    obj = backend.bucket.Object.return_value
+    obj.get.return_value = {'Body': io.BytesIO(b'234')}
+
+    assert backend.read_range('file.txt', 2, 5) == b'234'
+    obj.get.assert_called_once_with(Range='bytes=2-4')
+
+    backend.read_range('file.txt', 7)
+    obj.get.assert_called_with(Range='bytes=7-')
+
+    obj.get.side_effect = ClientError({'Error': {'Code': 'InvalidRange'}}, 'GetObject')
+    assert backend.read_range('file.txt', 20) == b''
+
+
+def test_iter_range_single_request(s3client):
+    backend = S3Backend('test', Config(endpoint=S3_SERVER, region=S3_REGION,
+                                       access_key=S3_ACCESS_KEY, secret_key=S3_SECRET_KEY,
+                                       serve_chunk_size=2))
+    obj = backend.bucket.Object.return_value
+    body = obj.get.return_value['Body']
+    body.iter_chunks.return_value = iter([b'23', b'4'])
+
+    assert list(backend.iter_range('file.txt', 2, 5)) == [b'23', b'4']
+    obj.get.assert_called_once_with(Range='bytes=2-4')
+    body.iter_chunks.assert_called_once_with(2)
+    assert body.close.called
+
+
+def test_signed_url_offline():
+    backend = S3Backend('test', Config(endpoint=S3_SERVER, region=S3_REGION,
+                                       access_key=S3_ACCESS_KEY, secret_key=S3_SECRET_KEY))
+
+    url = backend.signed_url('some/file.txt', expires=600)
+
+    assert url.startswith('{0}/test/some/file.txt?'.format(S3_SERVER))
+    assert 'X-Amz-Expires=600' in url
+    assert 'X-Amz-Signature=' in url
+    assert backend.signed_url('some/file.txt', expires=600) == url
+
+
+def test_serve_redirect(app, s3client):
+    backend = S3Backend('test', Config(endpoint=S3_SERVER, region=S3_REGION,
+                                       access_key=S3_ACCESS_KEY, secret_key=S3_SECRET_KEY,
+                                       redirect=True, signed_url_expires=300))
+    client = backend.s3.meta.client
+    client.generate_presigned_url.return_value = 'https://signed/file.txt'
+
+    response = backend.serve('file.txt')
+
+    assert response.status_code == 302
+    assert response.headers['Location'] == 'https://signed/file.txt'
+    client.generate_presigned_url.assert_called_once_with(
+        'get_object', Params={'Bucket': 'test', 'Key': 'file.txt'}, ExpiresIn=300
+    )
+    assert not backend.bucket.Object.called
+
+
+def test_write_multipart_created_once(s3client, utils):
+    backend = S3Backend('test', Config(endpoint=S3_SERVER, region=S3_REGION,
+                                       access_key=S3_ACCESS_KEY, secret_key=S3_SECRET_KEY,
+                                       multipart_chunksize=4, multipart_threshold=4,
+                                       max_concurrency=4))
+
+    def create_multipart_upload(**kwargs):
+        time.sleep(0.05)
+        return {'UploadId': 'upload'}
+
+    s3client.create_multipart_upload.side_effect = create_multipart_upload
+    s3client.upload_part.side_effect = lambda **kwargs: {'ETag': str(kwargs['PartNumber'])}
+
+    backend.write('file.txt', utils.file(b'a' * 40))
+
+    assert s3client.create_multipart_upload.call_count == 1
+    assert s3client.upload_part.call_count == 10
+    parts = s3client.complete_multipart_upload.call_args[1]['MultipartUpload']['Parts']
+    assert [part['PartNumber'] for part in parts] == list(range(1, 11))
+    assert not s3client.abort_multipart_upload.called
+
+
+def test_metadata_checksum_from_tag(s3client):
+    backend = S3Backend('test', Config(endpoint=S3_SERVER, region=S3_REGION,
+                                       access_key=S3_ACCESS_KEY, secret_key=S3_SECRET_KEY))
+    obj = backend.bucket.Object.return_value
+    obj.metadata = {}
+    obj.e_tag = '"abc-3"'
+    obj.content_type = 'text/plain'
+    s3client.get_object_tagging.return_value = {'TagSet': [{'Key': 'checksum',
+                                                            'Value': 'sha1:xyz'}]}
+
+    assert backend.get_metadata('file.txt')['checksum'] == 'sha1:xyz'
+    s3client.get_object_tagging.assert_called_once_with(Bucket='test', Key='file.txt')
+
+
+def test_serve_head_does_not_fetch_body(app, s3client):
+    backend = S3Backend('test', Config(endpoint=S3_SERVER, region=S3_REGION,
+                                       access_key=S3_ACCESS_KEY, secret_key=S3_SECRET_KEY))
+    obj = backend.bucket.Object.return_value
+    s3client.head_object.return_value = {
+        'ETag': '"etag"', 'ContentType': 'text/plain', 'ContentLength': 42,
+        'LastModified': datetime(2020, 1, 1, tzinfo=tz.tzutc()),
+    }
+
+    with app.test_request_context('/', method='HEAD'):
+        response = backend.serve('file.txt')
+
+    s3client.head_object.assert_called_once_with(Bucket='test', Key='file.txt')
+    assert not obj.get.called
+    assert not obj.load.called
+    assert response.content_length == 42
+    assert response.mimetype == 'text/plain'
+    assert response.headers['ETag'] == '"etag"'
+    assert response.last_modified == datetime(2020, 1, 1)
+
+
+def test_serve_forwards_conditions(app, s3client, mocker):
+    backend = S3Backend('test', Config(endpoint=S3_SERVER, region=S3_REGION,
+                                       access_key=S3_ACCESS_KEY, secret_key=S3_SECRET_KEY))
+    obj = backend.bucket.Object.return_value
+    body = mocker.MagicMock()
+    body.iter_chunks.return_value = iter([b'2345'])
+    obj.get.return_value = {
+        'Body': body, 'ETag': '"etag"', 'ContentType': 'text/plain', 'ContentLength': 4,
+        'ContentRange': 'bytes 2-5/10',
+    }
+    headers = {'Range': 'bytes=2-5', 'If-Range': '"etag"', 'If-None-Match': '"other"'}
+
+    with app.test_request_context('/', headers=headers):
+        response = backend.serve('file.txt')
+
+    obj.get.assert_called_once_with(Range='bytes=2-5', IfMatch='"etag"', IfNoneMatch='"other"')
+    assert not obj.load.called
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == 'bytes 2-5/10'
+    assert response.headers['ETag'] == '"etag"'
+    assert list(response.response) == [b'2345']
+
+
+def test_serve_not_modified(app, s3client):
+    backend = S3Backend('test', Config(endpoint=S3_SERVER, region=S3_REGION,
+                                       access_key=S3_ACCESS_KEY, secret_key=S3_SECRET_KEY))
+    obj = backend.bucket.Object.return_value
+    obj.get.side_effect = ClientError({
+        'Error': {'Code': '304'},
+        'ResponseMetadata': {'HTTPStatusCode': 304, 'HTTPHeaders': {'etag': '"etag"'}},
+    }, 'GetObject')
+
+    with app.test_request_context('/', headers={'If-None-Match': '"etag"'}):
+        response = backend.serve('file.txt')
+
+    assert response.status_code == 304
+    assert response.headers['ETag'] == '"etag"'
+
+
+def test_serve_outdated_if_range(app, s3client):
+    backend = S3Backend('test', Config(endpoint=S3_SERVER, region=S3_REGION,
+                                       access_key=S3_ACCESS_KEY, secret_key=S3_SECRET_KEY))
+    obj = backend.bucket.Object.return_value
+    full = {'Body': obj.get.return_value['Body'], 'ETag': '"new"', 'ContentLength': 10}
+    obj.get.side_effect = [ClientError({
+        'Error': {'Code': 'PreconditionFailed'},
+        'ResponseMetadata': {'HTTPStatusCode': 412},
+    }, 'GetObject'), full]
+
+    with app.test_request_context('/', headers={'Range': 'bytes=2-5', 'If-Range': '"old"'}):
+        response = backend.serve('file.txt')
+
+    assert obj.get.call_count == 2
+    obj.get.assert_called_with()
+    assert response.status_code == 200
+    assert response.content_length == 10
+
+
+def test_conditional_write_header(mocker):
+    backend = S3Backend('test', Config(endpoint='http://s3.invalid', region=S3_REGION,
+                                       access_key=S3_ACCESS_KEY, secret_key=S3_SECRET_KEY))
+    mocker.patch.object(backend, 'ensure_bucket')
+    sent = []
+
+    def send(request, **kwargs):
+        sent.append(request.headers)
+        return AWSResponse(request.url, 200, {}, mocker.Mock(stream=lambda: iter([b''])))
+
+    backend.s3.meta.client.meta.events.register('before-send.s3', send)
+
+    backend.write('new.txt', b'abc', overwrite=False)
+    backend.write('any.txt', b'abc')
+
+    assert sent[0]['If-None-Match'] == b'*'
+    assert 'If-None-Match' not in sent[1]
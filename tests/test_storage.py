@@ -3,10 +3,13 @@ from __future__ import unicode_literals
 
 import io
 
-from flask import url_for
+from flask import current_app, url_for
 
 import flask_fs as fs
 
+from flask_fs.backends import BaseBackend
+from flask_fs.batch import BatchResult, fan_out
+
 import pytest
 
 
@@ -64,6 +67,79 @@ def test_open(app, mock_backend):
     backend.open.assert_called_with('file.test', 'r')
 
 
+def test_download_to_file(app, mock_backend):
+    storage = fs.Storage('test')
+    app.configure(storage)
+
+    backend = mock_backend.return_value
+    out = io.BytesIO()
+
+    storage.download('file.test', out)
+
+    backend.download.assert_called_once_with('file.test', out)
+
+
+def test_download_to_path(app, mock_backend, tmpdir):
+    storage = fs.Storage('test')
+    app.configure(storage)
+
+    backend = mock_backend.return_value
+    backend.download.side_effect = lambda filename, out: out.write(b'content')
+    path = str(tmpdir.join('file.test'))
+
+    storage.download('file.test', path)
+
+    with open(path, 'rb') as f:
+        assert f.read() == b'content'
+
+
+def test_download_to_path_not_found(app, mock_backend, tmpdir):
+    storage = fs.Storage('test')
+    app.configure(storage)
+
+    backend = mock_backend.return_value
+    backend.download.side_effect = fs.FileNotFound('file.test')
+    path = str(tmpdir.join('file.test'))
+
+    with pytest.raises(fs.FileNotFound):
+        storage.download('file.test', path)
+
+    assert not tmpdir.join('file.test').check()
+
+
+def test_open_seekable(app, mock_backend):
+    storage = fs.Storage('test')
+    app.configure(storage)
+
+    backend = mock_backend.return_value
+    backend.open_seekable.return_value = io.BytesIO(b'content')
+
+    with storage.open('file.test', 'rb', seekable=True) as f:
+        assert f.read() == b'content'
+
+    backend.open_seekable.assert_called_once_with('file.test')
+    assert not backend.open.called
+
+
+def test_open_seekable_binary_only(app, mock_backend):
+    storage = fs.Storage('test')
+    app.configure(storage)
+
+    with pytest.raises(ValueError):
+        storage.open('file.test', 'r', seekable=True)
+
+
+def test_read_range(app, mock_backend):
+    storage = fs.Storage('test')
+    app.configure(storage)
+
+    backend = mock_backend.return_value
+    backend.read_range.return_value = b'con'
+
+    assert storage.read_range('file.test', 0, 3) == b'con'
+    backend.read_range.assert_called_once_with('file.test', 0, 3)
+
+
 def test_open_write_new_file(app, mock_backend):
     storage = fs.Storage('test')
     app.configure(storage)
@@ -82,12 +158,14 @@ def test_open_read_not_found(app, mock_backend):
     app.configure(storage)
 
     backend = mock_backend.return_value
-    backend.exists.return_value = False
+    backend.open.side_effect = fs.FileNotFound('file.test')
 
     with pytest.raises(fs.FileNotFound):
         with storage.open('file.test'):
             pass
 
+    backend.exists.assert_not_called()
+
 
 def test_read(app, mock_backend):
     storage = fs.Storage('test')
@@ -104,22 +182,23 @@ def test_read_not_found(app, mock_backend):
     app.configure(storage)
 
     backend = mock_backend.return_value
-    backend.exists.return_value = False
+    backend.read.side_effect = fs.FileNotFound('file.test')
 
     with pytest.raises(fs.FileNotFound):
         storage.read('file.test')
 
+    backend.exists.assert_not_called()
+
 
 def test_write(app, mock_backend):
     storage = fs.Storage('test')
     app.configure(storage)
 
     backend = mock_backend.return_value
-    backend.exists.return_value = False
 
     storage.write('file.test', 'content')
-    backend.exists.assert_called_with('file.test')
-    backend.write.assert_called_with('file.test', 'content')
+    backend.exists.assert_not_called()
+    backend.write.assert_called_with('file.test', 'content', overwrite=False)
 
 
 def test_write_file_exists(app, mock_backend):
@@ -127,7 +206,7 @@ def test_write_file_exists(app, mock_backend):
     app.configure(storage)
 
     backend = mock_backend.return_value
-    backend.exists.return_value = True
+    backend.write.side_effect = fs.FileExists('file.test')
 
     with pytest.raises(fs.FileExists):
         storage.write('file.test', 'content')
@@ -141,7 +220,7 @@ def test_write_overwrite(app, mock_backend):
 
     storage.write('file.test', 'content', overwrite=True)
 
-    backend.write.assert_called_with('file.test', 'content')
+    backend.write.assert_called_with('file.test', 'content', overwrite=True)
 
 
 def test_write_overwritable(app, mock_backend):
@@ -152,7 +231,7 @@ def test_write_overwritable(app, mock_backend):
 
     storage.write('file.test', 'content')
 
-    backend.write.assert_called_with('file.test', 'content')
+    backend.write.assert_called_with('file.test', 'content', overwrite=True)
 
 
 def test_save_file_exists(app, mock_backend, utils, faker):
@@ -162,11 +241,14 @@ def test_save_file_exists(app, mock_backend, utils, faker):
     f = utils.file(faker.binary())
 
     backend = mock_backend.return_value
-    backend.exists.return_value = True
+    backend.save.side_effect = fs.FileExists('test.png')
 
     with pytest.raises(fs.FileExists):
         storage.save(f, 'test.png')
 
+    backend.exists.assert_not_called()
+    backend.save.assert_called_with(f, 'test.png', overwrite=False)
+
 
 def test_save_overwrite(app, mock_backend, utils, faker):
     storage = fs.Storage('test')
@@ -180,7 +262,73 @@ def test_save_overwrite(app, mock_backend, utils, faker):
     filename = storage.save(f, 'test.png', overwrite=True)
 
     assert filename == 'test.png'
-    backend.save.assert_called_with(f, 'test.png')
+    backend.save.assert_called_with(f, 'test.png', overwrite=True)
+
+
+class LegacyBackend(BaseBackend):
+    '''A custom backend without exclusive create nor FileNotFound support'''
+    def __init__(self, name, config):
+        super(LegacyBackend, self).__init__(name, config)
+        self.files = {}
+
+    def exists(self, filename):
+        return filename in self.files
+
+    def write(self, filename, content):
+        self.files[filename] = content.read() if hasattr(content, 'read') else content
+
+    def read(self, filename):
+        return self.files[filename]
+
+    def open(self, filename, mode='r'):
+        return io.BytesIO(self.files[filename])
+
+
+@pytest.fixture
+def legacy_storage(app, mocker):
+    app.config['FS_BACKEND'] = 'mock'
+    mocker.patch('flask_fs.backends.mock.MockBackend', LegacyBackend)
+    storage = fs.Storage('test')
+    app.configure(storage)
+    return storage
+
+
+def test_write_without_exclusive_create(legacy_storage):
+    legacy_storage.write('file.test', b'content')
+    assert legacy_storage.backend.files == {'file.test': b'content'}
+
+    with pytest.raises(fs.FileExists):
+        legacy_storage.write('file.test', b'other')
+
+    legacy_storage.write('file.test', b'other', overwrite=True)
+    assert legacy_storage.backend.files == {'file.test': b'other'}
+
+
+def test_read_without_not_found_support(legacy_storage):
+    with pytest.raises(fs.FileNotFound):
+        legacy_storage.read('missing.txt')
+    with pytest.raises(fs.FileNotFound):
+        legacy_storage.open('missing.txt', 'rb')
+
+    legacy_storage.write('file.txt', b'content')
+    assert legacy_storage.read('file.txt') == b'content'
+    assert legacy_storage.open('file.txt', 'rb').read() == b'content'
+
+
+def test_serve_without_not_found_support(app, legacy_storage):
+    response = app.test_client().get(url_for('fs.get_file', fs='test', filename='missing.txt'))
+    assert response.status_code == 404
+
+
+def test_save_without_exclusive_create(legacy_storage, utils):
+    assert legacy_storage.save(utils.file(b'content'), 'file.txt') == 'file.txt'
+    assert legacy_storage.backend.files == {'file.txt': b'content'}
+
+    with pytest.raises(fs.FileExists):
+        legacy_storage.save(utils.file(b'other'), 'file.txt')
+
+    legacy_storage.save(utils.file(b'other'), 'file.txt', overwrite=True)
+    assert legacy_storage.backend.files == {'file.txt': b'other'}
 
 
 def test_save_from_file(app, mock_backend, utils, faker):
@@ -190,12 +338,11 @@ def test_save_from_file(app, mock_backend, utils, faker):
     app.configure(storage)
 
     backend = mock_backend.return_value
-    backend.exists.return_value = False
 
     filename = storage.save(f, 'test.png')
 
     assert filename == 'test.png'
-    backend.save.assert_called_with(f, 'test.png')
+    backend.save.assert_called_with(f, 'test.png', overwrite=False)
 
 
 def test_save_from_file_storage(app, mock_backend, utils):
@@ -206,12 +353,27 @@ def test_save_from_file_storage(app, mock_backend, utils):
     app.configure(storage)
 
     backend = mock_backend.return_value
-    backend.exists.return_value = False
 
     filename = storage.save(wfs)
 
     assert filename == 'test.txt'
-    backend.save.assert_called_with(wfs, 'test.txt')
+    backend.save.assert_called_with(wfs, 'test.txt', overwrite=False)
+
+
+def test_save_metadata(app, mock_backend, utils):
+    storage = fs.Storage('test')
+    wfs = utils.filestorage('test.txt', 'test')
+
+    app.configure(storage)
+
+    backend = mock_backend.return_value
+    backend.save.return_value = fs.SavedFile('test.txt', checksum='sha1:abc', size=4)
+
+    saved = storage.save(wfs)
+
+    assert saved == 'test.txt'
+    assert saved.checksum == 'sha1:abc'
+    assert saved.size == 4
 
 
 def test_save_with_filename(app, mock_backend, utils):
@@ -222,12 +384,11 @@ def test_save_with_filename(app, mock_backend, utils):
     app.configure(storage)
 
     backend = mock_backend.return_value
-    backend.exists.return_value = False
 
     filename = storage.save(wfs, 'other.gif')
 
     assert filename == 'other.gif'
-    backend.save.assert_called_with(wfs, 'other.gif')
+    backend.save.assert_called_with(wfs, 'other.gif', overwrite=False)
 
 
 def test_save_with_prefix(app, mock_backend, utils):
@@ -238,12 +399,11 @@ def test_save_with_prefix(app, mock_backend, utils):
     app.configure(storage)
 
     backend = mock_backend.return_value
-    backend.exists.return_value = False
 
     filename = storage.save(wfs, prefix='prefix')
 
     assert filename == 'prefix/test.txt'
-    backend.save.assert_called_with(wfs, 'prefix/test.txt')
+    backend.save.assert_called_with(wfs, 'prefix/test.txt', overwrite=False)
 
 
 def test_save_with_callable_prefix(app, mock_backend, utils):
@@ -254,12 +414,11 @@ def test_save_with_callable_prefix(app, mock_backend, utils):
     app.configure(storage)
 
     backend = mock_backend.return_value
-    backend.exists.return_value = False
 
     filename = storage.save(wfs, prefix=lambda: 'prefix')
 
     assert filename == 'prefix/test.txt'
-    backend.save.assert_called_with(wfs, 'prefix/test.txt')
+    backend.save.assert_called_with(wfs, 'prefix/test.txt', overwrite=False)
 
 
 def test_save_with_upload_to(app, mock_backend, utils):
@@ -270,12 +429,11 @@ def test_save_with_upload_to(app, mock_backend, utils):
     app.configure(storage)
 
     backend = mock_backend.return_value
-    backend.exists.return_value = False
 
     filename = storage.save(wfs)
 
     assert filename == 'upload_to/test.txt'
-    backend.save.assert_called_with(wfs, 'upload_to/test.txt')
+    backend.save.assert_called_with(wfs, 'upload_to/test.txt', overwrite=False)
 
 
 def test_save_with_callable_upload_to(app, mock_backend, utils):
@@ -286,12 +444,11 @@ def test_save_with_callable_upload_to(app, mock_backend, utils):
     app.configure(storage)
 
     backend = mock_backend.return_value
-    backend.exists.return_value = False
 
     filename = storage.save(wfs)
 
     assert filename == 'upload_to/test.txt'
-    backend.save.assert_called_with(wfs, 'upload_to/test.txt')
+    backend.save.assert_called_with(wfs, 'upload_to/test.txt', overwrite=False)
 
 
 def test_save_with_upload_to_and_prefix(app, mock_backend, utils):
@@ -302,12 +459,11 @@ def test_save_with_upload_to_and_prefix(app, mock_backend, utils):
     app.configure(storage)
 
     backend = mock_backend.return_value
-    backend.exists.return_value = False
 
     filename = storage.save(wfs, prefix='prefix')
 
     assert filename == 'upload_to/prefix/test.txt'
-    backend.save.assert_called_with(wfs, 'upload_to/prefix/test.txt')
+    backend.save.assert_called_with(wfs, 'upload_to/prefix/test.txt', overwrite=False)
 
 
 def test_delete(app, mock_backend):
@@ -371,6 +527,44 @@ def test_url_from_config_with_scheme(app):
         assert https.url('test.txt') == 'https://somewhere.com/static/test.txt'
 
 
+def test_url_prefix_resolved_once(app, mocker):
+    storage = fs.Storage('test')
+
+    app.configure(storage, TEST_FS_URL='somewhere.com/static')
+    base_url = mocker.spy(storage, '_base_url')
+
+    assert storage.url('first.txt') == 'http://somewhere.com/static/first.txt'
+    assert storage.url('second.txt') == 'http://somewhere.com/static/second.txt'
+    assert base_url.call_count == 1
+
+    with app.test_request_context(environ_overrides={'wsgi.url_scheme': 'https'}):
+        assert storage.url('first.txt') == 'https://somewhere.com/static/first.txt'
+        assert storage.url('second.txt') == 'https://somewhere.com/static/second.txt'
+    assert base_url.call_count == 2
+
+
+def test_urls(app):
+    storage = fs.Storage('test')
+
+    app.configure(storage)
+
+    filenames = ['test.txt', '/other.txt', 'some/path/to/file.txt', 'with space & co.txt']
+    assert storage.urls(filenames) == [storage.url(f) for f in filenames]
+    expected = [storage.url(f, external=True) for f in filenames]
+    assert storage.urls(filenames, external=True) == expected
+
+
+def test_urls_from_config(app):
+    storage = fs.Storage('test')
+
+    app.configure(storage, TEST_FS_URL='https://somewhere.com/static')
+
+    assert storage.urls(['test.txt', '/other.txt']) == [
+        'https://somewhere.com/static/test.txt',
+        'https://somewhere.com/static/other.txt',
+    ]
+
+
 def test_root(app, mock_backend):
     storage = fs.Storage('test')
     backend = mock_backend.return_value
@@ -434,3 +628,241 @@ def test_metadata(app, mock_backend):
     assert metadata['filename'] == 'file.test'
     assert metadata['url'] == url
     backend.metadata.assert_called_with('file.test')
+
+
+def test_metadata_without_cache(app, mock_backend):
+    storage = fs.Storage('test')
+    app.configure(storage)
+
+    backend = mock_backend.return_value
+    backend.metadata.return_value = {'size': 42}
+
+    storage.metadata('file.test')
+    storage.metadata('file.test')
+
+    assert storage.metadata_cache is None
+    assert backend.metadata.call_count == 2
+
+
+def test_metadata_cached(app, mock_backend):
+    storage = fs.Storage('test')
+    app.configure(storage, TEST_FS_METADATA_CACHE=True)
+
+    backend = mock_backend.return_value
+    backend.metadata.return_value = {'size': 42}
+
+    assert storage.metadata('file.test')['size'] == 42
+    assert storage.metadata('file.test')['size'] == 42
+
+    backend.metadata.assert_called_once_with('file.test')
+
+
+def test_metadata_cache_shared_between_storages(app, tmpdir):
+    shared = fs.cache.MemoryMetadataCache()
+    first = fs.Storage('first')
+    second = fs.Storage('second')
+    app.configure(first, second, FS_ROOT=str(tmpdir), FS_LOCAL_METADATA_CACHE=shared)
+
+    first.write('x.txt', b'first content')
+    second.write('x.txt', b'x')
+
+    assert first.metadata('x.txt')['size'] == 13
+    assert second.metadata('x.txt')['size'] == 1
+
+    first.delete('x.txt')
+    assert second.metadata('x.txt')['size'] == 1
+
+
+@pytest.mark.parametrize('operation,args', [
+    ('write', ('file.test', 'content')),
+    ('save', (io.BytesIO(b'content'), 'file.test')),
+    ('delete', ('file.test',)),
+    ('copy', ('other.test', 'file.test')),
+    ('move', ('file.test', 'other.test')),
+])
+def test_metadata_cache_invalidation(app, mock_backend, operation, args):
+    storage = fs.Storage('test', fs.ALL)
+    app.configure(storage, TEST_FS_METADATA_CACHE=True)
+
+    backend = mock_backend.return_value
+    backend.metadata.return_value = {'size': 42}
+
+    storage.metadata('file.test')
+    getattr(storage, operation)(*args)
+    storage.metadata('file.test')
+
+    assert backend.metadata.call_count == 2
+
+
+def test_metadata_cache_open_write_invalidation(app, tmpdir):
+    storage = fs.Storage('test')
+    app.configure(storage, FS_ROOT=str(tmpdir), TEST_FS_METADATA_CACHE=True)
+    storage.write('file.test', b'old')
+    assert storage.metadata('file.test')['size'] == 3
+
+    with storage.open('file.test', 'wb') as f:
+        f.write(b'content')
+    assert storage.metadata('file.test')['size'] == 7
+
+    f = storage.open('file.test', 'w')
+    f.write('new content')
+    f.close()
+    assert storage.metadata('file.test')['size'] == 11
+
+
+def test_metadata_cache_directory_invalidation(app, mock_backend):
+    storage = fs.Storage('test')
+    app.configure(storage, TEST_FS_METADATA_CACHE=True)
+
+    backend = mock_backend.return_value
+    backend.metadata.return_value = {'size': 42}
+
+    storage.metadata('dir/file.test')
+    storage.delete('dir')
+    storage.metadata('dir/file.test')
+
+    assert backend.metadata.call_count == 2
+
+
+def test_copy(app, mock_backend):
+    storage = fs.Storage('test')
+    app.configure(storage)
+
+    backend = mock_backend.return_value
+
+    storage.copy('file.test', 'other.test')
+
+    backend.copy.assert_called_with('file.test', 'other.test')
+
+
+def test_move(app, mock_backend):
+    storage = fs.Storage('test')
+    app.configure(storage)
+
+    backend = mock_backend.return_value
+
+    storage.move('file.test', 'other.test')
+
+    backend.move.assert_called_with('file.test', 'other.test')
+
+
+def test_warmup(app, mock_backend):
+    storage = fs.Storage('test')
+    app.configure(storage)
+
+    backend = mock_backend.return_value
+
+    storage.warmup()
+
+    backend.warmup.assert_called_once_with()
+
+
+def test_exists_many(app, mock_backend):
+    storage = fs.Storage('test')
+    app.configure(storage)
+
+    backend = mock_backend.return_value
+    backend.exists_many.return_value = BatchResult([('a.txt', True), ('b.txt', False)])
+
+    result = storage.exists_many(['a.txt', 'b.txt'])
+
+    assert result == {'a.txt': True, 'b.txt': False}
+    backend.exists_many.assert_called_once_with(['a.txt', 'b.txt'])
+
+
+def test_read_many(app, mock_backend):
+    storage = fs.Storage('test')
+    app.configure(storage)
+
+    backend = mock_backend.return_value
+    backend.read_many.return_value = BatchResult([('a.txt', b'content')])
+
+    assert storage.read_many(['a.txt']) == {'a.txt': b'content'}
+    backend.read_many.assert_called_once_with(['a.txt'])
+
+
+def test_delete_many(app, mock_backend):
+    storage = fs.Storage('test')
+    app.configure(storage, TEST_FS_METADATA_CACHE=True)
+
+    backend = mock_backend.return_value
+    backend.metadata.return_value = {}
+    result = BatchResult([('a.txt', None)])
+    result.errors['b.txt'] = fs.FileNotFound('b.txt')
+    backend.delete_many.return_value = result
+
+    storage.metadata('a.txt')
+    assert storage.delete_many(['a.txt', 'b.txt']) is result
+    storage.metadata('a.txt')
+
+    backend.delete_many.assert_called_once_with(['a.txt', 'b.txt'])
+    assert backend.metadata.call_count == 2
+
+
+def test_save_many(app, mock_backend, utils):
+    storage = fs.Storage('test')
+    app.configure(storage)
+
+    backend = mock_backend.return_value
+
+    def save(file_or_wfs, filename, overwrite):
+        if filename == 'prefix/exists.txt':
+            raise fs.FileExists(filename)
+
+    backend.save.side_effect = save
+    backend.fan_out.side_effect = lambda func, items, key=None: fan_out(func, items, key=key)
+    wfs = utils.filestorage('test.txt', 'test')
+    f = utils.file('other')
+
+    result = storage.save_many([wfs, (f, 'other.txt'), (utils.file('x'), 'exists.txt'),
+                                (utils.file('x'), 'denied.exe')], prefix='prefix')
+
+    assert result == {'test.txt': 'prefix/test.txt', 'other.txt': 'prefix/other.txt'}
+    assert isinstance(result.errors['exists.txt'], fs.FileExists)
+    assert isinstance(result.errors['denied.exe'], fs.UnauthorizedFileType)
+    assert backend.save.call_count == 3
+
+
+def test_signed_url(app, mock_backend):
+    storage = fs.Storage('test')
+    app.configure(storage)
+
+    backend = mock_backend.return_value
+    backend.signed_url.return_value = 'https://signed/file.test'
+
+    assert storage.signed_url('file.test', expires=60) == 'https://signed/file.test'
+    backend.signed_url.assert_called_once_with('file.test', 60)
+
+
+def test_save_many_rejects_ambiguous_filenames(app, mock_backend, utils):
+    storage = fs.Storage('test')
+    app.configure(storage)
+
+    with pytest.raises(ValueError):
+        storage.save_many([(utils.file('a'), 'a.txt'), (utils.file('b'), 'a.txt')])
+    with pytest.raises(ValueError):
+        storage.save_many([utils.file('a')])
+    assert not mock_backend.return_value.save.called
+
+
+def test_batch_operations_on_default_local_storage(app, tmpdir, utils):
+    # No explicit root: resolved from the application in the batch workers
+    storage = fs.Storage('test', overwrite=True)
+    app.configure(storage, FS_ROOT=str(tmpdir), TEST_FS_BATCH_WORKERS=4)
+
+    saved = storage.save_many([(utils.file('a'), 'a.txt'), (utils.file('b'), 'b.txt')],
+                              prefix=lambda: current_app.name)
+    assert saved.ok, saved.errors
+    assert saved == {'a.txt': 'flaskfs-tests/a.txt', 'b.txt': 'flaskfs-tests/b.txt'}
+
+    exists = storage.exists_many(['flaskfs-tests/a.txt', 'flaskfs-tests/b.txt', 'missing.txt'])
+    assert exists.ok, exists.errors
+    assert exists == {'flaskfs-tests/a.txt': True, 'flaskfs-tests/b.txt': True,
+                      'missing.txt': False}
+
+    read = storage.read_many(['flaskfs-tests/a.txt', 'flaskfs-tests/b.txt'])
+    assert read == {'flaskfs-tests/a.txt': b'a', 'flaskfs-tests/b.txt': b'b'}
+
+    deleted = storage.delete_many(['flaskfs-tests/a.txt', 'flaskfs-tests/b.txt'])
+    assert deleted.ok, deleted.errors
+    assert not tmpdir.join('test', 'flaskfs-tests', 'a.txt').check()
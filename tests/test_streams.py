@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import hashlib
+import io
+import threading
+
+from flask_fs import streams
+
+import pytest
+
+
+class RecordingWriter(streams.PartWriter):
+    def __init__(self, *args, **kwargs):
+        super(RecordingWriter, self).__init__(*args, **kwargs)
+        self.calls = []
+
+    def put(self, data):
+        self.calls.append(('put', data))
+
+    def upload_part(self, number, data):
+        self.calls.append(('part', number, data))
+
+    def complete(self):
+        self.calls.append(('complete',))
+
+    def cancel(self):
+        self.calls.append(('cancel',))
+
+
+def test_small_content_single_put():
+    writer = RecordingWriter(part_size=10)
+    writer.write(b'abc')
+    writer.write(b'def')
+    writer.close()
+
+    assert writer.calls == [('put', b'abcdef')]
+    assert writer.size == 6
+    assert writer.checksum == 'sha1:{0}'.format(hashlib.sha1(b'abcdef').hexdigest())
+
+
+def test_bounded_parts():
+    writer = RecordingWriter(part_size=4)
+    writer.write(b'abcdefghij')
+    assert len(writer.buffer) == 2
+    writer.write(memoryview(b'kl'))
+    writer.write(b'm')
+    writer.close()
+
+    assert writer.calls == [
+        ('part', 1, b'abcd'),
+        ('part', 2, b'efgh'),
+        ('part', 3, b'ijkl'),
+        ('part', 4, b'm'),
+        ('complete',),
+    ]
+    assert writer.size == 13
+
+
+def test_close_twice():
+    writer = RecordingWriter(part_size=4)
+    writer.close()
+    writer.close()
+
+    assert writer.calls == [('put', b'')]
+    with pytest.raises(ValueError):
+        writer.write(b'a')
+
+
+def test_abort_cancel_uploaded_parts():
+    writer = RecordingWriter(part_size=4)
+    writer.write(b'abcdef')
+    writer.abort()
+    writer.close()
+
+    assert writer.calls == [('part', 1, b'abcd'), ('cancel',)]
+
+
+def test_abort_without_parts():
+    writer = RecordingWriter(part_size=4)
+    writer.write(b'ab')
+    writer.abort()
+
+    assert writer.calls == []
+
+
+def test_failed_completion_cancel_uploaded_parts():
+    writer = RecordingWriter(part_size=4)
+    writer.complete = lambda: 1 / 0
+    writer.write(b'abcdef')
+
+    with pytest.raises(ZeroDivisionError):
+        writer.close()
+
+    assert writer.calls == [('part', 1, b'abcd'), ('part', 2, b'ef'), ('cancel',)]
+
+
+def test_writer_text_mode():
+    writer = RecordingWriter(part_size=4)
+    with streams.writer(writer, 'w', 'utf8') as f:
+        f.write('éà')
+
+    assert writer.calls == [('part', 1, 'éà'.encode('utf8')), ('complete',)]
+
+
+def test_writer_abort_on_error():
+    writer = RecordingWriter(part_size=4)
+    with pytest.raises(ZeroDivisionError):
+        with streams.writer(writer, 'wb') as f:
+            f.write(b'abcdef')
+            1 / 0
+
+    assert writer.calls == [('part', 1, b'abcd'), ('cancel',)]
+    assert writer.closed
+
+
+@pytest.mark.parametrize('content', [
+    b'abcdef',
+    'abcdef',
+    bytearray(b'abcdef'),
+    memoryview(b'abcdef'),
+    io.BytesIO(b'abcdef'),
+    io.StringIO('abcdef'),
+    iter([b'ab', b'', 'cd', bytearray(b'ef')]),
+])
+def test_chunks(content):
+    assert b''.join(streams.chunks(content, size=4)) == b'abcdef'
+
+
+@pytest.mark.parametrize('data', [b'abc', bytearray(b'abc'), memoryview(b'abc')])
+def test_to_bytes(data):
+    result = streams.to_bytes(data)
+    assert isinstance(result, bytes)
+    assert result == b'abc'
+
+
+def test_chunks_read_by_size():
+    assert list(streams.chunks(io.BytesIO(b'abcdef'), size=4)) == [b'abcd', b'ef']
+
+
+def test_copy():
+    writer = RecordingWriter(part_size=4)
+    streams.copy(io.BytesIO(b'abcdef'), writer)
+
+    assert writer.calls == [('part', 1, b'abcd'), ('part', 2, b'ef'), ('complete',)]
+
+
+def test_copy_abort_on_error():
+    def content():
+        yield b'abcdef'
+        raise IOError()
+
+    writer = RecordingWriter(part_size=4)
+    with pytest.raises(IOError):
+        streams.copy(content(), writer)
+
+    assert writer.calls == [('part', 1, b'abcd'), ('cancel',)]
+
+
+def test_threshold():
+    writer = RecordingWriter(part_size=4, threshold=10)
+    writer.write(b'abcdefgh')
+    assert writer.calls == []
+    writer.close()
+
+    assert writer.calls == [('put', b'abcdefgh')]
+
+
+def test_threshold_reached():
+    writer = RecordingWriter(part_size=4, threshold=10)
+    writer.write(b'abcdefgh')
+    writer.write(b'ijk')
+    writer.close()
+
+    assert writer.calls == [
+        ('part', 1, b'abcd'),
+        ('part', 2, b'efgh'),
+        ('part', 3, b'ijk'),
+        ('complete',),
+    ]
+
+
+def test_concurrent_parts():
+    lock = threading.Lock()
+    state = {'running': 0, 'max': 0}
+    event = threading.Event()
+
+    class ConcurrentWriter(RecordingWriter):
+        def upload_part(self, number, data):
+            with lock:
+                state['running'] += 1
+                state['max'] = max(state['max'], state['running'])
+            event.wait(0.01)
+            super(ConcurrentWriter, self).upload_part(number, data)
+            with lock:
+                state['running'] -= 1
+
+    writer = ConcurrentWriter(part_size=2, max_concurrency=3)
+    writer.write(b'abcdefghijklmnopqrst')
+    writer.close()
+
+    parts = sorted(c for c in writer.calls if c[0] == 'part')
+    assert [p[2] for p in parts] == [b'ab', b'cd', b'ef', b'gh', b'ij',
+                                     b'kl', b'mn', b'op', b'qr', b'st']
+    assert writer.calls[-1] == ('complete',)
+    assert 1 < state['max'] <= 3
+
+
+def test_concurrent_part_failure_cancel():
+    class FailingWriter(RecordingWriter):
+        def upload_part(self, number, data):
+            if number == 2:
+                raise IOError()
+            super(FailingWriter, self).upload_part(number, data)
+
+    writer = FailingWriter(part_size=2, max_concurrency=2)
+    with pytest.raises(IOError):
+        streams.copy(io.BytesIO(b'abcdefghij'), writer)
+
+    assert writer.calls[-1] == ('cancel',)
+    assert ('complete',) not in writer.calls
+
+
+class RangeSource(object):
+    def __init__(self, content):
+        self.content = content
+        self.calls = []
+
+    def __call__(self, start, end):
+        self.calls.append((start, end))
+        return self.content[start:end]
+
+
+def test_range_reader():
+    source = RangeSource(b'0123456789')
+    reader = streams.RangeReader(source, size=lambda: 10)
+
+    assert reader.read(3) == b'012'
+    assert reader.seek(-2, io.SEEK_END) == 8
+    assert reader.read() == b'89'
+    assert reader.read(2) == b''
+    reader.seek(-4, io.SEEK_CUR)
+    assert reader.tell() == 6
+    assert reader.read(2) == b'67'
+
+    with pytest.raises(ValueError):
+        reader.seek(-1)
+
+
+def test_range_reader_lazy_size():
+    def size():
+        raise AssertionError('Size should not be fetched')
+
+    reader = streams.RangeReader(RangeSource(b'0123456789'), size=size)
+    reader.seek(5)
+    assert reader.read(2) == b'56'
+
+
+def test_buffered_range_reader():
+    source = RangeSource(b'0123456789' * 10)
+    reader = streams.range_reader(source, size=100, buffer_size=16)
+
+    assert reader.read(2) == b'01'
+    assert reader.read(2) == b'23'
+    assert source.calls == [(0, 16)]
+
+    reader.seek(95)
+    assert reader.read(10) == b'56789'
+
+
+def test_range_reader_read_all_single_request():
+    source = RangeSource(b'0123456789' * 10)
+    reader = streams.range_reader(source, size=100, buffer_size=16)
+
+    assert reader.read(2) == b'01'
+    assert reader.read() == (b'0123456789' * 10)[2:]
+    assert source.calls == [(0, 16), (16, None)]
+    assert reader.read() == b''
+
+
+def test_iter_reader():
+    class Body(object):
+        closed = False
+
+        def __iter__(self):
+            return iter([b'abc', b'', b'defg'])
+
+        def close(self):
+            self.closed = True
+
+    body = Body()
+    reader = io.BufferedReader(streams.IterReader(body), 2)
+
+    assert reader.read(2) == b'ab'
+    assert reader.read() == b'cdefg'
+    reader.close()
+    assert body.closed
+
+
+def test_closing():
+    closed = []
+    iterator = streams.closing(iter([1, 2, 3]), lambda: closed.append(True))
+
+    assert next(iterator) == 1
+    iterator.close()
+    assert closed == [True]
+
+
+def test_start_called_once_before_parts():
+    calls = []
+
+    class StartingWriter(streams.PartWriter):
+        def start(self):
+            calls.append('start')
+
+        def upload_part(self, number, data):
+            calls.append(number)
+
+        def complete(self):
+            calls.append('complete')
+
+    writer = StartingWriter(part_size=2)
+    writer.write(b'abcde')
+    writer.close()
+
+    assert calls == ['start', 1, 2, 3, 'complete']
+
+
+def test_closing_not_started():
+    closed = []
+    iterator = streams.closing(iter([1, 2, 3]), lambda: closed.append(True))
+
+    iterator.close()
+    iterator.close()
+    assert closed == [True]
+
+
+def test_closing_exhausted():
+    closed = []
+
+    assert list(streams.closing([1, 2], lambda: closed.append(True))) == [1, 2]
+    assert closed == [True]
@@ -1,11 +1,18 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import hashlib
+import hmac
+import io
+import json
 import swiftclient
+import threading
+import time
 
 from .test_backend_mixin import BackendTestCase
 
 from flask_fs.backends.swift import SwiftBackend
+from flask_fs.errors import FSError, OperationNotSupported
 from flask_fs.storage import Config
 
 import pytest
@@ -58,3 +65,354 @@ class SwiftBackendTest(BackendTestCase):
             return True
         except swiftclient.ClientException:
             return False
+
+
+def test_lazy_connection(mocker):
+    connection = mocker.patch('swiftclient.Connection')
+    backend = SwiftBackend('test', Config(user='user', key='key', authurl='http://auth'))
+    assert not connection.called
+
+    backend.warmup()
+
+    connection.assert_called_once_with(user='user', key='key', authurl='http://auth')
+    connection.return_value.put_container.assert_called_once_with('test')
+
+
+def test_connection_per_thread(mocker):
+    connection = mocker.patch('swiftclient.Connection')
+    connection.side_effect = lambda **kwargs: mocker.MagicMock()
+    backend = SwiftBackend('test', Config(user='user', key='key', authurl='http://auth',
+                                          retries=3, timeout=10))
+    connections = []
+
+    def get_connection():
+        connections.append(backend.conn)
+
+    get_connection()
+    thread = threading.Thread(target=get_connection)
+    thread.start()
+    thread.join()
+
+    assert backend.conn is connections[0]
+    assert connections[0] is not connections[1]
+    connection.assert_called_with(user='user', key='key', authurl='http://auth',
+                                  retries=3, timeout=10)
+    # Container is only created once per process
+    assert connections[0].put_container.called
+    assert not connections[1].put_container.called
+
+
+def test_bulk_delete(mocker):
+    connection = mocker.patch('swiftclient.Connection')
+    conn = connection.return_value
+    conn.get_capabilities.return_value = {'bulk_delete': {'max_deletes_per_request': 2}}
+    items = [{'name': 'dir/a.png'}, {'name': 'dir/sub/b.png'}]
+    conn.get_container.side_effect = lambda c, **kw: ({}, items if c == 'test' else [])
+    conn.post_account.return_value = ({}, json.dumps({
+        'Response Status': '200 OK',
+        'Errors': [['/test/dir/sub/b.png', '401 Unauthorized']],
+    }).encode('utf8'))
+    backend = SwiftBackend('test', Config(user='user', key='key', authurl='http://auth'))
+
+    result = backend.delete_many(['dir'])
+
+    conn.get_container.assert_any_call('test', prefix='dir/', full_listing=True)
+    conn.get_container.assert_any_call('test_segments', prefix='dir/', full_listing=True)
+    assert conn.post_account.call_count == 2
+    bodies = [c[1]['data'] for c in conn.post_account.call_args_list]
+    assert bodies == [b'/test/dir\n/test/dir/a.png', b'/test/dir/sub/b.png']
+    assert conn.post_account.call_args[1]['query_string'] == 'bulk-delete'
+    assert not conn.delete_object.called
+    assert isinstance(result.errors['dir'], FSError)
+
+
+def test_delete_without_bulk_delete(mocker):
+    connection = mocker.patch('swiftclient.Connection')
+    conn = connection.return_value
+    conn.get_capabilities.return_value = {}
+    conn.get_container.return_value = ({}, [])
+    conn.delete_object.side_effect = swiftclient.ClientException('Not found', http_status=404)
+    backend = SwiftBackend('test', Config(user='user', key='key', authurl='http://auth'))
+
+    backend.delete('a.png')
+
+    conn.get_container.assert_any_call('test', prefix='a.png/', full_listing=True)
+    conn.delete_object.assert_called_once_with('test', 'a.png')
+    assert not conn.post_account.called
+
+
+def test_open_write_segments(mocker):
+    connection = mocker.patch('swiftclient.Connection')
+    conn = connection.return_value
+    conn.get_capabilities.return_value = {'slo': {}, 'bulk_delete': {}}
+    conn.put_object.return_value = 'etag'
+    conn.head_object.return_value = {'x-static-large-object': 'True'}
+    old_segment = 'file.txt/{0}/00000001'.format('0' * 32)
+    conn.get_container.return_value = ({}, [{'name': old_segment},
+                                            {'name': 'file.txt/other.txt'}])
+    conn.post_account.return_value = ({}, b'{"Response Status": "200 OK", "Errors": []}')
+    backend = SwiftBackend('test', Config(user='user', key='key', authurl='http://auth',
+                                          part_size=4))
+
+    with backend.open('file.txt', 'wb') as f:
+        f.write(b'abcdefghij')
+
+    segments = [c for c in conn.put_object.call_args_list if c[0][0] == 'test_segments']
+    assert [c[1]['contents'] for c in segments] == [b'abcd', b'efgh', b'ij']
+    manifest_call = conn.put_object.call_args_list[-1]
+    assert manifest_call[0][:2] == ('test', 'file.txt')
+    assert manifest_call[1]['query_string'] == 'multipart-manifest=put'
+    manifest = json.loads(manifest_call[1]['contents'])
+    assert [s['path'] for s in manifest] == ['/test_segments/' + c[0][1] for c in segments]
+    assert manifest_call[1]['headers'] == {
+        'X-Object-Meta-Checksum': backend.compute_checksum(b'abcdefghij')
+    }
+    # Previous version segments are deleted
+    expected = '/test_segments/{0}'.format(old_segment).encode('utf8')
+    assert conn.post_account.call_args[1]['data'] == expected
+
+
+def test_write_bytes_over_manifest(mocker):
+    connection = mocker.patch('swiftclient.Connection')
+    conn = connection.return_value
+    conn.get_capabilities.return_value = {'bulk_delete': {}}
+    conn.head_object.return_value = {'x-object-manifest': 'test_segments/file.txt/abc/'}
+    old_segment = 'file.txt/{0}/00000001'.format('0' * 32)
+    conn.get_container.return_value = ({}, [{'name': old_segment}])
+    conn.post_account.return_value = ({}, b'{"Response Status": "200 OK", "Errors": []}')
+    backend = SwiftBackend('test', Config(user='user', key='key', authurl='http://auth'))
+
+    backend.write('file.txt', b'abc')
+
+    conn.put_object.assert_called_once_with('test', 'file.txt', contents=b'abc', headers={
+        'X-Object-Meta-Checksum': backend.compute_checksum(b'abc'),
+    })
+    expected = '/test_segments/{0}'.format(old_segment).encode('utf8')
+    assert conn.post_account.call_args[1]['data'] == expected
+
+
+@pytest.mark.parametrize('overwrite,existing', [
+    (False, None),
+    (True, None),
+    (True, {'content-length': '3', 'etag': 'etag'}),
+])
+def test_write_stream_without_previous_segments(mocker, utils, overwrite, existing):
+    connection = mocker.patch('swiftclient.Connection')
+    conn = connection.return_value
+    conn.get_capabilities.return_value = {'slo': {}}
+    conn.put_object.return_value = 'etag'
+    if existing is None:
+        conn.head_object.side_effect = swiftclient.ClientException('Not found', http_status=404)
+    else:
+        conn.head_object.return_value = existing
+    backend = SwiftBackend('test', Config(user='user', key='key', authurl='http://auth',
+                                          part_size=4))
+
+    backend.write('file.txt', utils.file(b'abcdefghij'), overwrite=overwrite)
+    backend.write('small.txt', utils.file(b'abc'), overwrite=overwrite)
+
+    assert conn.head_object.called == overwrite
+    assert not conn.get_container.called
+
+
+def test_open_write_abort_segments(mocker):
+    connection = mocker.patch('swiftclient.Connection')
+    conn = connection.return_value
+    conn.get_capabilities.return_value = {}
+    backend = SwiftBackend('test', Config(user='user', key='key', authurl='http://auth',
+                                          part_size=4))
+
+    with pytest.raises(ValueError):
+        with backend.open('file.txt', 'wb') as f:
+            f.write(b'abcdefghij')
+            raise ValueError()
+
+    uploaded = [c[0][1] for c in conn.put_object.call_args_list]
+    deleted = [c[0][1] for c in conn.delete_object.call_args_list]
+    assert len(uploaded) == 2
+    assert deleted == uploaded
+
+
+def test_download_ranges(mocker):
+    content = b'abcdefghij'
+    connection = mocker.patch('swiftclient.Connection')
+    conn = connection.return_value
+    conn.head_object.return_value = {'content-length': '10', 'etag': 'etag'}
+
+    def get_object(container, filename, headers):
+        start, end = headers['Range'][len('bytes='):].split('-')
+        return {}, content[int(start):int(end) + 1]
+
+    conn.get_object.side_effect = get_object
+    backend = SwiftBackend('test', Config(user='user', key='key', authurl='http://auth',
+                                          part_size=4, max_concurrency=2))
+    out = io.BytesIO()
+
+    backend.download('file.txt', out)
+
+    assert out.getvalue() == content
+    ranges = sorted(c[1]['headers']['Range'] for c in conn.get_object.call_args_list)
+    assert ranges == ['bytes=0-3', 'bytes=4-7', 'bytes=8-9']
+    assert all(c[1]['headers']['If-Match'] == 'etag' for c in conn.get_object.call_args_list)
+    connection.assert_any_call(preauthurl=conn.url, preauthtoken=conn.token)
+
+
+def test_download_small_file_streamed(mocker):
+    connection = mocker.patch('swiftclient.Connection')
+    conn = connection.return_value
+    conn.head_object.return_value = {'content-length': '3', 'etag': 'etag'}
+    conn.get_object.return_value = ({}, iter([b'ab', b'c']))
+    backend = SwiftBackend('test', Config(user='user', key='key', authurl='http://auth',
+                                          part_size=4))
+    out = io.BytesIO()
+
+    backend.download('file.txt', out)
+
+    assert out.getvalue() == b'abc'
+    conn.get_object.assert_called_once_with('test', 'file.txt', resp_chunk_size=64 * 1024)
+
+
+def test_serve_streamed(app, mocker):
+    connection = mocker.patch('swiftclient.Connection')
+    conn = connection.return_value
+    body = mocker.MagicMock()
+    body.__iter__.return_value = iter([b'abc', b'def'])
+    conn.get_object.return_value = ({'content-type': 'text/plain', 'content-length': '6'}, body)
+    backend = SwiftBackend('test', Config(user='user', key='key', authurl='http://auth',
+                                          serve_chunk_size=3))
+
+    response = backend.serve('file.txt')
+
+    conn.get_object.assert_called_once_with('test', 'file.txt', headers={}, resp_chunk_size=3)
+    assert response.content_length == 6
+    assert response.mimetype == 'text/plain'
+    assert list(response.response) == [b'abc', b'def']
+    assert body.close.called
+
+
+def test_iter_range_single_request(mocker):
+    connection = mocker.patch('swiftclient.Connection')
+    conn = connection.return_value
+    body = mocker.MagicMock()
+    body.__iter__.return_value = iter([b'23', b'4'])
+    conn.get_object.return_value = ({}, body)
+    backend = SwiftBackend('test', Config(user='user', key='key', authurl='http://auth',
+                                          serve_chunk_size=2))
+
+    assert list(backend.iter_range('file.txt', 2, 5)) == [b'23', b'4']
+    conn.get_object.assert_called_once_with('test', 'file.txt', resp_chunk_size=2,
+                                            headers={'Range': 'bytes=2-4'})
+    assert body.close.called
+
+
+@pytest.mark.parametrize('digest', ['sha1', 'sha256'])
+def test_signed_url_offline(mocker, digest):
+    connection = mocker.patch('swiftclient.Connection')
+    backend = SwiftBackend('test', Config(user='user', key='key', authurl='http://auth',
+                                          temp_url_key='secret', temp_url_digest=digest,
+                                          storage_url='https://swift/v1/AUTH_account/'))
+
+    before = int(time.time())
+    url = backend.signed_url('some dir/file.txt', expires=600)
+
+    expires = url.rsplit('temp_url_expires=', 1)[1]
+    assert before + 600 <= int(expires) <= time.time() + 600
+    path = '/v1/AUTH_account/test/some dir/file.txt'
+    body = '\n'.join(('GET', expires, path)).encode('utf8')
+    signature = hmac.new(b'secret', body, getattr(hashlib, digest)).hexdigest()
+    assert url == ('https://swift/v1/AUTH_account/test/some%20dir/file.txt'
+                   '?temp_url_sig={0}&temp_url_expires={1}'.format(signature, expires))
+    assert backend.signed_url('some dir/file.txt', expires=600) == url
+    assert not connection.called
+
+
+def test_signed_url_from_auth_storage_url(mocker):
+    connection = mocker.patch('swiftclient.Connection')
+    connection.return_value.url = 'https://swift/v1/AUTH_account'
+    backend = SwiftBackend('test', Config(user='user', key='key', authurl='http://auth',
+                                          temp_url_key='secret'))
+
+    url = backend.signed_url('file.txt')
+
+    assert url.startswith('https://swift/v1/AUTH_account/test/file.txt?temp_url_sig=')
+
+
+def test_signed_url_without_key(mocker):
+    mocker.patch('swiftclient.Connection')
+    backend = SwiftBackend('test', Config(user='user', key='key', authurl='http://auth'))
+
+    with pytest.raises(OperationNotSupported):
+        backend.signed_url('file.txt')
+
+
+def test_unsupported_temp_url_digest():
+    with pytest.raises(ValueError):
+        SwiftBackend('test', Config(user='user', key='key', authurl='http://auth',
+                                    temp_url_digest='md5'))
+
+
+def test_serve_redirect(app, mocker):
+    connection = mocker.patch('swiftclient.Connection')
+    backend = SwiftBackend('test', Config(user='user', key='key', authurl='http://auth',
+                                          temp_url_key='secret', redirect=True,
+                                          storage_url='https://swift/v1/AUTH_account'))
+
+    response = backend.serve('file.txt')
+
+    assert response.status_code == 302
+    assert response.headers['Location'].startswith('https://swift/v1/AUTH_account/test/file.txt?')
+    assert not connection.return_value.get_object.called
+
+
+def test_serve_closes_unread_body(app, mocker):
+    connection = mocker.patch('swiftclient.Connection')
+    conn = connection.return_value
+    body = mocker.MagicMock()
+    conn.get_object.return_value = ({'content-type': 'text/plain', 'content-length': '6'}, body)
+    backend = SwiftBackend('test', Config(user='user', key='key', authurl='http://auth'))
+
+    response = backend.serve('file.txt')
+    response.close()
+
+    assert body.close.called
+
+
+def test_serve_forwards_conditions(app, mocker):
+    connection = mocker.patch('swiftclient.Connection')
+    conn = connection.return_value
+    body = mocker.MagicMock()
+    body.__iter__.return_value = iter([b'2345'])
+    conn.get_object.return_value = ({
+        'content-type': 'text/plain', 'content-length': '4', 'etag': 'abc',
+        'content-range': 'bytes 2-5/10', 'last-modified': 'Wed, 01 Jan 2020 00:00:00 GMT',
+    }, body)
+    backend = SwiftBackend('test', Config(user='user', key='key', authurl='http://auth'))
+
+    headers = {'Range': 'bytes=2-5', 'If-Modified-Since': 'Tue, 31 Dec 2019 00:00:00 GMT'}
+
+    with app.test_request_context('/', headers=headers):
+        response = backend.serve('file.txt')
+
+    conn.get_object.assert_called_once_with('test', 'file.txt', headers=headers,
+                                            resp_chunk_size=backend.serve_chunk_size)
+    assert not conn.head_object.called
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == 'bytes 2-5/10'
+    assert response.headers['ETag'] == '"abc"'
+    assert response.headers['Last-Modified'] == 'Wed, 01 Jan 2020 00:00:00 GMT'
+
+
+def test_serve_not_modified(app, mocker):
+    connection = mocker.patch('swiftclient.Connection')
+    conn = connection.return_value
+    conn.get_object.side_effect = swiftclient.ClientException(
+        'Not Modified', http_status=304, http_response_headers={'etag': 'abc'}
+    )
+    backend = SwiftBackend('test', Config(user='user', key='key', authurl='http://auth'))
+
+    with app.test_request_context('/', headers={'If-None-Match': '"abc"'}):
+        response = backend.serve('file.txt')
+
+    assert response.status_code == 304
+    assert response.headers['ETag'] == '"abc"'
+    assert not conn.head_object.called
@@ -1,10 +1,14 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from flask import url_for
+import os
+
+from flask import redirect, url_for
 
 import flask_fs as fs
 
+import pytest
+
 
 def test_url(app):
     storage = fs.Storage('test')
@@ -32,7 +36,7 @@ def test_get_file(app, mock_backend):
 def test_get_file_not_found(app, mock_backend):
     storage = fs.Storage('test')
     backend = mock_backend.return_value
-    backend.exists.return_value = False
+    backend.serve.side_effect = fs.FileNotFound('test.txt')
 
     app.configure(storage)
 
@@ -49,3 +53,175 @@ def test_get_file_no_storage(app):
 
     response = app.test_client().get(file_url)
     assert response.status_code == 404
+
+
+@pytest.fixture
+def local(app, tmpdir):
+    storage = fs.Storage('test')
+    app.configure(storage, FS_ROOT=str(tmpdir))
+    storage.write('test.txt', b'0123456789')
+    return storage
+
+
+def get(app, headers=None):
+    file_url = url_for('fs.get_file', fs='test', filename='test.txt')
+    return app.test_client().get(file_url, headers=headers or {})
+
+
+def test_get_file_validators(app, local, mocker):
+    metadata = mocker.spy(local.backend, 'metadata')
+    response = get(app)
+
+    stat = os.stat(local.path('test.txt'))
+    assert response.status_code == 200
+    assert response.data == b'0123456789'
+    assert response.headers['ETag'] == 'W/"{0:x}-{1:x}"'.format(stat.st_mtime_ns, stat.st_size)
+    assert response.last_modified is not None
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    assert not metadata.called
+
+
+def test_get_file_if_none_match(app, local):
+    etag = get(app).headers['ETag']
+
+    response = get(app, {'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+    assert response.headers['ETag'] == etag
+
+    response = get(app, {'If-None-Match': '"other"'})
+    assert response.status_code == 200
+
+
+def test_get_file_if_modified_since(app, local):
+    last_modified = get(app).headers['Last-Modified']
+
+    response = get(app, {'If-Modified-Since': last_modified})
+    assert response.status_code == 304
+
+    response = get(app, {'If-Modified-Since': 'Thu, 01 Jan 1970 00:00:00 GMT'})
+    assert response.status_code == 200
+
+
+def test_get_file_range(app, local):
+    response = get(app, {'Range': 'bytes=2-5'})
+
+    assert response.status_code == 206
+    assert response.data == b'2345'
+    assert response.headers['Content-Range'] == 'bytes 2-5/10'
+    assert response.content_length == 4
+
+
+def test_get_file_suffix_range(app, local):
+    response = get(app, {'Range': 'bytes=-3'})
+
+    assert response.status_code == 206
+    assert response.data == b'789'
+    assert response.headers['Content-Range'] == 'bytes 7-9/10'
+
+
+def test_get_file_open_range(app, local):
+    response = get(app, {'Range': 'bytes=8-'})
+
+    assert response.status_code == 206
+    assert response.data == b'89'
+    assert response.headers['Content-Range'] == 'bytes 8-9/10'
+
+
+def test_get_file_multiple_ranges(app, local):
+    response = get(app, {'Range': 'bytes=0-1,5-20'})
+
+    assert response.status_code == 206
+    assert response.mimetype == 'multipart/byteranges'
+    boundary = response.mimetype_params['boundary'].encode('ascii')
+    assert response.content_length == len(response.data)
+    parts = response.data.split(b'--' + boundary)
+    assert parts[-1] == b'--\r\n'
+    assert [part.split(b'\r\n\r\n', 1)[1].rstrip(b'\r\n') for part in parts[1:-1]] == [
+        b'01', b'56789'
+    ]
+    assert b'Content-Range: bytes 0-1/10' in parts[1]
+    assert b'Content-Range: bytes 5-9/10' in parts[2]
+    assert b'Content-Type: text/plain' in parts[1]
+
+
+def test_get_file_range_not_satisfiable(app, local):
+    response = get(app, {'Range': 'bytes=20-30'})
+
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == 'bytes */10'
+
+
+def test_get_file_if_range(app, local):
+    last_modified = get(app).headers['Last-Modified']
+
+    response = get(app, {'Range': 'bytes=2-5', 'If-Range': last_modified})
+    assert response.status_code == 206
+    assert response.data == b'2345'
+
+    response = get(app, {'Range': 'bytes=2-5', 'If-Range': 'Thu, 01 Jan 1970 00:00:00 GMT'})
+    assert response.status_code == 200
+    assert response.data == b'0123456789'
+
+
+def test_get_file_if_range_weak_etag(app, local):
+    etag = get(app).headers['ETag']
+
+    # Weak entity tags can't validate ranges
+    response = get(app, {'Range': 'bytes=2-5', 'If-Range': etag})
+    assert response.status_code == 200
+    assert response.data == b'0123456789'
+
+
+def test_get_file_cache_control(app, tmpdir):
+    storage = fs.Storage('test')
+    app.configure(storage, FS_ROOT=str(tmpdir), TEST_FS_CACHE_CONTROL=3600)
+    storage.write('test.txt', b'0123456789')
+
+    assert get(app).headers['Cache-Control'] == 'public, max-age=3600'
+    assert get(app, {'Range': 'bytes=0-1'}).headers['Cache-Control'] == 'public, max-age=3600'
+
+
+def test_get_file_local_not_found(app, local):
+    file_url = url_for('fs.get_file', fs='test', filename='missing.txt')
+
+    response = app.test_client().get(file_url, headers={'Range': 'bytes=0-1'})
+    assert response.status_code == 404
+
+
+def test_get_file_outside_root(app, local):
+    file_url = url_for('fs.get_file', fs='test', filename='../test/test.txt')
+
+    response = app.test_client().get(file_url, headers={'Range': 'bytes=0-1'})
+    assert response.status_code == 404
+
+
+def test_get_file_offloaded_range(app, tmpdir, mocker):
+    storage = fs.Storage('test')
+    app.configure(storage, FS_ROOT=str(tmpdir), TEST_FS_SENDFILE='x-accel-redirect')
+    storage.write('test.txt', b'0123456789')
+    metadata = mocker.spy(storage.backend, 'metadata')
+
+    response = get(app, {'Range': 'bytes=2-5', 'If-None-Match': '*'})
+
+    # Conditional and range requests are handled by the front server
+    assert response.status_code == 200
+    assert response.headers['X-Accel-Redirect'] == '/test/test.txt'
+    assert response.data == b''
+    assert 'ETag' not in response.headers
+    assert not metadata.called
+
+
+def test_get_file_redirect(app, mock_backend):
+    storage = fs.Storage('test')
+    backend = mock_backend.return_value
+    backend.serve.return_value = redirect('https://signed.somewhere.com/test.txt')
+
+    app.configure(storage)
+
+    response = get(app, {'Range': 'bytes=2-5'})
+
+    assert response.status_code == 302
+    assert response.headers['Location'] == 'https://signed.somewhere.com/test.txt'
+    assert 'Cache-Control' not in response.headers
+    assert not backend.metadata.called